@@ -0,0 +1,239 @@
+import argparse
+import csv
+import multiprocessing as mp
+import os
+import resource
+import time
+
+import numpy as np
+import texttable as tt
+import torch
+
+# execution modes: backend of predict.py, CPU precision, and whether graphs are predicted in batches
+MODES = {
+    "eager": ("eager", "fp32", False),
+    "batched": ("eager", "fp32", True),
+    "bf16": ("eager", "bf16", False),
+    "int8": ("eager", "int8", False),
+    "int8+bf16": ("eager", "int8+bf16", False),
+    "compiled": ("compiled", "fp32", False),
+    "onnx": ("onnx", "fp32", False),
+}
+
+# backends that only exist for GTModel
+GT_ONLY_BACKENDS = ["compiled", "onnx"]
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+# the batched mode predicts copies of a graph together, up to these many graphs and nodes
+MAX_BATCH_GRAPHS = 64
+MAX_BATCH_NODES = 1 << 14
+
+# after a cold call slower than this, a size is only timed once more
+SLOW_SECONDS = 10
+
+FIELDS = ["model", "mode", "backend", "precision", "num_nodes", "num_edges", "batch_graphs", "load_ms",
+          "cold_ms", "warm_ms", "graphs_per_s", "nodes_per_s", "peak_rss_mb", "error"]
+
+
+def peak_rss_mb():
+    # high-water mark of the resident memory of this process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_config(model, mode, sizes, edges_per_node, repeats, threads, pt_paths=None):
+    """
+    Rows of one (model, mode) over the sizes, measured in this process. Run it
+    in a fresh process (see run_config): the first call at every size is its
+    cold latency, and sizes go up so that the peak RSS is the one of the size.
+    """
+    import predict
+    from deadline import synthetic_graph
+    from export import export_onnx_checkpoint, onnx_model_dir
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    backend, precision, batched = MODES[mode]
+    predict.MODEL = model
+    predict.BACKEND = backend
+    base = {"model": model, "mode": mode, "backend": backend, "precision": precision}
+
+    try:
+        if backend == "onnx" and not os.path.isdir(onnx_model_dir(predict.GT_MODEL_PATH)):
+            export_onnx_checkpoint(predict.GT_MODEL_PATH)
+
+        start = time.perf_counter()
+        predictor = predict.Predictor(is_cuda=False, precision=precision, memory_budget=predict.MEMORY_BUDGET)
+        load_ms = (time.perf_counter() - start) * 1000
+    except Exception as e:
+        return [dict(base, error=f"{type(e).__name__}: {e}")]
+
+    rows = []
+    for i, num_nodes in enumerate(sizes):
+        if pt_paths is not None:
+            graph = torch.load(pt_paths[i], weights_only=False)
+        else:
+            graph = synthetic_graph(num_nodes, num_nodes * edges_per_node, seed=i)
+
+        num_graphs = max(1, min(MAX_BATCH_GRAPHS, MAX_BATCH_NODES // graph.num_nodes)) if batched else 1
+        graphs = [graph] * num_graphs
+        row = dict(base, num_nodes=graph.num_nodes, num_edges=graph.num_edges, batch_graphs=num_graphs, load_ms=load_ms)
+
+        try:
+            start = time.perf_counter()
+            predictor.predict_model_batch(graphs)
+            row["cold_ms"] = (time.perf_counter() - start) * 1000
+
+            elapsed = []
+            for _ in range(repeats if row["cold_ms"] < SLOW_SECONDS * 1000 else 1):
+                start = time.perf_counter()
+                predictor.predict_model_batch(graphs)
+                elapsed.append(time.perf_counter() - start)
+            warm = float(np.median(elapsed))
+
+            row.update(warm_ms=warm * 1000, graphs_per_s=num_graphs / warm,
+                       nodes_per_s=num_graphs * graph.num_nodes / warm, peak_rss_mb=peak_rss_mb())
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+        rows.append(row)
+    return rows
+
+
+def run_config(*args):
+    # bench_config in a spawned process, so that the model, caches and peak RSS start from scratch
+    with mp.get_context("spawn").Pool(1) as pool:
+        return pool.apply(bench_config, args)
+
+
+def sample_pt_files(pt_dir_path, sizes, max_files=500):
+    # for every size, the converted graph (of up to max_files spread over the directory) with the closest node count
+    pt_file_lst = sorted(os.listdir(pt_dir_path))
+    pt_file_lst = pt_file_lst[::max(1, len(pt_file_lst) // max_files)]
+    num_nodes = {pt_file: torch.load(os.path.join(pt_dir_path, pt_file), weights_only=False).num_nodes
+                 for pt_file in pt_file_lst}
+
+    picked = [min(pt_file_lst, key=lambda pt_file: abs(np.log(num_nodes[pt_file] / size))) for size in sizes]
+    order = np.argsort([num_nodes[pt_file] for pt_file in picked], kind="stable")
+    return [os.path.join(pt_dir_path, picked[i]) for i in order], [num_nodes[picked[i]] for i in order]
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def plot_curves(rows, path):
+    # warm latency, cold latency and peak RSS against graph size, one curve per model and mode
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 3, figsize=(18, 5))
+    configs = sorted({(row["model"], row["mode"]) for row in rows})
+    for model, mode in configs:
+        points = [row for row in rows if (row["model"], row["mode"]) == (model, mode) and not row.get("error")]
+        if len(points) == 0:
+            continue
+        x = [row["num_nodes"] for row in points]
+        # per graph, batches of the batched mode hold many
+        axes[0].plot(x, [row["warm_ms"] / row["batch_graphs"] for row in points], marker="o", label=f"{model} {mode}")
+        axes[1].plot(x, [row["cold_ms"] for row in points], marker="o")
+        axes[2].plot(x, [row["peak_rss_mb"] for row in points], marker="o")
+
+    for ax, label in zip(axes, ["warm latency per graph (ms)", "cold latency (ms)", "peak RSS (MB)"]):
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("nodes")
+        ax.set_ylabel(label)
+        ax.grid(True, alpha=0.3, linestyle="--")
+    axes[0].legend(loc="best", fontsize=8)
+    fig.tight_layout()
+    fig.savefig(path, dpi=150)
+    plt.close(fig)
+
+
+def regressions(rows, baseline_rows, tolerance):
+    # rows whose warm latency is above (1 + tolerance) times the baseline at the same model, mode and size
+    baseline = {(row["model"], row["mode"], int(row["num_nodes"])): float(row["warm_ms"])
+                for row in baseline_rows if row.get("warm_ms")}
+    slower = []
+    for row in rows:
+        key = (row["model"], row["mode"], row["num_nodes"])
+        if row.get("warm_ms") is not None and key in baseline and row["warm_ms"] > (1 + tolerance) * baseline[key]:
+            slower.append((*key, baseline[key], row["warm_ms"]))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="latency, throughput and peak RSS of CPU inference across graph sizes and execution modes")
+    parser.add_argument('--models', type=str, nargs="+", default=["neuroback", "mamba"])
+    parser.add_argument('--modes', type=str, nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument('--sizes', type=int, nargs="+", default=DEFAULT_SIZES, help="nodes of the graphs")
+    parser.add_argument('--edges_per_node', type=int, default=6, help="of the synthetic graphs (about 6.5 for random 3-SAT)")
+    parser.add_argument('--pt_dir_path', type=str, default=None, help="sample converted graphs of these sizes instead")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default="./log/bench_inference/bench.csv")
+    parser.add_argument('--no_plot', action='store_true')
+    parser.add_argument('--baseline', type=str, default=None, help="CSV of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="warm latency increase over the baseline to report")
+    args = parser.parse_args()
+
+    import predict
+
+    pt_paths, sizes = None, sorted(args.sizes)
+    if args.pt_dir_path is not None:
+        pt_paths, sizes = sample_pt_files(args.pt_dir_path, sizes)
+
+    rows = []
+    for model in args.models:
+        checkpoint_path = predict.MAMBA_MODEL_PATH if model == "mamba" else predict.GT_MODEL_PATH
+        if not os.path.isfile(checkpoint_path):
+            print(f"skipping {model}: no checkpoint {checkpoint_path}")
+            continue
+
+        for mode in args.modes:
+            if model == "mamba" and MODES[mode][0] in GT_ONLY_BACKENDS:
+                continue
+            print(f"{model} {mode}", flush=True)
+            rows += run_config(model, mode, sizes, args.edges_per_node, args.repeats, args.threads, pt_paths)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    write_csv(args.output, rows)
+
+    table = tt.Texttable()
+    table.header(["model", "mode", "nodes", "cold (ms)", "warm (ms)", "graphs/s", "peak RSS (MB)"])
+    for row in rows:
+        if row.get("error"):
+            table.add_row([row["model"], row["mode"], row.get("num_nodes", "-"), row["error"].split(":")[0], "-", "-", "-"])
+        else:
+            table.add_row([row["model"], row["mode"], row["num_nodes"], row["cold_ms"], row["warm_ms"],
+                           row["graphs_per_s"], row["peak_rss_mb"]])
+    table.set_precision(1)
+    print(table.draw())
+    print(f"saved to {args.output}")
+
+    if not args.no_plot:
+        plot_path = os.path.splitext(args.output)[0] + ".png"
+        plot_curves(rows, plot_path)
+        print(f"saved to {plot_path}")
+
+    if args.baseline is not None:
+        slower = regressions(rows, read_csv(args.baseline), args.tolerance)
+        if len(slower) > 0:
+            table = tt.Texttable()
+            table.header(["model", "mode", "nodes", "baseline (ms)", "warm (ms)"])
+            table.add_rows(slower, header=False)
+            table.set_precision(1)
+            print(table.draw())
+            print(f"{len(slower)} regressions over {args.tolerance:.0%}")
+            exit(1)
+        print("no regressions")
@@ -0,0 +1,110 @@
+import argparse
+import time
+
+import torch
+import texttable as tt
+
+from mamba_cpu import MambaCPU, selective_scan, selective_scan_ref
+from mamba_model import Mamba
+
+
+def random_inputs(batch, length, d_inner, d_state, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    u = torch.randn(batch, length, d_inner, generator=g)
+    delta = torch.randn(batch, length, d_inner, generator=g) * 0.5
+    A = -torch.rand(d_inner, d_state, generator=g) * d_state
+    B = torch.randn(batch, length, d_state, generator=g)
+    C = torch.randn(batch, length, d_state, generator=g)
+    D = torch.randn(d_inner, generator=g)
+    z = torch.randn(batch, length, d_inner, generator=g)
+    delta_bias = torch.randn(d_inner, generator=g) * 0.1
+    return u, delta, A, B, C, D, z, delta_bias
+
+
+def check_scan(atol):
+    ok = True
+    for batch, length, d_inner, d_state, chunk_size in [(1, 1, 8, 4, 64), (2, 37, 16, 8, 8),
+                                                         (3, 130, 32, 16, 64), (1, 257, 128, 64, 32)]:
+        u, delta, A, B, C, D, z, delta_bias = random_inputs(batch, length, d_inner, d_state)
+        ref = selective_scan_ref(u, delta, A, B, C, D, z=z, delta_bias=delta_bias)
+        out = selective_scan(u, delta, A, B, C, D, z=z, delta_bias=delta_bias, chunk_size=chunk_size)
+        diff = (out - ref).abs().max().item()
+        print(f"scan b={batch} l={length} d={d_inner} n={d_state} chunk={chunk_size}: max |diff| = {diff:.2e}")
+        ok &= diff <= atol
+
+    # gradients, the scan is also used for training
+    inputs = [t.requires_grad_() for t in random_inputs(2, 37, 16, 8)]
+    ref_grads = torch.autograd.grad(selective_scan_ref(*inputs[:6], z=inputs[6], delta_bias=inputs[7]).sum(), inputs)
+    grads = torch.autograd.grad(selective_scan(*inputs[:6], z=inputs[6], delta_bias=inputs[7], chunk_size=8).sum(), inputs)
+    diff = max((g - r).abs().max().item() for g, r in zip(grads, ref_grads))
+    print(f"scan gradients: max |diff| = {diff:.2e}")
+    ok &= diff <= atol * 10
+
+    # the CPU block must expose exactly the parameters of mamba_ssm.Mamba
+    block = MambaCPU(d_model=64, d_state=64, d_conv=4, expand=2)
+    if Mamba is not None and torch.cuda.is_available():
+        ref_block = Mamba(d_model=64, d_state=64, d_conv=4, expand=2).cuda()
+        block.load_state_dict({k: v.cpu() for k, v in ref_block.state_dict().items()})
+
+        x = torch.randn(2, 100, 64)
+        with torch.no_grad():
+            diff = (block(x) - ref_block(x.cuda()).cpu()).abs().max().item()
+        print(f"MambaCPU vs mamba_ssm.Mamba: max |diff| = {diff:.2e}")
+        ok &= diff <= atol
+    else:
+        expected = {"in_proj.weight": (256, 64), "conv1d.weight": (128, 1, 4), "conv1d.bias": (128,),
+                    "x_proj.weight": (4 + 2 * 64, 128), "dt_proj.weight": (128, 4), "dt_proj.bias": (128,),
+                    "A_log": (128, 64), "D": (128,), "out_proj.weight": (64, 128)}
+        shapes = {k: tuple(v.shape) for k, v in block.state_dict().items()}
+        print(f"MambaCPU parameters match mamba_ssm.Mamba: {shapes == expected}")
+        ok &= shapes == expected
+    return ok
+
+
+def bench(lengths, batch, d_inner, d_state, chunk_sizes, repeat):
+    table = tt.Texttable()
+    table.header(["length", "impl", "chunk", "ms", "tokens/s"])
+
+    for length in lengths:
+        u, delta, A, B, C, D, z, delta_bias = random_inputs(batch, length, d_inner, d_state)
+
+        impls = [("chunked", chunk_size) for chunk_size in chunk_sizes]
+        if length <= 4096:
+            impls.append(("reference", "-"))
+
+        for impl, chunk_size in impls:
+            with torch.no_grad():
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    if impl == "reference":
+                        selective_scan_ref(u, delta, A, B, C, D, z=z, delta_bias=delta_bias)
+                    else:
+                        selective_scan(u, delta, A, B, C, D, z=z, delta_bias=delta_bias, chunk_size=chunk_size)
+                elapsed = (time.perf_counter() - start) / repeat
+            table.add_row([length, impl, chunk_size, elapsed * 1000, batch * length / elapsed])
+
+    table.set_precision(1)
+    print(table.draw())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check the CPU selective scan against the naive reference and benchmark it")
+    parser.add_argument('--lengths', type=int, nargs="+", default=[256, 1024, 4096, 16384, 65536])
+    parser.add_argument('--chunk_sizes', type=int, nargs="+", default=[0, 256, 1024])
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--d_inner', type=int, default=128)
+    parser.add_argument('--d_state', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if not check_scan(args.atol):
+        print("selective scan check FAILED")
+        exit(1)
+    print("selective scan check passed")
+
+    bench(args.lengths, args.batch, args.d_inner, args.d_state, args.chunk_sizes, args.repeat)
@@ -0,0 +1,72 @@
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(state):
+    # copy of a (nested) state dict with every tensor copied to host memory
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class AsyncCheckpointer:
+    """
+    Saves checkpoints without blocking the training loop: save() snapshots the
+    state to host memory and returns, a background thread writes the snapshot
+    to a temporary file and renames it, so a checkpoint on disk is always complete.
+    At most one write is in flight, save() waits for the previous one first.
+    """
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def save(self, state, *paths):
+        snapshot = to_cpu(state)
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(snapshot, paths), daemon=True)
+        self._thread.start()
+
+    def _write(self, snapshot, paths):
+        try:
+            for path in paths:
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                torch.save(snapshot, tmp_path)
+                os.replace(tmp_path, path)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -90,3 +90,46 @@ class SortedBucketSampler(Sampler):
 
     def __len__(self):
         return len(self.dataset)
+
+class ResumableSampler(Sampler):
+    """
+    Random sampler whose order only depends on (seed, epoch), so that training
+    resumed from a checkpoint sees the same data order, starting at the sample
+    where it stopped (set_epoch(epoch, start)).
+    """
+    def __init__(self, data_source, shuffle=True, seed=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        n = len(self.data_source)
+        if self.shuffle:
+            g = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(n, generator=g).tolist()
+        else:
+            order = list(range(n))
+        return iter(order[self.start:])
+
+    def __len__(self):
+        return max(len(self.data_source) - self.start, 0)
+
+def stratified_indices(num_graphs, size, seed=0):
+    """
+    Fixed subsample of a dataset whose graphs are sorted by size (MyOwnDataset):
+    one graph drawn from each of `size` consecutive strata of the sorted graphs,
+    so that the subsample spans the size range of the whole dataset.
+    """
+    if size is None or size >= num_graphs:
+        return torch.arange(num_graphs)
+
+    bounds = torch.linspace(0, num_graphs, size + 1).long()
+    g = torch.Generator().manual_seed(seed)
+    offsets = (torch.rand(size, generator=g) * (bounds[1:] - bounds[:-1])).long()
+    return bounds[:-1] + offsets
@@ -0,0 +1,292 @@
+import argparse
+import copy
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+from scipy.optimize import nnls
+from torch_geometric.data import Data
+
+import predict
+from gt_model import GTModel
+from predict import MEMORY_BUDGET, PRECISION, batch_nodes, coalesce, get_predictor
+
+# distilled student of distill.py, the cheapest full-coverage plan when it exists
+STUDENT_MODEL_PATH = "./models/distill/distill-best.ptg"
+
+# fitted cost models, one file per model and host
+LATENCY_DIR = "./cache/latency"
+
+# plans are sized for this fraction of the time left, the rest absorbs cost model errors
+SAFETY = 0.8
+
+# model variants, from the most to the least accurate: the student is trained
+# to match the full model, skipping the decode blocks is not trained at all
+VARIANTS = ["full", "student", "no_decode"]
+
+# (nodes, edges) of the graphs timed to fit the cost model
+CALIBRATION_SIZES = [(n, n * r) for n in (100, 1000, 10000, 100000) for r in (2, 6)]
+
+
+def without_decode(model):
+    # a GTModel with its decode blocks (residual) skipped, sharing the weights of model
+    truncated = copy.copy(model)
+    truncated._modules = dict(model._modules, decode=None)
+    return truncated
+
+
+def variant_predictors(predictor, student_path=STUDENT_MODEL_PATH):
+    # the variants of VARIANTS available for a predictor
+    variants = {"full": predictor}
+
+    if isinstance(predictor.model, GTModel) and predictor.model.decode is not None:
+        fewer = copy.copy(predictor)
+        fewer.model = without_decode(predictor.model)
+        fewer.run_model = without_decode(predictor.run_model)
+        fewer.model_key = predictor.model_key + "-no_decode"
+        variants["no_decode"] = fewer
+
+    if predict.MODEL == "neuroback" and predict.BACKEND != "onnx" and os.path.isfile(student_path):
+        variants["student"] = get_predictor(predictor.is_cuda, predictor.precision, predictor.memory_budget,
+                                            checkpoint_path=student_path)
+    return variants
+
+
+def synthetic_graph(num_nodes, num_edges, seed=0):
+    # a random graph with the layout of pt_dataset.py graphs (variables, clauses, root), for timing
+    generator = torch.Generator().manual_seed(seed)
+    num_vars = max(num_nodes // 2, 1)
+    num_clauses = max(num_nodes - num_vars - 1, 1)
+    root = num_vars + num_clauses
+
+    num_lits = max(num_edges // 2 - num_clauses, 1)
+    src = torch.cat([torch.randint(0, num_vars, (num_lits,), generator=generator), torch.full((num_clauses,), root)])
+    dst = torch.cat([torch.randint(num_vars, root, (num_lits,), generator=generator), torch.arange(num_vars, root)])
+    edge_attr = torch.cat([torch.randint(0, 2, (num_lits, 1), generator=generator) * 2 - 1, torch.zeros(num_clauses, 1, dtype=torch.long)])
+
+    x = torch.cat([torch.ones(num_vars), -torch.ones(num_clauses), torch.zeros(1)]).view(-1, 1)
+    return Data(x=x, edge_index=torch.cat([torch.stack([src, dst]), torch.stack([dst, src])], dim=1),
+                edge_attr=torch.cat([edge_attr, edge_attr]).float(), n2v=torch.arange(1, num_vars + 1, dtype=torch.int32))
+
+
+def call_before(deadline, fn, *args):
+    """
+    fn(*args) in a thread abandoned at deadline (a time.perf_counter() value):
+    its result, or None if it is not done by then.
+    """
+    results = []
+    errors = []
+
+    def run():
+        try:
+            results.append(fn(*args))
+        except Exception as e:
+            errors.append(e)
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    worker.join(timeout=max(deadline - time.perf_counter(), 0))
+    if errors:
+        raise errors[0]
+    return results[0] if results else None
+
+
+class LatencyModel:
+    """
+    Expected milliseconds of one forward of every model variant, linear in the
+    nodes and edges of the (batched) graph: a + b * nodes + c * edges, fitted
+    on timed forwards by calibrate().
+    """
+    def __init__(self, coefficients=None):
+        self.coefficients = coefficients or {}
+
+    def cost(self, variant, num_nodes, num_edges):
+        a, b, c = self.coefficients[variant]
+        return a + b * num_nodes + c * num_edges
+
+    def estimate(self, variant, graphs, max_nodes):
+        # milliseconds of predicting graphs in the batches of predict.coalesce
+        return sum(self.cost(variant, sum(data.num_nodes for _, data in group), sum(data.num_edges for _, data in group))
+                   for group in coalesce(enumerate(graphs), max_nodes=max_nodes))
+
+    @staticmethod
+    def calibrate(variants, sizes=CALIBRATION_SIZES, repeats=3):
+        coefficients = {}
+        graphs = [synthetic_graph(num_nodes, num_edges, seed=i) for i, (num_nodes, num_edges) in enumerate(sizes)]
+        for variant, predictor in variants.items():
+            rows, times = [], []
+            for data in graphs:
+                predictor.predict(data)
+                elapsed = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    predictor.predict(data)
+                    elapsed.append((time.perf_counter() - start) * 1000)
+                rows.append([1.0, data.num_nodes, data.num_edges])
+                times.append(np.median(elapsed))
+
+            # non-negative fit of the relative error, small graphs matter as much as large ones
+            rows, times = np.array(rows), np.array(times)
+            coef, _ = nnls(rows / times[:, None], np.ones_like(times))
+            coefficients[variant] = [float(value) for value in coef]
+        return LatencyModel(coefficients)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.coefficients, f, indent=2)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return LatencyModel(json.load(f))
+
+
+def load_or_calibrate(variants, latency_dir=LATENCY_DIR):
+    # the cost model of the variants of a predictor on this host, calibrated on first use
+    path = os.path.join(latency_dir, f"{variants['full'].model_key}-{'cuda' if variants['full'].is_cuda else 'cpu'}.json")
+    if os.path.isfile(path):
+        latency = LatencyModel.load(path)
+        if all(variant in latency.coefficients for variant in variants):
+            return latency
+
+    os.makedirs(latency_dir, exist_ok=True)
+    latency = LatencyModel.calibrate(variants)
+    latency.save(path)
+    return latency
+
+
+class DeadlinePredictor:
+    """
+    Predicts the components of a formula within a time budget. plan() picks the
+    most accurate variant (full model, distilled student, without decode
+    blocks) whose expected time fits, otherwise only the largest components
+    that fit with the cheapest variant. predict() then returns by the deadline
+    whatever happens: batches not expected to finish in the time left are not
+    started, those still running at the deadline are dropped.
+    """
+    def __init__(self, predictor, latency=None, student_path=STUDENT_MODEL_PATH, safety=SAFETY):
+        self.variants = variant_predictors(predictor, student_path)
+        self.latency = latency or load_or_calibrate(self.variants)
+        self.max_nodes = batch_nodes(predictor.is_cuda)
+        self.safety = safety
+
+    def plan(self, graphs, budget_ms):
+        # variant, indices of the components to predict and their expected milliseconds
+        budget_ms *= self.safety
+
+        # components of the cheap tiers of tiered.py are always predicted, only the others are priced
+        tiny = [i for i, data in enumerate(graphs) if self.variants["full"].tier(data) != "gnn"]
+        model = [i for i, data in enumerate(graphs) if self.variants["full"].tier(data) == "gnn"]
+
+        estimates = {variant: self.latency.estimate(variant, [graphs[i] for i in model], self.max_nodes)
+                     for variant in self.variants}
+        for variant in VARIANTS:
+            if variant in estimates and estimates[variant] <= budget_ms:
+                return variant, list(range(len(graphs))), estimates[variant]
+
+        # each component priced alone, so a partial plan is never optimistic about batching
+        cheapest = min(estimates, key=estimates.get)
+        chosen, expected = tiny, 0.0
+        for i in sorted(model, key=lambda i: -graphs[i].num_nodes):
+            cost = self.latency.cost(cheapest, graphs[i].num_nodes, graphs[i].num_edges)
+            if expected + cost <= budget_ms:
+                chosen.append(i)
+                expected += cost
+        return cheapest, sorted(chosen), expected
+
+    def predict(self, graphs, deadline):
+        """
+        Variables and scores of the components predicted before deadline (a
+        time.perf_counter() value), and the record of the plan. Components left
+        out have no scores, the solver keeps its default phases for them.
+        """
+        start = time.perf_counter()
+        budget_ms = (deadline - start) * 1000
+        variant, chosen, expected = self.plan(graphs, budget_ms)
+        predictor = self.variants[variant]
+
+        results = {}
+        errors = []
+        stop = threading.Event()
+
+        def run():
+            try:
+                # smallest first, if the estimate is off the components lost are the last, largest ones
+                order = sorted(chosen, key=lambda i: graphs[i].num_nodes)
+                for group in coalesce(((i, graphs[i]) for i in order), max_nodes=self.max_nodes):
+                    # a batch is only started if its model graphs are expected to finish before the deadline
+                    model_graphs = [data for _, data in group if predictor.tier(data) == "gnn"]
+                    cost = self.latency.cost(variant, sum(data.num_nodes for data in model_graphs),
+                                             sum(data.num_edges for data in model_graphs)) if model_graphs else 0.0
+                    if stop.is_set() or cost > (deadline - time.perf_counter()) * 1000:
+                        return
+                    for (i, _), pred in zip(group, predictor.predict_batch([data for _, data in group])):
+                        results[i] = pred
+            except Exception as e:
+                errors.append(e)
+
+        # a thread that is abandoned at the deadline, it never starts a batch after it
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        worker.join(timeout=max(deadline - time.perf_counter(), 0))
+        stop.set()
+        if errors:
+            raise errors[0]
+
+        done = sorted(dict(results))
+        if len(done) > 0:
+            variables = torch.cat([graphs[i].n2v.view(-1).long().cpu() for i in done])
+            scores = torch.cat([results[i] for i in done])
+        else:
+            variables, scores = torch.zeros(0, dtype=torch.long), torch.zeros(0)
+
+        if len(chosen) == 0:
+            plan = "none"
+        elif len(chosen) == len(graphs):
+            plan = variant
+        else:
+            plan = f"partial-{variant}"
+
+        record = {
+            "plan": plan,
+            "components": len(graphs),
+            "planned": len(chosen),
+            "predicted": len(done),
+            "budget_ms": budget_ms,
+            "expected_ms": expected,
+            "elapsed_ms": (time.perf_counter() - start) * 1000,
+        }
+        return variables, scores, record
+
+
+# deadline predictors are kept per process, like predictors
+_deadline_predictors = {}
+
+def get_deadline_predictor(predictor):
+    if predictor.model_key not in _deadline_predictors:
+        _deadline_predictors[predictor.model_key] = DeadlinePredictor(predictor)
+    return _deadline_predictors[predictor.model_key]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="calibrate the latency cost model of the deadline-aware predictor")
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--precision', type=str, default=PRECISION)
+    parser.add_argument('--student_path', type=str, default=STUDENT_MODEL_PATH)
+    parser.add_argument('--latency_dir', type=str, default=LATENCY_DIR)
+    args = parser.parse_args()
+
+    predictor = get_predictor(is_cuda=args.cuda, precision=args.precision, memory_budget=None if args.cuda else MEMORY_BUDGET)
+    variants = variant_predictors(predictor, args.student_path)
+    latency = LatencyModel.calibrate(variants)
+
+    os.makedirs(args.latency_dir, exist_ok=True)
+    path = os.path.join(args.latency_dir, f"{predictor.model_key}-{'cuda' if args.cuda else 'cpu'}.json")
+    latency.save(path)
+
+    for variant, (a, b, c) in latency.coefficients.items():
+        print(f"{variant}: {a:.3f} ms + {b * 1000:.4f} ms/1k nodes + {c * 1000:.4f} ms/1k edges")
+    print(f"saved to {path}")
@@ -0,0 +1,203 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import texttable as tt
+from torch.nn import BCELoss
+from torch_geometric.loader import DataLoader
+from sklearn.metrics import f1_score
+from tqdm import tqdm
+
+from data import MyOwnDataset
+from gt_model import GTModel, load_gt_model
+
+
+def variable_scores(model, data):
+    # scores of the variable nodes, aligned with data.y also in batches
+    # (variables come first in every graph and have x = 1)
+    pred = model(data.x, data.edge_index, data.edge_attr)
+    return pred[data.x.view(-1) == 1].view(-1)
+
+
+def soft_bce(student, teacher, temperature):
+    # BCE between the temperature-softened scores, scaled by T^2 to keep the gradient magnitude
+    if temperature == 1:
+        return BCELoss()(student, teacher)
+
+    student = torch.sigmoid(torch.logit(student, eps=1e-6) / temperature)
+    teacher = torch.sigmoid(torch.logit(teacher, eps=1e-6) / temperature)
+    return BCELoss()(student, teacher) * temperature ** 2
+
+
+def train(student, teacher, optimizer, loader, device, alpha, temperature, log_file):
+    student.train()
+    total_loss = 0
+    total_var_cnt = 0
+
+    for data in tqdm(loader):
+        if data.y is None:
+            continue
+
+        try:
+            data = data.to(device)
+            with torch.no_grad():
+                teacher_score = variable_scores(teacher, data)
+
+            y = data.y
+            y01_mask = y != 2
+            y01 = y[y01_mask].float()
+
+            u0 = torch.sum((y01 == 0).int())
+            u1 = torch.sum((y01 == 1).int())
+            u01 = u0 + u1
+            weight = torch.zeros_like(y01)
+            weight[y01 == 0] = u01 / (2 * (u0 + 1))
+            weight[y01 == 1] = u01 / (2 * (u1 + 1))
+
+            optimizer.zero_grad(set_to_none=True)
+
+            score = variable_scores(student, data)
+            hard_loss = BCELoss(weight=weight)(score[y01_mask], y01) if u01 > 0 else 0
+            # the teacher also scores the variables without a backbone label
+            soft_loss = soft_bce(score, teacher_score, temperature)
+            loss = alpha * hard_loss + (1 - alpha) * soft_loss
+
+            loss.backward()
+            nn.utils.clip_grad_norm_(student.parameters(), max_norm=1.0)
+            optimizer.step()
+        except Exception as e:
+            if "CUDA out of memory" in str(e):
+                continue
+            else:
+                raise e
+
+        total_loss += loss.item() * y.shape[0]
+        total_var_cnt += y.shape[0]
+
+    train_loss = total_loss / max(total_var_cnt, 1)
+    log_file.write(f"train_loss={train_loss}\n")
+    return train_loss
+
+
+def evaluate(model, loader, device):
+    model.eval()
+    all_target = []
+    all_pred_class = []
+
+    with torch.no_grad():
+        for data in loader:
+            data = data.to(device)
+            score = variable_scores(model, data)
+
+            y01_mask = data.y != 2
+            all_target += data.y[y01_mask].cpu().numpy().tolist()
+            all_pred_class += (score[y01_mask] >= 0.5).int().cpu().numpy().tolist()
+
+    return f1_score(all_target, all_pred_class, average='micro'), np.array(all_pred_class)
+
+
+def cpu_latency(model, dataset, max_graphs):
+    # per-graph CPU inference time, over graphs sampled evenly in the size range
+    model = model.cpu().eval()
+    step = max(1, len(dataset) // max_graphs)
+
+    times = []
+    with torch.no_grad():
+        for idx in range(0, len(dataset), step):
+            data = dataset[idx]
+            start = time.perf_counter()
+            model(data.x, data.edge_index, data.edge_attr)
+            times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="distill a GTModel checkpoint into a smaller student GTModel")
+    parser.add_argument('--teacher_path', type=str, default="./best_model/pretrain-best2.ptg")
+    parser.add_argument('--dataset_path', type=str, default="./data/pt/pretrain")
+    parser.add_argument('--vld_dataset_path', type=str, default="./data/pt/validation")
+    parser.add_argument('--model_dir', type=str, default="./models/distill")
+    parser.add_argument('--log_dir', type=str, default="./log/distill")
+    # student architecture
+    parser.add_argument('--rb_num', type=int, default=2)
+    parser.add_argument('--decode_num', type=int, default=0)
+    parser.add_argument('--out_channels', type=int, default=32)
+    parser.add_argument('--head_cnt', type=int, default=4)
+    # weight of the backbone label loss, 1 - alpha for the teacher score loss
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--epoch_num', type=int, default=40)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--latency_graphs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=77)
+    args = parser.parse_args()
+
+    os.makedirs(args.model_dir, exist_ok=True)
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    dataset_train = MyOwnDataset(root=args.dataset_path)
+    dataset_vld = MyOwnDataset(root=args.vld_dataset_path)
+    train_loader = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, num_workers=4)
+    vld_loader = DataLoader(dataset_vld, batch_size=args.batch_size, shuffle=False, num_workers=2)
+
+    teacher = load_gt_model(args.teacher_path).to(device).eval()
+
+    model_config = {"rb_num": args.rb_num, "decode_num": args.decode_num,
+                    "out_channels": args.out_channels, "head_cnt": args.head_cnt}
+    student = GTModel(**model_config).to(device)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr)
+
+    teacher_f1, teacher_pred = evaluate(teacher, vld_loader, device)
+    print(f"teacher validation f1: {teacher_f1:.4f}")
+
+    best_f1 = 0
+    for epoch in range(args.epoch_num):
+        print(f"epoch {epoch}")
+        with open(f"{args.log_dir}/distill-{epoch}.log", "w") as log_file:
+            log_file.write(str(time.asctime(time.localtime(time.time()))) + "\n")
+            train(student, teacher, optimizer, train_loader, device, args.alpha, args.temperature, log_file)
+
+            f1, _ = evaluate(student, vld_loader, device)
+            log_file.write("validation_f1=%.4f\n" % f1)
+            log_file.write("teacher_validation_f1=%.4f\n" % teacher_f1)
+            print(f"student validation f1: {f1:.4f} (teacher {teacher_f1:.4f})")
+
+        # model_config lets predict.py and export.py rebuild the student (gt_model.load_gt_model)
+        checkpoint = {
+            'model_state_dict': student.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'model_config': model_config,
+            'teacher_path': args.teacher_path,
+            'epoch': epoch,
+            'f1': f1,
+        }
+        torch.save(checkpoint, f"{args.model_dir}/distill-{epoch}.ptg")
+        if f1 > best_f1:
+            best_f1 = f1
+            torch.save(checkpoint, f"{args.model_dir}/distill-best.ptg")
+
+    # student vs teacher report, with the best student
+    student = load_gt_model(f"{args.model_dir}/distill-best.ptg").to(device)
+    student_f1, student_pred = evaluate(student, vld_loader, device)
+
+    teacher_times = cpu_latency(teacher, dataset_vld, args.latency_graphs)
+    student_times = cpu_latency(student, dataset_vld, args.latency_graphs)
+
+    table = tt.Texttable()
+    table.header(["model", "parameters", "f1", "agreement", "median cpu latency (ms)", "total cpu time (s)", "speedup"])
+    for name, model, f1, pred, times in [("teacher", teacher, teacher_f1, teacher_pred, teacher_times),
+                                         ("student", student, student_f1, student_pred, student_times)]:
+        table.add_row([name, sum(p.numel() for p in model.parameters()), f1, float(np.mean(pred == teacher_pred)),
+                       np.median(times) * 1000, times.sum(), teacher_times.sum() / times.sum()])
+    table.set_precision(4)
+    print(table.draw())
+
+    with open(f"{args.log_dir}/distill-report.log", "w") as log_file:
+        log_file.write(table.draw() + "\n")
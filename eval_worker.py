@@ -0,0 +1,132 @@
+import argparse
+import os
+import re
+import shutil
+import time
+
+import torch
+from torch_geometric.loader import DataLoader
+from tqdm import tqdm
+
+from data import MyOwnDataset
+from gt_model import load_gt_model
+from learn import class_weight_crit
+from metrics import ConfusionMeter
+
+
+def evaluate(model, loader, device):
+    # full validation set metrics, same as learn.evaluate
+    model = model.to(device).eval()
+    meter = ConfusionMeter(device=device)
+
+    with torch.no_grad():
+        for data in tqdm(loader):
+            try:
+                data = data.to(device)
+                pred = model(data.x, data.edge_index, data.edge_attr)
+            except Exception as e:
+                # if cuda out of memory, use CPU to do model inference
+                if "CUDA out of memory" in str(e):
+                    data = data.cpu()
+                    pred = model.cpu()(data.x, data.edge_index, data.edge_attr)
+                    model = model.to(device)
+                else:
+                    raise e
+
+            y01_indices = (data.y != 2).nonzero(as_tuple=True)
+            y01 = data.y[y01_indices].float()
+            pred = pred[y01_indices]
+            loss = class_weight_crit(y01)(pred, y01.view(-1, 1))
+            meter.update(y01, (pred >= 0.5).int().flatten(), loss, y01.shape[0])
+
+    return meter
+
+
+def epoch_checkpoints(model_dir, mode):
+    # per-epoch checkpoints written by learn.py, by epoch
+    pattern = re.compile(rf"^{mode}-(\d+)\.ptg$")
+    checkpoints = {}
+    for fn in os.listdir(model_dir):
+        match = pattern.match(fn)
+        if match:
+            checkpoints[int(match.group(1))] = os.path.join(model_dir, fn)
+    return checkpoints
+
+
+def read_summary(summary_path):
+    # epochs already evaluated and their f1, so a restarted worker continues
+    done = {}
+    if os.path.isfile(summary_path):
+        with open(summary_path) as f:
+            for line in f:
+                fields = dict(field.split("=") for field in line.split())
+                done[int(fields["epoch"])] = float(fields["f1"])
+    return done
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="evaluate the epoch checkpoints of learn.py on the full validation set")
+    parser.add_argument('--mode', type=str, default="pretrain", choices=["pretrain", "finetune"])
+    parser.add_argument('--model_dir', type=str, default="./models/pretrain")
+    parser.add_argument('--log_dir', type=str, default="./log/pretrain")
+    parser.add_argument('--dataset_path', type=str, default="./data/pt/validation")
+    parser.add_argument('--batch_size', type=int, default=100)
+    # CPU by default, learn.py runs this worker next to the training on the GPU
+    parser.add_argument('--device', type=str, default="cpu")
+    # copy the checkpoint with the best full validation f1 here
+    parser.add_argument('--promote_path', type=str, default=None)
+    # keep watching for new checkpoints while this process (the training) runs
+    parser.add_argument('--parent_pid', type=int, default=None)
+    parser.add_argument('--poll', type=float, default=30)
+    args = parser.parse_args()
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    summary_path = f"{args.log_dir}/full-eval.log"
+
+    dataset_vld = MyOwnDataset(root=args.dataset_path)
+    vld_loader = DataLoader(dataset_vld, batch_size=args.batch_size, shuffle=False, num_workers=2)
+
+    done = read_summary(summary_path)
+    best_f1 = max(done.values(), default=0)
+
+    while True:
+        # checked before listing, so the last checkpoints of a finished run are still evaluated
+        training = args.parent_pid is not None and process_alive(args.parent_pid)
+        pending = sorted((epoch, path) for epoch, path in epoch_checkpoints(args.model_dir, args.mode).items() if epoch not in done)
+
+        for epoch, path in pending:
+            meter = evaluate(load_gt_model(path), vld_loader, args.device)
+            loss = meter.loss()
+            precision, recall, f1 = meter.scores(average='micro')
+
+            with open(f"{args.log_dir}/full-{epoch}.log", "w") as log_file:
+                log_file.write(str(time.asctime(time.localtime(time.time()))) + "\n")
+                log_file.write(f"checkpoint: {path}\n")
+                log_file.write("confusion_matrix_on_validation_set\n")
+                log_file.write(str(meter.confusion_matrix()) + "\n")
+                log_file.write("validation_loss=%.4f\n" % loss)
+                log_file.write("validation_precision=%.4f\n" % precision)
+                log_file.write("validation_recall=%.4f\n" % recall)
+                log_file.write("validation_f1=%.4f\n" % f1)
+
+            if args.promote_path is not None and f1 > best_f1:
+                shutil.copyfile(path, args.promote_path + ".tmp")
+                os.replace(args.promote_path + ".tmp", args.promote_path)
+                print(f"full validation f1 {f1:.4f} at epoch {epoch}, promoted to {args.promote_path}")
+            best_f1 = max(best_f1, f1)
+
+            with open(summary_path, "a") as f:
+                f.write(f"epoch={epoch} loss={loss:.4f} f1={f1:.4f}\n")
+            done[epoch] = f1
+
+        if not training:
+            break
+        time.sleep(args.poll)
@@ -0,0 +1,263 @@
+import argparse
+import copy
+import hashlib
+import os
+import warnings
+
+import torch
+from tqdm import tqdm
+
+from gt_model import SimpleRGATConv, load_gt_model
+
+# compiled GTModel artifacts are cached on disk under
+#   <cache_dir>/<checkpoint hash>/<device>/gt_n<nodes>_e<edges>_r<relations>.pt
+# so that later predictor processes start warm
+COMPILED_CACHE_DIR = "./cache/compiled"
+
+# ONNX exports live under <onnx_dir>/<checkpoint hash>/gt_r<relations>.onnx,
+# node and edge counts are dynamic axes so only the relation mask is fixed
+ONNX_DIR = "./cache/onnx"
+ONNX_OPSET = 18
+
+MIN_NODE_BUCKET = 64
+MIN_EDGE_BUCKET = 256
+
+# edge_attr value of each relation of GTBlock (edge_type = edge_attr + 1)
+RELATION_ATTRS = [-1, 0, 1]
+
+
+def checkpoint_hash(checkpoint_path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(checkpoint_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+def bucket_size(n, min_size):
+    size = min_size
+    while size < n:
+        size *= 2
+    return size
+
+
+def relation_mask(edge_attr):
+    mask = 0
+    for bit, attr in enumerate(RELATION_ATTRS):
+        if bool((edge_attr == attr).any()):
+            mask |= 1 << bit
+    return mask
+
+
+def graph_bucket(x, edge_attr):
+    # one extra node and one extra edge per relation are always needed for padding
+    n_bucket = bucket_size(x.size(0) + 1, MIN_NODE_BUCKET)
+    e_bucket = bucket_size(edge_attr.size(0) + len(RELATION_ATTRS), MIN_EDGE_BUCKET)
+    return n_bucket, e_bucket, relation_mask(edge_attr)
+
+
+def pad_graph(x, edge_index, edge_attr, bucket):
+    """
+    Pad a graph to the node/edge counts of its bucket.
+
+    Padding nodes are isolated from the real graph, padding edges are self loops
+    on the first padding node and only use relations present in the real graph,
+    so RGINConv takes exactly the same relation branches and the outputs of the
+    real nodes are unchanged.
+    """
+    n_bucket, e_bucket, rel_mask = bucket
+    n, e = x.size(0), edge_index.size(1)
+
+    rel_attrs = [attr for bit, attr in enumerate(RELATION_ATTRS) if rel_mask & (1 << bit)]
+    if len(rel_attrs) == 0:
+        # GTModel cannot run without edges either, its RGINConv layers keep the input width
+        raise ValueError("a graph without edges has no bucket to pad to")
+
+    x_pad = x.new_zeros((n_bucket - n, x.size(1)))
+    edge_index_pad = edge_index.new_full((2, e_bucket - e), n)
+    edge_attr_pad = torch.tensor(rel_attrs, dtype=edge_attr.dtype, device=edge_attr.device)
+    edge_attr_pad = edge_attr_pad.repeat((e_bucket - e) // len(rel_attrs) + 1)[:e_bucket - e]
+
+    return (torch.cat([x, x_pad], dim=0),
+            torch.cat([edge_index, edge_index_pad], dim=1),
+            torch.cat([edge_attr, edge_attr_pad.view(-1, *edge_attr.shape[1:])], dim=0))
+
+
+def example_graph(bucket, device="cpu"):
+    # smallest graph that falls into the bucket, used as the tracing example
+    n_bucket, e_bucket, rel_mask = bucket
+    rel_attrs = [attr for bit, attr in enumerate(RELATION_ATTRS) if rel_mask & (1 << bit)]
+
+    x = torch.ones((1, 1), device=device)
+    edge_index = torch.zeros((2, len(rel_attrs)), dtype=torch.long, device=device)
+    edge_attr = torch.tensor(rel_attrs, dtype=torch.float, device=device).view(-1, 1)
+    return pad_graph(x, edge_index, edge_attr, bucket)
+
+
+def compile_gt_model(model, bucket):
+    model.eval()
+    x, edge_index, edge_attr = example_graph(bucket, device=next(model.parameters()).device)
+
+    with torch.no_grad(), warnings.catch_warnings():
+        # RGINConv's relation loop is data dependent, the bucket fixes which branches are taken
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        traced = torch.jit.trace(model, (x, edge_index, edge_attr), check_trace=False)
+    return torch.jit.freeze(traced)
+
+
+class CompiledGTModel:
+    """
+    Drop-in replacement of GTModel.forward for inference, backed by TorchScript
+    artifacts traced per (node bucket, edge bucket, relation mask).
+    """
+    def __init__(self, checkpoint_path, cache_dir=COMPILED_CACHE_DIR, device="cpu"):
+        self.checkpoint_path = checkpoint_path
+        self.device = device
+
+        # traces are specialized to the device they were made on
+        self.cache_dir = os.path.join(cache_dir, checkpoint_hash(checkpoint_path), torch.device(device).type)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self._model = None
+        self._compiled = {}
+
+    def _eager_model(self):
+        if self._model is None:
+            self._model = load_gt_model(self.checkpoint_path).to(self.device)
+            self._model.eval()
+        return self._model
+
+    def artifact_path(self, bucket):
+        n_bucket, e_bucket, rel_mask = bucket
+        return os.path.join(self.cache_dir, f"gt_n{n_bucket}_e{e_bucket}_r{rel_mask}.pt")
+
+    def get(self, bucket):
+        if bucket in self._compiled:
+            return self._compiled[bucket]
+
+        path = self.artifact_path(bucket)
+        if os.path.isfile(path):
+            compiled = torch.jit.load(path, map_location=self.device)
+        else:
+            compiled = compile_gt_model(self._eager_model(), bucket)
+            # write to a temporary file first, concurrent predictors may compile the same bucket
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.jit.save(compiled, tmp_path)
+            os.replace(tmp_path, path)
+
+        self._compiled[bucket] = compiled
+        return compiled
+
+    def warmup(self, buckets):
+        for bucket in buckets:
+            self.get(bucket)
+
+    def __call__(self, x, edge_index, edge_attr):
+        bucket = graph_bucket(x, edge_attr)
+        x_pad, edge_index_pad, edge_attr_pad = pad_graph(x, edge_index, edge_attr, bucket)
+
+        with torch.no_grad():
+            pred = self.get(bucket)(x_pad, edge_index_pad, edge_attr_pad)
+        return pred[:x.size(0)]
+
+
+def onnx_model_dir(checkpoint_path, onnx_dir=ONNX_DIR):
+    return os.path.join(onnx_dir, checkpoint_hash(checkpoint_path))
+
+
+class MaskedRGATConv(torch.nn.Module):
+    """
+    SimpleRGATConv for the graphs of one relation mask. GATv2Conv on an empty
+    edge set only returns its bias, so the branch of a missing relation is
+    replaced by the bias and the export never traces GATv2Conv on no edges.
+    """
+    def __init__(self, conv, rel_mask):
+        super(MaskedRGATConv, self).__init__()
+        self.gat_convs = torch.nn.ModuleList([conv.gat_conv1, conv.gat_conv2, conv.gat_conv3])
+        self.rel_mask = rel_mask
+
+    def forward(self, x, edge_index, edge_type):
+        out = 0
+        for rel, gat_conv in enumerate(self.gat_convs):
+            if self.rel_mask & (1 << rel):
+                out = out + gat_conv(x, edge_index[:, edge_type == rel])
+            else:
+                out = out + gat_conv.bias
+        return out
+
+
+def masked_model(model, rel_mask):
+    # copy of model whose SimpleRGATConv layers only run the relations of rel_mask
+    model = copy.deepcopy(model)
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, SimpleRGATConv):
+                setattr(module, name, MaskedRGATConv(child, rel_mask))
+    return model
+
+
+def export_onnx(model, path, rel_mask, opset=ONNX_OPSET):
+    model = masked_model(model.cpu(), rel_mask)
+    model.eval()
+    # the example only has to take the right relation branches, its size is irrelevant
+    x, edge_index, edge_attr = example_graph((MIN_NODE_BUCKET, MIN_EDGE_BUCKET, rel_mask))
+    x, edge_index, edge_attr = x.cpu(), edge_index.cpu(), edge_attr.cpu()
+
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.onnx.export(model, (x, edge_index, edge_attr), tmp_path,
+                          input_names=["x", "edge_index", "edge_attr"],
+                          output_names=["pred"],
+                          dynamic_axes={"x": {0: "num_nodes"},
+                                        "edge_index": {1: "num_edges"},
+                                        "edge_attr": {0: "num_edges"},
+                                        "pred": {0: "num_nodes"}},
+                          opset_version=opset,
+                          dynamo=False)
+        os.replace(tmp_path, path)
+
+
+def export_onnx_checkpoint(checkpoint_path, onnx_dir=ONNX_DIR):
+    # one export per relation mask, so every graph finds a model whose RGINConv branches match
+    model_dir = onnx_model_dir(checkpoint_path, onnx_dir)
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+
+    model = load_gt_model(checkpoint_path)
+
+    for rel_mask in range(1, 1 << len(RELATION_ATTRS)):
+        path = os.path.join(model_dir, f"gt_r{rel_mask}.onnx")
+        if os.path.isfile(path):
+            continue
+        export_onnx(model, path, rel_mask)
+    return model_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compile a GTModel checkpoint for every shape bucket of a dataset")
+    parser.add_argument('--model_path', type=str, default="./best_model/pretrain-best2.ptg")
+    parser.add_argument('--pt_dir_path', type=str, default="./data/pt/test/processed")
+    parser.add_argument('--cache_dir', type=str, default=COMPILED_CACHE_DIR)
+    parser.add_argument('--cuda', action='store_true', help="compile the artifacts of the GPU predictors")
+    parser.add_argument('--onnx', action="store_true", help="export to ONNX instead of TorchScript")
+    parser.add_argument('--onnx_dir', type=str, default=ONNX_DIR)
+    args = parser.parse_args()
+
+    if args.onnx:
+        model_dir = export_onnx_checkpoint(args.model_path, args.onnx_dir)
+        print(f"ONNX models exported into {model_dir}")
+        exit(0)
+
+    compiled_model = CompiledGTModel(args.model_path, cache_dir=args.cache_dir, device="cuda" if args.cuda else "cpu")
+
+    buckets = set()
+    for pt_file in tqdm(os.listdir(args.pt_dir_path), desc="bucketing"):
+        data = torch.load(os.path.join(args.pt_dir_path, pt_file), weights_only=False)
+        buckets.add(graph_bucket(data.x, data.edge_attr))
+
+    for bucket in tqdm(sorted(buckets), desc="compiling"):
+        compiled_model.get(bucket)
+
+    print(f"{len(buckets)} buckets compiled into {compiled_model.cache_dir}")
@@ -173,13 +173,11 @@ class GTBlock(torch.nn.Module):
 
 
 class GTModel(torch.nn.Module):
-    def __init__(self, rb_num, decode_num):
+    def __init__(self, rb_num, decode_num, out_channels=48, head_cnt=8):
         super(GTModel, self).__init__()
         assert(rb_num > 0)
 
         dropout = 0.2
-        out_channels = 48
-        head_cnt = 8
 
         assert(out_channels % head_cnt == 0)
 
@@ -218,9 +216,26 @@ class GTModel(torch.nn.Module):
             for i in range(0, len(self.decode)):
                 x = self.decode[i](x, edge_index, edge_attr)
 
+        return self.head(x)
+
+    def head(self, x):
         x = self.mlp1(x)
         x = F.gelu(x)
         x = self.mlp2(x)
         x = F.gelu(x)
         x = self.mlp3(x)
-        return F.sigmoid(x)
\ No newline at end of file
+        return F.sigmoid(x)
+
+
+# architecture of the checkpoints that do not store a model_config (GTModel(3, 3))
+DEFAULT_MODEL_CONFIG = {"rb_num": 3, "decode_num": 3, "out_channels": 48, "head_cnt": 8}
+
+
+def load_gt_model(checkpoint_path, map_location="cpu"):
+    # builds the GTModel described by the checkpoint's model_config and loads its weights
+    checkpoint = torch.load(checkpoint_path, map_location=map_location, weights_only=False)
+    model_config = dict(DEFAULT_MODEL_CONFIG, **checkpoint.get("model_config", {}))
+
+    model = GTModel(**model_config)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    return model
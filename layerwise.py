@@ -0,0 +1,261 @@
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+from gt_model import GTModel
+
+# default peak memory budget of layer-wise inference, in bytes
+DEFAULT_MEMORY_BUDGET = 4 << 30
+
+# rough number of float32 (nodes + edges) x channels buffers alive during a
+# full-graph GTModel forward (messages, MLP hidden states, attention logits)
+FULL_GRAPH_BUFFERS = 12
+
+
+def full_graph_bytes(num_nodes, num_edges, channels=48):
+    return FULL_GRAPH_BUFFERS * (num_nodes + num_edges) * channels * 4
+
+
+class Workspace:
+    """
+    Allocates the node activations and the relation-partitioned edge lists,
+    either in RAM or, when spilling, as memory-mapped files in a temporary directory.
+    """
+    def __init__(self, spill, spill_dir=None):
+        self.spill = spill
+        self.tmp_dir = tempfile.mkdtemp(prefix="layerwise-", dir=spill_dir) if spill else None
+        self._cnt = 0
+
+    def array(self, shape, dtype=np.float32):
+        if not self.spill:
+            return np.empty(shape, dtype=dtype)
+
+        self._cnt += 1
+        return np.lib.format.open_memmap(f"{self.tmp_dir}/a{self._cnt}.npy", mode="w+", dtype=dtype, shape=shape)
+
+    def close(self):
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+
+class RelationEdges:
+    """
+    Edges of every relation sorted by target node (CSR), so that the incoming
+    edges of a node chunk are a contiguous slice.
+    """
+    def __init__(self, edge_index, edge_type, num_nodes, num_relations, workspace):
+        self.num_nodes = num_nodes
+        self.src = []
+        self.dst = []
+        self.indptr = []
+
+        index_dtype = np.int32 if num_nodes < 2 ** 31 else np.int64
+        for rel in range(num_relations):
+            mask = edge_type == rel
+            src, dst = edge_index[0][mask], edge_index[1][mask]
+            order = np.argsort(dst, kind="stable")
+
+            src_sorted = workspace.array((len(order),), index_dtype)
+            dst_sorted = workspace.array((len(order),), index_dtype)
+            src_sorted[:] = src[order]
+            dst_sorted[:] = dst[order]
+            del src, dst, order
+
+            indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+            np.cumsum(np.bincount(dst_sorted, minlength=num_nodes), out=indptr[1:])
+
+            self.src.append(src_sorted)
+            self.dst.append(dst_sorted)
+            self.indptr.append(indptr)
+
+    def count(self, rel):
+        return len(self.src[rel])
+
+    def in_degree_cumsum(self):
+        return sum(self.indptr)
+
+    def sub_chunks(self, rel, lo, hi, edge_chunk):
+        # incoming edges of the target nodes [lo, hi), at most edge_chunk at a time
+        start, end = self.indptr[rel][lo], self.indptr[rel][hi]
+        for a in range(start, end, edge_chunk):
+            b = min(a + edge_chunk, end)
+            src = torch.from_numpy(np.asarray(self.src[rel][a:b], dtype=np.int64))
+            dst = torch.from_numpy(np.asarray(self.dst[rel][a:b], dtype=np.int64)) - lo
+            yield src, dst
+
+
+class LayerwiseGTModel:
+    """
+    Memory-bounded GTModel inference on CPU.
+
+    Instead of running every block over the whole graph at once, each message
+    passing layer (RGINConv, SimpleRGATConv) is computed for all target nodes in
+    node chunks whose incoming edges fit the memory budget, and each node-wise
+    layer (DTBlock, head) in plain node chunks. Node activations are kept in RAM
+    or spilled to memory-mapped files, so peak memory is set by the budget and
+    not by the graph size. Outputs match the full-graph forward up to float
+    summation order.
+    """
+    def __init__(self, model, memory_budget=DEFAULT_MEMORY_BUDGET, spill_dir=None):
+        assert(isinstance(model, GTModel))
+        self.model = model.cpu().eval()
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+
+        self.channels = self.model.mlp1.in_features
+
+    def __call__(self, x, edge_index, edge_attr):
+        num_nodes, num_edges = x.size(0), edge_index.size(1)
+        c = self.channels
+
+        # half of the budget for the node activations and the edge lists, half for the chunks
+        resident = 3 * num_nodes * c * 4 + 3 * num_edges * 8 + 3 * (num_nodes + 1) * 8
+        workspace = Workspace(spill=resident > self.memory_budget // 2, spill_dir=self.spill_dir)
+
+        # per node: input, normed, output and MLP hidden rows; per edge: gathered rows, messages, hidden
+        self.node_cost = 8 * c * 4
+        self.edge_cost = 8 * c * 4
+        self.chunk_budget = max(self.memory_budget // 2, self.node_cost + self.edge_cost)
+        self.edge_chunk = max(1, self.chunk_budget // (2 * self.edge_cost))
+
+        try:
+            with torch.no_grad():
+                edge_type = (edge_attr + 1).int().flatten().numpy()
+                self.edges = RelationEdges(edge_index.numpy(), edge_type, num_nodes, 3, workspace)
+                self.chunks = self._plan_chunks(num_nodes)
+                self.node_chunks = self._plan_node_chunks(num_nodes)
+
+                h = x.float().numpy()
+                for block in self.model.rb:
+                    h = self._gt_block(block, h, workspace)
+
+                if self.model.decode is not None:
+                    for block in self.model.decode:
+                        out = workspace.array((num_nodes, c))
+                        for lo, hi in self.node_chunks:
+                            out[lo:hi] = block(torch.from_numpy(np.asarray(h[lo:hi])), None, None).numpy()
+                        h = out
+
+                pred = np.empty((num_nodes, 1), dtype=np.float32)
+                for lo, hi in self.node_chunks:
+                    pred[lo:hi] = self.model.head(torch.from_numpy(np.asarray(h[lo:hi]))).numpy()
+        finally:
+            self.edges = None
+            workspace.close()
+
+        return torch.from_numpy(pred)
+
+    def _plan_chunks(self, num_nodes):
+        # contiguous target node ranges whose nodes and incoming edges fit the chunk budget,
+        # a single node with more incoming edges is split further by sub_chunks()
+        cost = np.arange(num_nodes + 1, dtype=np.int64) * self.node_cost + \
+               self.edges.in_degree_cumsum() * self.edge_cost
+        chunks = []
+        lo = 0
+        while lo < num_nodes:
+            hi = int(np.searchsorted(cost, cost[lo] + self.chunk_budget, side="right")) - 1
+            hi = min(max(hi, lo + 1), num_nodes)
+            chunks.append((lo, hi))
+            lo = hi
+        return chunks
+
+    def _plan_node_chunks(self, num_nodes):
+        size = max(1, self.chunk_budget // self.node_cost)
+        return [(lo, min(lo + size, num_nodes)) for lo in range(0, num_nodes, size)]
+
+    def _rows(self, h, index):
+        return torch.from_numpy(np.asarray(h[index.numpy()]))
+
+    def _gt_block(self, block, h, workspace):
+        num_nodes = h.shape[0]
+        if block.in_channels == block.output_channels:
+            out = workspace.array((num_nodes, block.output_channels))
+            self._gat_layer(block, h, out)
+            return out
+
+        # x2 = conv1(norm1(x)), then x_k+1 = x_k + conv_k+1(norm_k+1(x_k))
+        layers = [(block.norm1, block.conv1, False),
+                  (block.conv_norm2, block.conv2, True),
+                  (block.conv_norm3, block.conv3, True),
+                  (block.conv_norm4, block.conv4, True)]
+        for norm, conv, residual in layers:
+            out = workspace.array((num_nodes, conv.out_channels))
+            self._rgin_layer(conv, norm, h, out, residual)
+            h = out
+        return h
+
+    def _rgin_layer(self, conv, norm, h, out, residual):
+        num_nodes = h.shape[0]
+        # RGINConv adds the node's own features once per non-empty relation
+        relations = [rel for rel in range(conv.num_relations) if self.edges.count(rel) > 0]
+        if num_nodes <= 1:
+            relations = []
+
+        for lo, hi in self.chunks:
+            x_chunk = torch.from_numpy(np.asarray(h[lo:hi]))
+            xn = norm(x_chunk)
+
+            if len(relations) == 0:
+                res = xn
+            else:
+                res = torch.zeros((hi - lo, conv.out_channels))
+                for rel in relations:
+                    aggr = torch.zeros((hi - lo, conv.out_channels))
+                    for src, dst in self.edges.sub_chunks(rel, lo, hi, self.edge_chunk):
+                        aggr.index_add_(0, dst, conv.message(norm(self._rows(h, src)), rel))
+                    res = res + conv.update(aggr, xn)
+
+            if residual:
+                res = x_chunk + res
+            out[lo:hi] = res.numpy()
+
+    def _gat_layer(self, block, h, out):
+        gat_convs = [block.mha.gat_conv1, block.mha.gat_conv2, block.mha.gat_conv3]
+
+        for lo, hi in self.chunks:
+            x_chunk = torch.from_numpy(np.asarray(h[lo:hi]))
+            xn = block.norm1(x_chunk)
+
+            res = x_chunk + block.mlp(xn)
+            for rel, gat in enumerate(gat_convs):
+                res = res + self._gat_chunk(gat, block.norm1, h, xn, rel, lo, hi)
+            out[lo:hi] = res.numpy()
+
+    def _gat_logits(self, gat, norm, h, x_r, src, dst):
+        H, C = gat.heads, gat.out_channels
+        x_l = gat.lin_l(norm(self._rows(h, src))).view(-1, H, C)
+        e = torch.nn.functional.leaky_relu(x_l + x_r[dst], gat.negative_slope)
+        return (e * gat.att).sum(dim=-1), x_l
+
+    def _gat_chunk(self, gat, norm, h, xn, rel, lo, hi):
+        # GATv2Conv over the incoming edges of [lo, hi), with the softmax computed
+        # in two passes (max, then sums) so that the edges can come in sub-chunks
+        H, C = gat.heads, gat.out_channels
+        n = hi - lo
+        x_r = gat.lin_r(xn).view(-1, H, C)
+
+        sub_chunks = list(self.edges.sub_chunks(rel, lo, hi, self.edge_chunk))
+
+        src_max = torch.full((n, H), float("-inf"))
+        cached = None
+        for src, dst in sub_chunks:
+            logits, x_l = self._gat_logits(gat, norm, h, x_r, src, dst)
+            src_max.scatter_reduce_(0, dst.view(-1, 1).expand(-1, H), logits, reduce="amax")
+            if len(sub_chunks) == 1:
+                cached = (logits, x_l)
+
+        out_sum = torch.zeros((n, H))
+        out = torch.zeros((n, H, C))
+        for src, dst in sub_chunks:
+            logits, x_l = cached if cached is not None else self._gat_logits(gat, norm, h, x_r, src, dst)
+            w = (logits - src_max[dst]).exp()
+            out_sum.index_add_(0, dst, w)
+            out.index_add_(0, dst, x_l * w.unsqueeze(-1))
+
+        out = (out / (out_sum + 1e-16).unsqueeze(-1)).view(n, H * C)
+        if gat.bias is not None:
+            out = out + gat.bias
+        return out
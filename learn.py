@@ -8,15 +8,19 @@ from torch_geometric.loader import DataLoader
 
 from data import *
 from gt_model import GTModel
+from metrics import ConfusionMeter
+from checkpoint import AsyncCheckpointer, rng_state, set_rng_state
+from partition import DEFAULT_MAX_NODES, split_oversized
+from profiling import StageTimer, stage_line, trace_profiler
 
 from sklearn.utils import class_weight
-from sklearn.metrics import confusion_matrix, recall_score, precision_score, f1_score
 
 import texttable as tt
 
 from tqdm import tqdm
 import time
 import sys
+import subprocess
 import random
 import numpy as np
 from multiprocessing import Pool
@@ -24,73 +28,147 @@ from multiprocessing import Pool
 
 
 # train and evaluate
-def train(log_file):
+def class_weight_crit(y01):
+	# class-balanced BCE weights, computed on the device without a host sync
+	u0 = torch.sum((y01 == 0).int())
+	u1 = torch.sum((y01 == 1).int())
+	u01 = y01.shape[0]
+	weight = torch.where(y01 == 0, u01 / (2 * (u0 + 1)), u01 / (2 * (u1 + 1)))
+	return BCELoss(weight=weight.view(-1, 1))
+
+
+def training_state(epoch, step, meter=None):
+	# everything needed to resume: epoch in progress, batches of it already trained on,
+	# RNG states and the metrics of the partial epoch (the data order follows from the epoch)
+	return {
+		'model_state_dict': model.state_dict(),
+		'optimizer_state_dict': optimizer.state_dict(),
+		'epoch': epoch,
+		'step': step,
+		'best_f1': best_f1,
+		'rng_state': rng_state(),
+		'meter': meter.state_dict() if meter is not None else None,
+	}
+
+
+def optimizer_step(acc_cnt=0):
+	# with accumulation the gradients hold the sum of the per-variable losses
+	# of the window, averaged here so the step minimizes the per-variable mean loss
+	if acc_cnt > 0:
+		for p in model.parameters():
+			if p.grad is not None:
+				p.grad.div_(acc_cnt)
+
+	nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+	optimizer.step()
+	optimizer.zero_grad(set_to_none=True)
+
+
+def train(log_file, epoch, start_step=0, meter_state=None):
 	global model
 	global optimizer
 
 	model.train()
-	total_loss = 0
-	total_var_cnt = 0
-
-	all_target = []
-	all_pred_class = []
-
-	cnt = 0
+	meter = ConfusionMeter(device="cuda")
+	if meter_state is not None:
+		meter.load_state_dict(meter_state)
+
+	sampler_train.set_epoch(epoch, start_step * hyper_params["batch_size"])
+	step = start_step
+	cnt = min(start_step * hyper_params["batch_size"], len(dataset_train))
+
+	# labeled variables per optimizer step, None steps after every batch
+	accum_budget = hyper_params["accum_budget"]
+	acc_cnt = 0
+	last_save = start_step
+	optimizer.zero_grad(set_to_none=True)
+
+	timer = StageTimer("cuda")
+	# the trace covers a window of steps of the first epoch of the run
+	prof = trace_profiler(hyper_params["log_dir"] + "/trace", hyper_params["profile_start"], hyper_params["profile_steps"], "cuda") \
+		if epoch == first_epoch else None
+	if prof is not None:
+		prof.start()
 
 	fit_idx_lst = []
-	with tqdm(total=len(dataset_train)) as pbar:
-		for data in train_loader:
-			if data.y == None:
+	with tqdm(total=len(dataset_train), initial=cnt) as pbar:
+		for batch in timer.iterate(train_loader):
+			step += 1
+			if batch.y == None:
 				log_file.write("no data.y, ignore\n")
 				continue
 
-			loss = None
-			pred = None
-			y01 = None
-
-			try:
-				model = model.cuda()
-				data = data.cuda()
+			timer.step_begin()
+			step_vars = 0
 
-				y01_indices = (data.y != 2).nonzero(as_tuple=True)
-				y01 = data.y[y01_indices].float()
-
-				u0 = torch.sum((y01 == 0).int()).cpu()
-				u1 = torch.sum((y01 == 1).int()).cpu()
-				u01 = u0 + u1
-				assert(u01 == y01.shape[0])
-				weight = torch.zeros(u01).cuda()
-				weight[y01 == 0] = u01 / (2 * (u0 + 1))
-				weight[y01 == 1] = u01 / (2 * (u1 + 1))
-				crit = BCELoss(weight=weight.view(-1, 1))
-				
-				optimizer.zero_grad(set_to_none=True)
-
-				pred = model(data.x, data.edge_index, data.edge_attr)
-				pred = pred[y01_indices]
-
-				loss = crit(pred, y01.view(-1, 1))
-				loss.backward()
-
-				nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-				optimizer.step()
-			except Exception as e:
-				if "CUDA out of memory" in str(e):
-					continue
-				else:
-					raise e
+			# graphs over the node budget are trained on as clusters, whose gradients
+			# add up before one optimizer step, like an accumulation window
+			with timer.stage("partition"):
+				parts = split_oversized(batch, hyper_params["partition_nodes"], hyper_params["halo_hops"])
+			accumulate = accum_budget or len(parts) > 1
 
-			assert(loss != None)
+			for data in parts:
+				loss = None
+				pred = None
+				y01 = None
 
-			pred_class = None
-			with torch.no_grad():
-				pred_class = (pred >= 0.5).int().flatten() # torch.argmax(pred, dim=1)
-			
-			all_target += y01.cpu().numpy().tolist()
-			all_pred_class += pred_class.cpu().numpy().tolist()
+				try:
+					with timer.stage("h2d"):
+						model = model.cuda()
+						data = data.cuda()
 
-			total_loss += loss.item() * y01.shape[0] # data.y.shape[0]
-			total_var_cnt += y01.shape[0] # data.y.shape[0]
+					y01_indices = (data.y != 2).nonzero(as_tuple=True)
+					y01 = data.y[y01_indices].float()
+					if y01.shape[0] == 0:
+						log_file.write("no labeled variable, ignore\n")
+						continue
+					crit = class_weight_crit(y01)
+
+					with timer.stage("forward"):
+						pred = model(data.x, data.edge_index, data.edge_attr)
+						pred = pred[y01_indices]
+
+						loss = crit(pred, y01.view(-1, 1))
+					with timer.stage("backward"):
+						if accumulate:
+							(loss * y01.shape[0]).backward()
+							acc_cnt += y01.shape[0]
+						else:
+							loss.backward()
+					if not accumulate:
+						with timer.stage("optimizer"):
+							optimizer_step()
+				except Exception as e:
+					if "CUDA out of memory" in str(e):
+						# a failed backward may have left partial gradients, which acc_cnt does not
+						# count, so the whole accumulation window is discarded with them
+						optimizer.zero_grad(set_to_none=True)
+						acc_cnt = 0
+						continue
+					else:
+						raise e
+
+				assert(loss != None)
+
+				with torch.no_grad():
+					pred_class = (pred >= 0.5).int().flatten() # torch.argmax(pred, dim=1)
+					meter.update(y01, pred_class, loss, y01.shape[0])
+				step_vars += y01.shape[0]
+
+			if acc_cnt > 0 and (not accum_budget or acc_cnt >= accum_budget):
+				with timer.stage("optimizer"):
+					optimizer_step(acc_cnt)
+				acc_cnt = 0
+
+			timer.step_end(batch.num_graphs, batch.num_nodes, step_vars)
+			if prof is not None:
+				prof.step()
+
+			# accumulated gradients are not checkpointed, so only save between optimizer steps
+			if step - last_save >= hyper_params["save_every"] and acc_cnt == 0:
+				with timer.stage("checkpoint"):
+					checkpointer.save(training_state(epoch, step, meter), hyper_params["resume_path"])
+				last_save = step
 
 			if cnt + hyper_params["batch_size"] <= len(dataset_train):
 				pbar.update(hyper_params["batch_size"])
@@ -99,7 +177,18 @@ def train(log_file):
 				pbar.update(len(dataset_train) - cnt)
 				cnt = len(dataset_train)
 
-	c = confusion_matrix(all_target, all_pred_class, labels=[0, 1])
+	# step on the last, partial window of the epoch
+	if acc_cnt > 0:
+		optimizer_step(acc_cnt)
+
+	if prof is not None:
+		prof.stop()
+
+	# stage times, throughput per graph size and peak memory of the epoch
+	profile = timer.write(hyper_params["log_dir"] + f"/profile-{epoch}.json", epoch=epoch, start_step=start_step)
+	log_file.write("stages: " + stage_line(profile) + "\n")
+
+	c = meter.confusion_matrix()
 	
 	if hyper_params["pretrain"]:
 		log_file.write("confusion_matrix_on_pretraining_set\n")
@@ -108,11 +197,12 @@ def train(log_file):
 
 	log_file.write(str(c) + "\n")
 
-	if total_var_cnt > 0:
-		log_file.write(f"train_loss={total_loss / total_var_cnt}\n")
-		return total_loss / total_var_cnt
+	train_loss = meter.loss()
+	if train_loss is not None:
+		log_file.write(f"train_loss={train_loss}\n")
+		return train_loss
 	else:
-		log_file.write(f"total_var_cnt={total_var_cnt}\n")
+		log_file.write("total_var_cnt=0\n")
 		return None
 
 
@@ -120,11 +210,7 @@ def evaluate(log_file):
 	global model
 	model.eval()
 
-	total_loss = 0
-	total_var_cnt = 0
-
-	all_target = []
-	all_pred_class = []
+	meter = ConfusionMeter(device="cuda")
 
 	with torch.no_grad():
 		for data in tqdm(vld_loader):
@@ -137,17 +223,8 @@ def evaluate(log_file):
 				model = model.cuda()
 				
 				y01_indices = (data.y != 2).nonzero(as_tuple=True)
-
 				y01 = data.y[y01_indices].float()
-
-				u0 = torch.sum((y01 == 0).int()).cpu()
-				u1 = torch.sum((y01 == 1).int()).cpu()
-				u01 = u0 + u1
-				assert(u01 == y01.shape[0])
-				weight = torch.zeros(u01).cuda()
-				weight[y01 == 0] = u01 / (2 * (u0 + 1))
-				weight[y01 == 1] = u01 / (2 * (u1 + 1))
-				crit = BCELoss(weight=weight.view(-1, 1))
+				crit = class_weight_crit(y01)
 
 				pred = model(data.x, data.edge_index, data.edge_attr)
 			except Exception as e:
@@ -159,15 +236,7 @@ def evaluate(log_file):
 					
 					y01_indices = (data.y != 2).nonzero(as_tuple=True)
 					y01 = data.y[y01_indices].float()
-
-					u0 = torch.sum((y01 == 0).int()).cpu()
-					u1 = torch.sum((y01 == 1).int()).cpu()
-					u01 = u0 + u1
-					assert(u01 == y01.shape[0])
-					weight = torch.zeros(u01).cpu()
-					weight[y01 == 0] = u01 / (2 * (u0 + 1))
-					weight[y01 == 1] = u01 / (2 * (u1 + 1))
-					crit = BCELoss(weight=weight.view(-1, 1))
+					crit = class_weight_crit(y01)
 					pred = model(data.x, data.edge_index, data.edge_attr)
 				else:
 					raise e
@@ -175,23 +244,16 @@ def evaluate(log_file):
 			pred = pred[y01_indices] 			
 			loss = crit(pred, y01.view(-1, 1))
 
-			total_loss += y01.shape[0] * loss.item()
-			total_var_cnt += y01.shape[0]
-
 			pred_class = (pred >= 0.5).int().flatten() 
+			meter.update(y01, pred_class, loss, y01.shape[0])
 
-			all_target += y01.cpu().numpy().tolist()
-			all_pred_class += pred_class.cpu().numpy().tolist()
-
-	c = confusion_matrix(all_target, all_pred_class, labels=[0, 1])
+	c = meter.confusion_matrix()
 
 	log_file.write("confusion_matrix_on_validation_set\n")
 	log_file.write(str(c) + "\n")
 
-	loss = total_loss / total_var_cnt
-	precision = precision_score(all_target, all_pred_class, average='micro')
-	recall = recall_score(all_target, all_pred_class, average='micro')
-	f1 = f1_score(all_target, all_pred_class, average='micro')
+	loss = meter.loss()
+	precision, recall, f1 = meter.scores(average='micro')
 	log_file.write("validation_loss=%.4f\n" % loss)
 	log_file.write("validation_precision=%.4f\n" % precision)
 	log_file.write("validation_recall=%.4f\n" % recall)
@@ -212,6 +274,8 @@ if __name__ == "__main__":
         exit(1)
 
     batch_size = 100
+    # mid-epoch checkpoint period, in batches
+    save_every = 1000
 
     if hyper_params["pretrain"]:
         hyper_params["seed"] = 77
@@ -221,6 +285,8 @@ if __name__ == "__main__":
         hyper_params["log_dir"] = "./log/pretrain"
         hyper_params["checkpoint_path"] = None
         hyper_params["dataset_path"] = "./data/pt/pretrain"
+        hyper_params["model_dir"] = "./models/pretrain"
+        hyper_params["accum_budget"] = None
 
     else:
         hyper_params["seed"] = 77
@@ -230,6 +296,34 @@ if __name__ == "__main__":
         hyper_params["log_dir"] = "./log/finetune" 
         hyper_params["checkpoint_path"] = "./models/pretrain/pretrain-best.ptg"
         hyper_params["dataset_path"] = "./data/pt/finetune"
+        hyper_params["model_dir"] = "./models/finetune"
+        # accumulate the gradients of several graphs until this many labeled variables
+        # before an optimizer step (e.g. 50000), None steps after every graph
+        hyper_params["accum_budget"] = None
+
+    # graphs over partition_nodes nodes are split into clusters with a halo of
+    # halo_hops (partition.py) instead of running out of memory, None disables it
+    hyper_params["partition_nodes"] = DEFAULT_MAX_NODES
+    hyper_params["halo_hops"] = 2
+
+    # graphs of the size-stratified validation subsample evaluated after every epoch,
+    # None evaluates the whole validation set
+    hyper_params["vld_subsample"] = 200
+    # evaluate every epoch checkpoint on the whole validation set in a separate
+    # process (eval_worker.py), which promotes the best one to {mode}-best-full.ptg
+    hyper_params["full_eval"] = True
+    # device of that process, the CPU leaves the GPU memory to the training (or e.g. "cuda:1")
+    hyper_params["eval_device"] = "cpu"
+
+    # export a torch.profiler trace of profile_steps steps, from step profile_start
+    # of the first epoch of the run, to log_dir/trace (0 steps: no trace)
+    hyper_params["profile_start"] = 10
+    hyper_params["profile_steps"] = 0
+
+    mode = "pretrain" if hyper_params["pretrain"] else "finetune"
+    hyper_params["save_every"] = save_every
+    # latest training state, training resumes from it when it exists
+    hyper_params["resume_path"] = f"{hyper_params['model_dir']}/{mode}-last.ptg"
 
 # create log folder and model folder
     if not os.path.isdir(hyper_params["log_dir"]):
@@ -244,23 +338,55 @@ if __name__ == "__main__":
 # set up training and validation sets
     torch.manual_seed(hyper_params["seed"])
     dataset_train = MyOwnDataset(root=hyper_params["dataset_path"])
-    dataset_train = dataset_train.shuffle()
     dataset_vld = MyOwnDataset(root='./data/pt/validation')
 
-    train_loader = DataLoader(dataset_train, batch_size=hyper_params["batch_size"], shuffle=True, pin_memory=True, num_workers=9)
+    # the data order of an epoch only depends on the seed and the epoch, see ResumableSampler
+    sampler_train = ResumableSampler(dataset_train, shuffle=True, seed=hyper_params["seed"])
+    # the loader draws its worker seeds from its own generator, not from the restored global RNG
+    train_loader = DataLoader(dataset_train, batch_size=hyper_params["batch_size"], sampler=sampler_train, pin_memory=True, num_workers=9,
+                              generator=torch.Generator().manual_seed(hyper_params["seed"]))
+    # the same subsample every epoch, so that the epochs compare
+    dataset_vld = dataset_vld[stratified_indices(len(dataset_vld), hyper_params["vld_subsample"], hyper_params["seed"])]
     vld_loader = DataLoader(dataset_vld, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=5)
 
+    if hyper_params["full_eval"]:
+        eval_worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_worker.py")
+        eval_out = open(hyper_params["log_dir"] + "/eval_worker.out", "a")
+        eval_proc = subprocess.Popen([sys.executable, eval_worker, "--mode", mode,
+                                      "--model_dir", hyper_params["model_dir"], "--log_dir", hyper_params["log_dir"],
+                                      "--batch_size", str(batch_size), "--device", hyper_params["eval_device"],
+                                      "--parent_pid", str(os.getpid()),
+                                      "--promote_path", f"{hyper_params['model_dir']}/{mode}-best-full.ptg"],
+                                     stdout=eval_out, stderr=subprocess.STDOUT)
+
 # load model and optimizer weights
     model = GTModel(3, 3).cuda()
     optimizer = torch.optim.AdamW(model.parameters(), lr=hyper_params["lr"])
 
-    if hyper_params["checkpoint_path"] is not None and os.path.isfile(hyper_params["checkpoint_path"]):
-        checkpoint = torch.load(hyper_params["checkpoint_path"])
+    checkpointer = AsyncCheckpointer()
+
+    best_f1 = 0
+    start_epoch = 0
+    start_step = 0
+    meter_state = None
+
+    if os.path.isfile(hyper_params["resume_path"]):
+        # resume an interrupted run where its last checkpoint left it
+        state = torch.load(hyper_params["resume_path"], weights_only=False)
+        model.load_state_dict(state['model_state_dict'])
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+        best_f1 = state['best_f1']
+        start_epoch = state['epoch']
+        start_step = state['step']
+        meter_state = state['meter']
+        set_rng_state(state['rng_state'])
+        print(f"resume from {hyper_params['resume_path']}: epoch {start_epoch}, step {start_step}, best f1 {best_f1}")
+
+    elif hyper_params["checkpoint_path"] is not None and os.path.isfile(hyper_params["checkpoint_path"]):
+        checkpoint = torch.load(hyper_params["checkpoint_path"], weights_only=False)
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
-    best_f1 = 0
-    if hyper_params["checkpoint_path"] is not None and os.path.isfile(hyper_params["checkpoint_path"]):
         # evaluate the model if it is loaded from a checkpoint
         with open(hyper_params["log_dir"] + "/gnn-load.log", "w") as log_file:
 
@@ -273,55 +399,36 @@ if __name__ == "__main__":
             _, _, _, f1 = evaluate(log_file)
         
         best_f1 = f1
-        if hyper_params["pretrain"]:
-                torch.save({
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                }, "models/pretrain/pretrain-best.ptg")
-        else:
-            torch.save({
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            }, "models/finetune/finetune-best.ptg")
+        checkpointer.save(training_state(0, 0), f"{hyper_params['model_dir']}/{mode}-best.ptg")
 
 
 # training loop
-    for epoch in range(hyper_params["epoch_num"]):
+    first_epoch = start_epoch
+    for epoch in range(start_epoch, hyper_params["epoch_num"]):
         print(f"epoch {epoch}\ntrain:")
-        with open(hyper_params["log_dir"] + f"/gnn-{epoch}.log", "w") as log_file:
+        # a resumed epoch appends to its log
+        with open(hyper_params["log_dir"] + f"/gnn-{epoch}.log", "a" if start_step > 0 else "w") as log_file:
 
             localtime = time.asctime(time.localtime(time.time()))
             log_file.write(str(localtime) + "\n")
 
             log_file.write(f"epoch: {epoch}\n")
-            train_loss = train(log_file)
+            train_loss = train(log_file, epoch, start_step, meter_state)
+            start_step = 0
+            meter_state = None
             localtime = time.asctime(time.localtime(time.time()))
             
             print("eval:")
             _, _, _, f1 = evaluate(log_file)
 
-        if hyper_params["pretrain"]:
-            torch.save({
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                }, "models/pretrain/pretrain-" + str(epoch) + ".ptg")
-        else:
-            torch.save({
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                }, "models/finetune/finetune-" + str(epoch) + ".ptg")
-
+        paths = [f"{hyper_params['model_dir']}/{mode}-{epoch}.ptg", hyper_params["resume_path"]]
         if f1 > best_f1:
             best_f1 = f1
-            if hyper_params["pretrain"]:
-                torch.save({
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                }, "models/pretrain/pretrain-best.ptg")
-            else:
-                torch.save({
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                }, "models/finetune/finetune-best.ptg")
+            paths.append(f"{hyper_params['model_dir']}/{mode}-best.ptg")
+
+        checkpointer.save(training_state(epoch + 1, 0), *paths)
 
+    checkpointer.wait()
+    if hyper_params["full_eval"]:
+        print(f"full validation of the last checkpoints continues in process {eval_proc.pid}, see {hyper_params['log_dir']}/full-eval.log")
     print("Done")
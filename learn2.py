@@ -6,11 +6,14 @@ import sys
 import time
 import argparse
 from tqdm import tqdm
-from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
 
 # --- IMPORTACIÓN DE LA NUEVA RED ---
 from mamba_model import NeuroBackMamba
-from data import MyOwnDataset, SortedBucketSampler
+from data import MyOwnDataset, SortedBucketSampler, ResumableSampler
+from metrics import ConfusionMeter
+from checkpoint import AsyncCheckpointer, rng_state, set_rng_state
+from partition import DEFAULT_MAX_NODES, split_oversized
+from profiling import StageTimer, stage_line, trace_profiler
 
 # Configuración de argumentos
 parser = argparse.ArgumentParser()
@@ -20,6 +23,17 @@ parser.add_argument('--lr', type=float, default=1e-4)
 parser.add_argument('--epochs', type=int, default=40)
 parser.add_argument('--hidden_dim', type=int, default=64)
 parser.add_argument('--layers', type=int, default=12)
+# sort nodes by noisy degree in training even when the graphs store a node ordering (node_order.py)
+parser.add_argument('--noisy_train_order', action='store_true')
+# checkpoint the training state every this many batches, training resumes from last.ptg unless --restart
+parser.add_argument('--save_every', type=int, default=500)
+parser.add_argument('--restart', action='store_true')
+# graphs over this many nodes are trained on as clusters with a halo of halo_hops (partition.py), 0 disables it
+parser.add_argument('--partition_nodes', type=int, default=DEFAULT_MAX_NODES)
+parser.add_argument('--halo_hops', type=int, default=2)
+# export a torch.profiler trace of profile_steps steps, from step profile_start of the first epoch, to the log folder
+parser.add_argument('--profile_start', type=int, default=10)
+parser.add_argument('--profile_steps', type=int, default=0)
 args = parser.parse_args()
 
 # Configuración de Rutas
@@ -45,7 +59,10 @@ batch_size_vld = 2
 # train_loader = DataLoader(dataset_train, batch_size=args.batch_size, sampler=sampler_train, num_workers=12, pin_memory=False)
 # vld_loader = DataLoader(dataset_vld, batch_size_vld, sampler=sampler_vld, num_workers=4, pin_memory=False)
 
-train_loader = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, num_workers=12, pin_memory=True)
+# the data order of an epoch only depends on the seed and the epoch, so it can be resumed mid-epoch
+sampler_train = ResumableSampler(dataset_train, shuffle=True, seed=77)
+train_loader = DataLoader(dataset_train, batch_size=args.batch_size, sampler=sampler_train, num_workers=12, pin_memory=True,
+                          generator=torch.Generator().manual_seed(77))
 vld_loader = DataLoader(dataset_vld, batch_size_vld, shuffle=False, num_workers=4, pin_memory=True)
 
 # --- INICIALIZACIÓN DEL MODELO ---
@@ -55,7 +72,8 @@ model = NeuroBackMamba(
     input_dim=input_dim,
     hidden_dim=args.hidden_dim,
     num_layers=args.layers,
-    dropout=0.1
+    dropout=0.1,
+    noisy_train_order=args.noisy_train_order
 ).to(device)
 
 optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=0.01)
@@ -66,97 +84,147 @@ if args.mode == 'finetune':
     ckpt_path = "./models/pretrain/pretrain-best.ptg"
     if os.path.exists(ckpt_path):
         print(f"Cargando pesos pre-entrenados desde {ckpt_path}")
-        checkpoint = torch.load(ckpt_path)
+        checkpoint = torch.load(ckpt_path, weights_only=False)
         model.load_state_dict(checkpoint['model_state_dict'])
     else:
         print("Advertencia: No se encontró checkpoint de pretrain.")
 
 # --- FUNCIÓN DE ENTRENAMIENTO CORREGIDA ---
-def train_epoch(epoch_idx, log_file):
+def training_state(epoch, step, meter=None):
+    # epoch in progress and batches of it already trained on, the data order follows from the epoch
+    return {
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scaler_state_dict': scaler.state_dict(),
+        'epoch': epoch,
+        'step': step,
+        'best_f1': best_f1,
+        'rng_state': rng_state(),
+        'meter': meter.state_dict() if meter is not None else None,
+    }
+
+def train_epoch(epoch_idx, log_file, start_step=0, meter_state=None):
     model.train()
-    total_loss = 0
-    total_samples = 0
-    
-    all_targets = []
-    all_preds = []
+    meter = ConfusionMeter(device=device)
+    if meter_state is not None:
+        meter.load_state_dict(meter_state)
+
+    sampler_train.set_epoch(epoch_idx, start_step * args.batch_size)
+    step = start_step
+
+    timer = StageTimer(device)
+    # the trace covers a window of steps of the first epoch of the run
+    prof = trace_profiler(os.path.join(BASE_LOG, "trace"), args.profile_start, args.profile_steps, device) \
+        if epoch_idx == first_epoch else None
+    if prof is not None:
+        prof.start()
 
-    pbar = tqdm(train_loader, desc=f"Train Ep {epoch_idx}")
+    pbar = tqdm(timer.iterate(train_loader), desc=f"Train Ep {epoch_idx}", initial=start_step, total=start_step + len(train_loader))
     
-    for data in pbar:
-        if data.y is None: continue
-        
-        data = data.to(device)
-        
-        # --- CORRECCIÓN CRÍTICA ---
-        # 1. Encontramos los índices RELATIVOS dentro de data.y que son válidos (!= 2)
-        # Esto nos da posiciones como [0, 1, 5, ...] hasta len(data.y)
-        y_valid_indices = (data.y != 2).nonzero(as_tuple=True)[0]
-        
-        if y_valid_indices.numel() == 0: continue
-        
-        # 2. Obtenemos las etiquetas reales usando esos índices
-        y_valid = data.y[y_valid_indices].float()
-        
-        # Cálculo de pesos para desbalance
-        n_zeros = (y_valid == 0).sum()
-        n_ones = (y_valid == 1).sum()
-        pos_weight = (n_zeros + 1) / (n_ones + 1)
-        
-        # Reducción manual para aplicar pesos
-        criterion = nn.BCEWithLogitsLoss(reduction='none') 
-        
+    for batch in pbar:
+        step += 1
+        if batch.y is None: continue
+
+        timer.step_begin()
+        step_vars = 0
+
+        # graphs over the node budget are trained on as clusters (partition.py), the
+        # loss of every micro-batch is weighted by its share of the labeled variables
+        with timer.stage("partition"):
+            parts = split_oversized(batch, args.partition_nodes, args.halo_hops)
+        total_valid = sum(int((data.y != 2).sum()) for data in parts)
+        if total_valid == 0: continue
+
         optimizer.zero_grad()
-        
-        with torch.amp.autocast('cuda'):
-            try:
-                # El modelo devuelve predicciones para TODOS los nodos (ej. 1040)
-                out = model(data.x, data.edge_index, data.edge_attr, data.batch)
-                
-                # --- CORRECCIÓN CRÍTICA ---
-                # 3. Asumimos que data.y corresponde a los PRIMEROS nodos de data.x
-                # (Esta es la convención estándar cuando len(y) < len(x) en grafos SAT)
-                # Usamos los mismos índices válidos para extraer las predicciones correspondientes.
-                # Como out es [1040, 1], out[y_valid_indices] extrae los valores correctos.
-                pred_valid = out[y_valid_indices].view(-1)
-                
-                # Chequeo de seguridad dimensional
-                if pred_valid.shape != y_valid.shape:
-                    # Caso extremo: Si los índices exceden el tamaño de out (raro)
-                    print(f"Error dimensional: Pred {pred_valid.shape} vs Target {y_valid.shape}")
-                    continue
-
-                loss_elements = criterion(pred_valid, y_valid)
-                weights = torch.ones_like(y_valid)
-                weights[y_valid == 1] = pos_weight
-                loss = (loss_elements * weights).mean()
-                
-            except RuntimeError as e:
-                if 'out of memory' in str(e):
-                    torch.cuda.empty_cache()
-                    continue
-                else:
-                    raise e
+        stepped = False
 
-        scaler.scale(loss).backward()
-        scaler.unscale_(optimizer)
-        nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-        scaler.step(optimizer)
-        scaler.update()
+        for data in parts:
+            with timer.stage("h2d"):
+                data = data.to(device)
 
-        total_loss += loss.item() * y_valid.size(0)
-        total_samples += y_valid.size(0)
-        
-        with torch.no_grad():
-            preds_cls = (pred_valid >= 0.5).long()
-            all_targets.append(y_valid.cpu())
-            all_preds.append(preds_cls.cpu())
-
-    if len(all_targets) > 0:
-        y_true = torch.cat(all_targets).numpy()
-        y_pred = torch.cat(all_preds).numpy()
-        
-        avg_loss = total_loss / total_samples if total_samples > 0 else 0
-        f1 = f1_score(y_true, y_pred, zero_division=0)
+            # --- CORRECCIÓN CRÍTICA ---
+            # 1. Encontramos los índices RELATIVOS dentro de data.y que son válidos (!= 2)
+            # Esto nos da posiciones como [0, 1, 5, ...] hasta len(data.y)
+            y_valid_indices = (data.y != 2).nonzero(as_tuple=True)[0]
+
+            if y_valid_indices.numel() == 0: continue
+
+            # 2. Obtenemos las etiquetas reales usando esos índices
+            y_valid = data.y[y_valid_indices].float()
+
+            # Cálculo de pesos para desbalance
+            n_zeros = (y_valid == 0).sum()
+            n_ones = (y_valid == 1).sum()
+            pos_weight = (n_zeros + 1) / (n_ones + 1)
+
+            # Reducción manual para aplicar pesos
+            criterion = nn.BCEWithLogitsLoss(reduction='none')
+
+            with torch.amp.autocast('cuda'), timer.stage("forward"):
+                try:
+                    # El modelo devuelve predicciones para TODOS los nodos (ej. 1040)
+                    out = model(data.x, data.edge_index, data.edge_attr, data.batch,
+                                getattr(data, "node_order_index", None), getattr(data, "node_order_inv_index", None))
+
+                    # --- CORRECCIÓN CRÍTICA ---
+                    # 3. Asumimos que data.y corresponde a los PRIMEROS nodos de data.x
+                    # (Esta es la convención estándar cuando len(y) < len(x) en grafos SAT)
+                    # Usamos los mismos índices válidos para extraer las predicciones correspondientes.
+                    # Como out es [1040, 1], out[y_valid_indices] extrae los valores correctos.
+                    pred_valid = out[y_valid_indices].view(-1)
+
+                    # Chequeo de seguridad dimensional
+                    if pred_valid.shape != y_valid.shape:
+                        # Caso extremo: Si los índices exceden el tamaño de out (raro)
+                        print(f"Error dimensional: Pred {pred_valid.shape} vs Target {y_valid.shape}")
+                        continue
+
+                    loss_elements = criterion(pred_valid, y_valid)
+                    weights = torch.ones_like(y_valid)
+                    weights[y_valid == 1] = pos_weight
+                    loss = (loss_elements * weights).mean()
+
+                except RuntimeError as e:
+                    if 'out of memory' in str(e):
+                        torch.cuda.empty_cache()
+                        continue
+                    else:
+                        raise e
+
+            with timer.stage("backward"):
+                scaler.scale(loss * (y_valid.size(0) / total_valid)).backward()
+            stepped = True
+            step_vars += y_valid.size(0)
+
+            with torch.no_grad():
+                preds_cls = (pred_valid >= 0.5).long()
+                meter.update(y_valid, preds_cls, loss, y_valid.size(0))
+
+        if stepped:
+            with timer.stage("optimizer"):
+                scaler.unscale_(optimizer)
+                nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+                scaler.step(optimizer)
+                scaler.update()
+
+        timer.step_end(batch.num_graphs, batch.num_nodes, step_vars)
+        if prof is not None:
+            prof.step()
+
+        if step % args.save_every == 0:
+            with timer.stage("checkpoint"):
+                checkpointer.save(training_state(epoch_idx, step, meter), os.path.join(BASE_MODEL, "last.ptg"))
+
+    if prof is not None:
+        prof.stop()
+
+    # stage times, throughput per graph size and peak memory of the epoch
+    profile = timer.write(os.path.join(BASE_LOG, f"profile-{epoch_idx}.json"), epoch=epoch_idx, start_step=start_step)
+    log_file.write(f"Epoch {epoch_idx} stages: {stage_line(profile)}\n")
+
+    if meter.loss_cnt > 0:
+        avg_loss = meter.loss()
+        _, _, f1 = meter.scores(average="binary")
         
         log_msg = f"Epoch {epoch_idx} Loss: {avg_loss:.4f} F1: {f1:.4f}\n"
         log_file.write(log_msg)
@@ -167,19 +235,20 @@ def train_epoch(epoch_idx, log_file):
 # --- FUNCIÓN DE EVALUACIÓN CORREGIDA ---
 def evaluate(log_file):
     model.eval()
-    all_targets = []
-    all_preds = []
+    meter = ConfusionMeter(device=device)
     
     with torch.no_grad():
         for data in tqdm(vld_loader, desc="Validating"):
             try:
                 data = data.to(device)
-                out = model(data.x, data.edge_index, data.edge_attr, data.batch)
+                out = model(data.x, data.edge_index, data.edge_attr, data.batch,
+                            getattr(data, "node_order_index", None), getattr(data, "node_order_inv_index", None))
             except RuntimeError as e:
                 if 'out of memory' in str(e):
                     data = data.cpu()
                     model_cpu = model.to('cpu')
-                    out = model_cpu(data.x, data.edge_index, data.edge_attr, data.batch)
+                    out = model_cpu(data.x, data.edge_index, data.edge_attr, data.batch,
+                                    getattr(data, "node_order_index", None), getattr(data, "node_order_inv_index", None))
                     model.to(device)
                 else:
                     raise e
@@ -192,41 +261,57 @@ def evaluate(log_file):
             y_valid = data.y[y_valid_indices].float()
             
             preds_cls = (pred_valid >= 0).long()
-            all_targets.append(y_valid.cpu())
-            all_preds.append(preds_cls.cpu())
+            meter.update(y_valid, preds_cls)
 
-    if len(all_targets) > 0:
-        y_true = torch.cat(all_targets).numpy()
-        y_pred = torch.cat(all_preds).numpy()
-        
-        f1 = f1_score(y_true, y_pred, zero_division=0)
-        matrix = confusion_matrix(y_true, y_pred)
+    if meter.counts.sum() > 0:
+        _, _, f1 = meter.scores(average="binary")
+        matrix = meter.confusion_matrix()
         
         log_file.write(f"Validation F1: {f1:.4f}\nConfusion Matrix:\n{matrix}\n")
         return f1
     return 0.0
 
 # --- BUCLE PRINCIPAL ---
+checkpointer = AsyncCheckpointer()
 best_f1 = 0.0
+start_epoch = 0
+start_step = 0
+meter_state = None
+
+resume_path = os.path.join(BASE_MODEL, "last.ptg")
+if not args.restart and os.path.exists(resume_path):
+    state = torch.load(resume_path, weights_only=False)
+    # last.ptg of older runs only has the weights
+    if 'rng_state' in state:
+        model.load_state_dict(state['model_state_dict'])
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+        scaler.load_state_dict(state['scaler_state_dict'])
+        best_f1 = state['best_f1']
+        start_epoch = state['epoch']
+        start_step = state['step']
+        meter_state = state['meter']
+        set_rng_state(state['rng_state'])
+        print(f"Reanudando desde {resume_path}: epoch {start_epoch}, step {start_step}, best F1 {best_f1:.4f}")
+
 log_path = os.path.join(BASE_LOG, f"training.log")
 
 with open(log_path, "a") as log_file:
-    for epoch in range(args.epochs):
-        train_f1 = train_epoch(epoch, log_file)
+    first_epoch = start_epoch
+    for epoch in range(start_epoch, args.epochs):
+        train_f1 = train_epoch(epoch, log_file, start_step, meter_state)
+        start_step = 0
+        meter_state = None
         val_f1 = evaluate(log_file)
-        
-        save_dict = {
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'epoch': epoch,
-            'f1': val_f1
-        }
-        
-        torch.save(save_dict, os.path.join(BASE_MODEL, "last.ptg"))
-        
+
+        paths = [resume_path]
         if val_f1 > best_f1:
             best_f1 = val_f1
-            torch.save(save_dict, os.path.join(BASE_MODEL, f"{args.mode}-best.ptg"))
+            paths.append(os.path.join(BASE_MODEL, f"{args.mode}-best.ptg"))
             print(f"¡Nuevo récord! F1: {best_f1:.4f}")
 
+        save_dict = training_state(epoch + 1, 0)
+        save_dict['f1'] = val_f1
+        checkpointer.save(save_dict, *paths)
+
+checkpointer.wait()
 print("Entrenamiento finalizado.")
@@ -0,0 +1,261 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# bounds of the default chunk size of selective_scan()
+MIN_CHUNK_SIZE = 256
+MAX_CHUNK_SIZE = 1024
+
+
+def selective_scan_ref(u, delta, A, B, C, D, z=None, delta_bias=None, delta_softplus=True):
+    """
+    Naive per-timestep selective scan, the reference of selective_scan().
+
+    u, delta, z: (batch, length, d_inner), A: (d_inner, d_state),
+    B, C: (batch, length, d_state), D: (d_inner)
+    """
+    if delta_bias is not None:
+        delta = delta + delta_bias
+    if delta_softplus:
+        delta = F.softplus(delta)
+
+    batch, length, d_inner = u.shape
+    h = u.new_zeros((batch, d_inner, A.size(1)))
+    ys = []
+    for t in range(length):
+        dA = torch.exp(delta[:, t, :, None] * A)
+        dBu = delta[:, t, :, None] * B[:, t, None, :] * u[:, t, :, None]
+        h = dA * h + dBu
+        ys.append((h * C[:, t, None, :]).sum(dim=-1))
+    y = torch.stack(ys, dim=1) + u * D
+
+    if z is not None:
+        y = y * F.silu(z)
+    return y
+
+
+def selective_scan(u, delta, A, B, C, D, z=None, delta_bias=None, delta_softplus=True,
+                   h0=None, reset=None, chunk_size=None, return_state=False):
+    """
+    Chunked parallel selective scan on CPU.
+
+    The sequence is cut into K chunks of chunk_size steps and the recurrence h_t = exp(delta_t * A) * h_t-1 + delta_t * B_t * u_t
+    is evaluated as a two-level associative scan:
+      1. all chunks are scanned at once from a zero state, one vectorized
+         (batch, K, d_inner, d_state) update per step, keeping each chunk's
+         final state and total decay,
+      2. the chunk aggregates are combined sequentially over the K chunks to
+         get the state entering every chunk,
+      3. the contribution of the entering state is added back to every output.
+    The Python loop runs 2 * chunk_size + K times instead of length times, and
+    the (length, d_inner, d_state) states are never materialized. The default
+    chunk_size keeps K small enough for the (batch, K, d_inner, d_state)
+    states to stay in cache (see bench_scan.py).
+
+    Same layout as selective_scan_ref(); h0 is an optional (batch, d_inner, d_state)
+    initial state and reset an optional (batch, length) bool mask of steps that
+    start a new sequence (their state does not depend on the previous steps).
+    """
+    if delta_bias is not None:
+        delta = delta + delta_bias
+    if delta_softplus:
+        delta = F.softplus(delta)
+
+    batch, length, d_inner = u.shape
+    d_state = A.size(1)
+
+    if chunk_size is None or chunk_size <= 0:
+        target = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, length // 32))
+        chunk_size = math.ceil(length / max(1, length // target))
+    num_chunks = math.ceil(length / chunk_size)
+
+    # padded steps have delta = 0, i.e. no decay and no input, and leave the state untouched
+    pad = num_chunks * chunk_size - length
+    du = F.pad(delta * u, (0, 0, 0, pad)).view(batch, num_chunks, chunk_size, d_inner)
+    delta_p = F.pad(delta, (0, 0, 0, pad)).view(batch, num_chunks, chunk_size, d_inner)
+    B_p = F.pad(B, (0, 0, 0, pad)).view(batch, num_chunks, chunk_size, d_state)
+    C_p = F.pad(C, (0, 0, 0, pad)).view(batch, num_chunks, chunk_size, d_state)
+    if reset is not None:
+        reset = F.pad(reset, (0, pad)).view(batch, num_chunks, chunk_size)
+
+    def decay(j):
+        dA = torch.exp(delta_p[:, :, j, :, None] * A)
+        if reset is not None:
+            dA = dA.masked_fill(reset[:, :, j, None, None], 0.0)
+        return dA
+
+    # 1. scan every chunk from a zero state
+    h = u.new_zeros((batch, num_chunks, d_inner, d_state))
+    decay_prod = u.new_ones((batch, num_chunks, d_inner, d_state))
+    ys = []
+    for j in range(chunk_size):
+        dA = decay(j)
+        h = dA * h + du[:, :, j, :, None] * B_p[:, :, j, None, :]
+        decay_prod = decay_prod * dA
+        ys.append(torch.einsum("bkdn,bkn->bkd", h, C_p[:, :, j]))
+
+    # 2. state entering every chunk
+    h_in = []
+    state = u.new_zeros((batch, d_inner, d_state)) if h0 is None else h0
+    for k in range(num_chunks):
+        h_in.append(state)
+        state = decay_prod[:, k] * state + h[:, k]
+
+    # 3. add the decayed entering state to the outputs
+    if num_chunks > 1 or h0 is not None:
+        h_in = torch.stack(h_in, dim=1)
+        for j in range(chunk_size):
+            h_in = h_in * decay(j)
+            ys[j] = ys[j] + torch.einsum("bkdn,bkn->bkd", h_in, C_p[:, :, j])
+
+    # out-of-place updates only, the scan is also used for training
+    y = torch.stack(ys, dim=2)
+    y = y.view(batch, num_chunks * chunk_size, d_inner)[:, :length] + u * D
+    if z is not None:
+        y = y * F.silu(z)
+
+    if return_state:
+        return y, state
+    return y
+
+
+def seq_positions(cu_seqlens):
+    """
+    For packed sequences with cumulative offsets cu_seqlens (num_seqs + 1),
+    returns the position of every token in its sequence and its sequence id.
+    """
+    lengths = cu_seqlens[1:] - cu_seqlens[:-1]
+    seq = torch.repeat_interleave(torch.arange(lengths.numel(), device=cu_seqlens.device), lengths)
+    pos = torch.arange(seq.numel(), device=cu_seqlens.device) - cu_seqlens[:-1][seq]
+    return pos, seq
+
+
+class MambaCPU(nn.Module):
+    """
+    Pure PyTorch Mamba block with the same parameters (names, shapes and
+    initialization) as mamba_ssm.Mamba, so mamba_ssm checkpoints load unchanged.
+    """
+    def __init__(self, d_model, d_state=16, d_conv=4, expand=2, dt_rank="auto",
+                 dt_min=0.001, dt_max=0.1, dt_init="random", dt_scale=1.0, dt_init_floor=1e-4,
+                 conv_bias=True, bias=False, chunk_size=None):
+        super().__init__()
+        self.d_model = d_model
+        self.d_state = d_state
+        self.d_conv = d_conv
+        self.expand = expand
+        self.d_inner = int(self.expand * self.d_model)
+        self.dt_rank = math.ceil(self.d_model / 16) if dt_rank == "auto" else dt_rank
+        self.chunk_size = chunk_size
+
+        self.in_proj = nn.Linear(self.d_model, self.d_inner * 2, bias=bias)
+
+        self.conv1d = nn.Conv1d(
+            in_channels=self.d_inner,
+            out_channels=self.d_inner,
+            bias=conv_bias,
+            kernel_size=d_conv,
+            groups=self.d_inner,
+            padding=d_conv - 1,
+        )
+        self.act = nn.SiLU()
+
+        self.x_proj = nn.Linear(self.d_inner, self.dt_rank + self.d_state * 2, bias=False)
+        self.dt_proj = nn.Linear(self.dt_rank, self.d_inner, bias=True)
+
+        dt_init_std = self.dt_rank ** -0.5 * dt_scale
+        if dt_init == "constant":
+            nn.init.constant_(self.dt_proj.weight, dt_init_std)
+        elif dt_init == "random":
+            nn.init.uniform_(self.dt_proj.weight, -dt_init_std, dt_init_std)
+        else:
+            raise NotImplementedError
+
+        dt = torch.exp(
+            torch.rand(self.d_inner) * (math.log(dt_max) - math.log(dt_min)) + math.log(dt_min)
+        ).clamp(min=dt_init_floor)
+        # inverse of softplus
+        inv_dt = dt + torch.log(-torch.expm1(-dt))
+        with torch.no_grad():
+            self.dt_proj.bias.copy_(inv_dt)
+        self.dt_proj.bias._no_reinit = True
+
+        A = torch.arange(1, self.d_state + 1, dtype=torch.float32).repeat(self.d_inner, 1).contiguous()
+        self.A_log = nn.Parameter(torch.log(A))
+        self.A_log._no_weight_decay = True
+
+        self.D = nn.Parameter(torch.ones(self.d_inner))
+        self.D._no_weight_decay = True
+
+        self.out_proj = nn.Linear(self.d_inner, self.d_model, bias=bias)
+
+    def forward(self, hidden_states, cu_seqlens=None):
+        # hidden_states: (batch, length, d_model), or (1, total, d_model) for packed
+        # sequences delimited by cu_seqlens, which are scanned without mixing
+        if cu_seqlens is None:
+            length = hidden_states.size(1)
+
+            xz = self.in_proj(hidden_states)
+            x, z = xz.chunk(2, dim=-1)
+
+            x = self.conv1d(x.transpose(1, 2))[..., :length].transpose(1, 2)
+            return self._ssm(x, z)[0]
+
+        assert(hidden_states.size(0) == 1)
+        pos, _ = seq_positions(cu_seqlens)
+        return self.step_chunk(hidden_states, pos=pos)[0]
+
+    def step_chunk(self, hidden_states, state=None, pos=None):
+        """
+        Runs the block on the next chunk of a long sequence and returns the
+        output and the state to pass with the following chunk, i.e. the last
+        d_conv - 1 conv inputs and the SSM state. Chaining the chunks gives the
+        output of a single call over the whole sequence.
+
+        pos optionally gives the position of every token in its sequence, for
+        packed sequences: a token at position 0 starts from an empty state.
+        """
+        conv_state, ssm_state = state if state is not None else (None, None)
+
+        xz = self.in_proj(hidden_states)
+        x, z = xz.chunk(2, dim=-1)
+
+        x, conv_state = self._causal_conv(x, pos, conv_state)
+
+        reset = None if pos is None else (pos == 0).expand(hidden_states.size(0), -1)
+        y, ssm_state = self._ssm(x, z, ssm_state, reset)
+        return y, (conv_state, ssm_state)
+
+    def _causal_conv(self, x, pos=None, conv_state=None):
+        # causal depthwise conv where a token only sees the previous tokens of its own sequence
+        length = x.size(1)
+        if conv_state is not None:
+            x_ext = torch.cat([conv_state, x], dim=1)
+        else:
+            x_ext = F.pad(x, (0, 0, self.d_conv - 1, 0))
+
+        weight = self.conv1d.weight[:, 0]
+        out = x * weight[:, -1]
+        for shift in range(1, self.d_conv):
+            prev = x_ext[:, self.d_conv - 1 - shift:self.d_conv - 1 - shift + length]
+            if pos is not None:
+                prev = prev * (pos >= shift).unsqueeze(-1)
+            out = out + prev * weight[:, -1 - shift]
+        if self.conv1d.bias is not None:
+            out = out + self.conv1d.bias
+        return out, x_ext[:, x_ext.size(1) - (self.d_conv - 1):]
+
+    def _ssm(self, x, z, ssm_state=None, reset=None):
+        x = self.act(x)
+
+        x_dbl = self.x_proj(x)
+        dt, B, C = torch.split(x_dbl, [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        dt = F.linear(dt, self.dt_proj.weight)
+
+        A = -torch.exp(self.A_log.float())
+        y, ssm_state = selective_scan(x, dt, A, B, C, self.D.float(), z=z,
+                                      delta_bias=self.dt_proj.bias.float(), delta_softplus=True,
+                                      h0=ssm_state, reset=reset, chunk_size=self.chunk_size,
+                                      return_state=True)
+        return self.out_proj(y), ssm_state
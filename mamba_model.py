@@ -3,13 +3,45 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch_geometric.utils import degree, to_dense_batch
 from torch.nn import LayerNorm
-from mamba_ssm import Mamba
+
+from mamba_cpu import MambaCPU, seq_positions
+
+try:
+    from mamba_ssm import Mamba
+except ImportError:
+    # fused kernels are CUDA only, CPU hosts use the pure PyTorch scan
+    Mamba = None
+
+
+def resolve_backend(backend):
+    if backend == "auto":
+        return "cuda" if Mamba is not None and torch.cuda.is_available() else "cpu"
+    if backend == "cuda" and Mamba is None:
+        raise ImportError("mamba_ssm is required for the cuda Mamba backend")
+    assert(backend in ("cuda", "cpu"))
+    return backend
+
 
 class NodePrioritization(nn.Module):
-    def __init__(self):
+    def __init__(self, noisy_train_order=False):
         super().__init__()
+        self.noisy_train_order = noisy_train_order
+
+    def forward(self, x, edge_index, batch, node_order=None):
+        """
+        Returns the permutation that packs the nodes graph by graph, each graph
+        sorted by descending degree, and the cumulative offsets of the graphs
+        in the packed sequence.
+
+        node_order is the collated permutation precomputed by node_order.py,
+        used instead of sorting except in training with noisy_train_order.
+        """
+        num_graphs = int(batch.max()) + 1 if batch.numel() > 0 else 0
+        cu_seqlens = F.pad(torch.cumsum(torch.bincount(batch, minlength=num_graphs), dim=0), (1, 0))
+
+        if node_order is not None and not (self.training and self.noisy_train_order):
+            return node_order, cu_seqlens
 
-    def forward(self, x, edge_index, batch):
         node_degrees = degree(edge_index[0], x.size(0), dtype=x.dtype)
 
         if self.training:
@@ -18,27 +50,23 @@ class NodePrioritization(nn.Module):
         else:
             score = node_degrees
 
-        x_dense, mask = to_dense_batch(x, batch)
-        scores_dense, _ = to_dense_batch(score, batch)
-
-        scores_dense[~mask] = -1e9
-
-        sorted_indices = torch.argsort(scores_dense, dim=1, descending=True)
+        # sort by score, then stable sort by graph to keep the score order within each graph
+        order = torch.argsort(score, descending=True, stable=True)
+        order = order[torch.argsort(batch[order], stable=True)]
 
-        batch_idx = torch.arange(x_dense.size(0), device=x.device).unsqueeze(1)
-        x_sorted = x_dense[batch_idx, sorted_indices]
-        
-        return x_sorted, mask, sorted_indices
+        return order, cu_seqlens
 
 class BiMambaBlock(nn.Module):
-    def __init__(self, d_model, d_state=64, d_conv=4, expand=2, dropout=0.1):
+    def __init__(self, d_model, d_state=64, d_conv=4, expand=2, dropout=0.1, backend="auto"):
         super().__init__()
 
-        self.mamba_fwd = Mamba(
+        mamba_cls = Mamba if resolve_backend(backend) == "cuda" else MambaCPU
+
+        self.mamba_fwd = mamba_cls(
             d_model=d_model, d_state=d_state, d_conv=d_conv, expand=expand
         )
 
-        self.mamba_bwd = Mamba(
+        self.mamba_bwd = mamba_cls(
             d_model=d_model, d_state=d_state, d_conv=d_conv, expand=expand
         )
 
@@ -46,29 +74,47 @@ class BiMambaBlock(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.output_proj = nn.Linear(d_model * 2, d_model)
 
-    def forward(self, x):
-        out_fwd = self.mamba_fwd(x)
+    def forward(self, x, cu_seqlens=None):
+        # x: (batch, length, d_model) dense sequences, or (1, total, d_model)
+        # packed sequences delimited by cu_seqlens
+        if cu_seqlens is None:
+            out_fwd = self.mamba_fwd(x)
+
+            x_rev = torch.flip(x, dims=[1])
+            out_rev = self.mamba_bwd(x_rev)
+            out_rev = torch.flip(out_rev, dims=[1])
+        else:
+            pos, seq = seq_positions(cu_seqlens)
+            # reverses every sequence in place, and is its own inverse
+            rev_index = cu_seqlens[1:][seq] - 1 - pos
 
-        x_rev = torch.flip(x, dims=[1])
-        out_rev = self.mamba_bwd(x_rev)
-        out_rev = torch.flip(out_rev, dims=[1])
+            out_fwd = self._packed(self.mamba_fwd, x, cu_seqlens, seq)
+            out_rev = self._packed(self.mamba_bwd, x[:, rev_index], cu_seqlens, seq)[:, rev_index]
 
         combined = torch.cat([out_fwd, out_rev], dim=-1)
         out = self.output_proj(combined)
 
         return self.norm(out + self.dropout(x))
 
+    def _packed(self, mamba, x, cu_seqlens, seq):
+        if isinstance(mamba, MambaCPU):
+            return mamba(x, cu_seqlens=cu_seqlens)
+
+        # the fused kernels only take dense batches, pad at the end of every sequence
+        x_dense, mask = to_dense_batch(x[0], seq, batch_size=cu_seqlens.numel() - 1)
+        return mamba(x_dense)[mask].unsqueeze(0)
+
 class NeuroBackMamba(nn.Module):
-    def __init__(self, input_dim, hidden_dim=64, num_layers=3, dropout=0.2):
+    def __init__(self, input_dim, hidden_dim=64, num_layers=3, dropout=0.2, backend="auto", noisy_train_order=False):
         super().__init__()
 
         self.embedding = nn.Linear(input_dim, hidden_dim)
         self.norm_in = LayerNorm(hidden_dim)
 
-        self.prioritizer = NodePrioritization()
+        self.prioritizer = NodePrioritization(noisy_train_order)
 
         self.layers = nn.ModuleList([
-            BiMambaBlock(d_model=hidden_dim, dropout=dropout)
+            BiMambaBlock(d_model=hidden_dim, dropout=dropout, backend=backend)
             for _ in range(num_layers)
         ])
 
@@ -78,23 +124,21 @@ class NeuroBackMamba(nn.Module):
             nn.Linear(hidden_dim // 2, 1)
         )
 
-    def forward(self, x, edge_index, edge_attr, batch):
+    def forward(self, x, edge_index, edge_attr, batch, node_order=None, node_order_inv=None):
         h = self.embedding(x)
         h = self.norm_in(h)
 
-        h_seq, mask, sort_idx = self.prioritizer(h, edge_index, batch)
+        order, cu_seqlens = self.prioritizer(h, edge_index, batch, node_order)
 
+        h_seq = h[order].unsqueeze(0)
         for layer in self.layers:
-            h_seq = layer(h_seq)
+            h_seq = layer(h_seq, cu_seqlens)
 
-        undo_sort_indices = torch.argsort(sort_idx, dim=1)
-        batch_idx = torch.arange(h_seq.size(0), device=x.device).unsqueeze(1)
-
-        h_restored = h_seq[batch_idx, undo_sort_indices]
-
-        _, mask_orig = to_dense_batch(torch.zeros(x.size(0), device=x.device), batch)
-
-        final_h = h_restored[mask_orig]
+        if order is node_order and node_order_inv is not None:
+            final_h = h_seq[0][node_order_inv]
+        else:
+            final_h = torch.empty_like(h)
+            final_h[order] = h_seq[0]
 
         out = self.classifier(final_h)
         return out
@@ -0,0 +1,83 @@
+import torch
+
+from mamba_cpu import MambaCPU, seq_positions
+from mamba_model import NeuroBackMamba
+
+# default number of nodes per chunk of streaming inference
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+def cpu_mamba(mamba):
+    # CPU copy of a fused mamba_ssm.Mamba, both have the same parameters
+    if isinstance(mamba, MambaCPU):
+        return mamba
+
+    block = MambaCPU(d_model=mamba.d_model, d_state=mamba.d_state, d_conv=mamba.d_conv, expand=mamba.expand)
+    block.load_state_dict({k: v.cpu() for k, v in mamba.state_dict().items()})
+    return block.eval()
+
+
+class StreamingNeuroBackMamba:
+    """
+    NeuroBackMamba inference on CPU over fixed-length chunks of the ordered node
+    sequence.
+
+    Each BiMambaBlock runs over the whole (packed) sequence chunk by chunk,
+    first forward and then backward, carrying the conv and SSM states of both
+    scan directions from one chunk to the next (MambaCPU.step_chunk). Only the
+    (nodes, hidden_dim) block inputs and outputs are kept for the whole sequence,
+    the projections, convolutions and scans only exist for one chunk at a time.
+    Outputs match the whole-sequence forward up to float summation order.
+    """
+    def __init__(self, model, chunk_size=DEFAULT_CHUNK_SIZE):
+        assert(isinstance(model, NeuroBackMamba))
+        self.model = model.cpu().eval()
+        self.chunk_size = chunk_size
+
+        self.layers = [(layer, cpu_mamba(layer.mamba_fwd), cpu_mamba(layer.mamba_bwd)) for layer in self.model.layers]
+
+    def __call__(self, x, edge_index, edge_attr, batch, node_order=None, node_order_inv=None):
+        model = self.model
+        num_nodes = x.size(0)
+
+        with torch.no_grad():
+            order, cu_seqlens = model.prioritizer(x, edge_index, batch, node_order)
+            if order is not node_order or node_order_inv is None:
+                node_order_inv = torch.empty_like(order)
+                node_order_inv[order] = torch.arange(num_nodes)
+
+            # position of every node in its graph, in the forward and in the backward scan
+            pos, seq = seq_positions(cu_seqlens)
+            pos_rev = cu_seqlens[1:][seq] - cu_seqlens[:-1][seq] - 1 - pos
+
+            chunks = [(lo, min(lo + self.chunk_size, num_nodes)) for lo in range(0, num_nodes, self.chunk_size)]
+
+            h = torch.empty((num_nodes, model.embedding.out_features))
+            for lo, hi in chunks:
+                h[lo:hi] = model.norm_in(model.embedding(x[order[lo:hi]]))
+
+            for layer, mamba_fwd, mamba_bwd in self.layers:
+                h = self._bi_mamba_block(layer, mamba_fwd, mamba_bwd, h, chunks, pos, pos_rev)
+
+            out = torch.empty((num_nodes, 1))
+            for lo, hi in chunks:
+                out[lo:hi] = model.classifier(h[lo:hi])
+
+        return out[node_order_inv]
+
+    def _bi_mamba_block(self, layer, mamba_fwd, mamba_bwd, h, chunks, pos, pos_rev):
+        out_fwd = torch.empty_like(h)
+        state = None
+        for lo, hi in chunks:
+            y, state = mamba_fwd.step_chunk(h[lo:hi].unsqueeze(0), state, pos[lo:hi])
+            out_fwd[lo:hi] = y[0]
+
+        # the backward scan reads the whole packed sequence reversed, so every graph
+        # is reversed in place and starts at its last node
+        out = torch.empty_like(h)
+        state = None
+        for lo, hi in reversed(chunks):
+            y, state = mamba_bwd.step_chunk(h[lo:hi].flip(0).unsqueeze(0), state, pos_rev[lo:hi].flip(0))
+            combined = torch.cat([out_fwd[lo:hi], y[0].flip(0)], dim=-1)
+            out[lo:hi] = layer.norm(layer.output_proj(combined) + h[lo:hi])
+        return out
@@ -0,0 +1,63 @@
+import torch
+
+
+class ConfusionMeter:
+    """
+    Binary confusion counts and loss sums kept as tensors on the compute device.
+
+    update() is one scatter_add_ per batch and never synchronizes with the host,
+    the counts are copied back once when the metrics are read at the end.
+    Counts are laid out as sklearn's confusion_matrix(labels=[0, 1]):
+    rows are targets, columns predictions.
+    """
+    def __init__(self, device=None):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.counts = torch.zeros(4, dtype=torch.long, device=self.device)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.loss_cnt = 0
+
+    def state_dict(self):
+        return {"counts": self.counts, "loss_sum": self.loss_sum, "loss_cnt": self.loss_cnt}
+
+    def load_state_dict(self, state):
+        self.counts = state["counts"].to(self.counts.device)
+        self.loss_sum = state["loss_sum"].to(self.loss_sum.device)
+        self.loss_cnt = state["loss_cnt"]
+
+    def update(self, target, pred_class, loss=None, n=None):
+        # target, pred_class: 0/1 tensors of the same size, loss: mean loss over n samples
+        idx = (target.view(-1).long() * 2 + pred_class.view(-1).long()).to(self.counts.device, non_blocking=True)
+        self.counts.scatter_add_(0, idx, torch.ones_like(idx))
+
+        if loss is not None:
+            n = idx.numel() if n is None else n
+            self.loss_sum += loss.detach().to(self.loss_sum.device, torch.float64) * n
+            self.loss_cnt += n
+
+    def confusion_matrix(self):
+        return self.counts.view(2, 2).cpu().numpy()
+
+    def loss(self):
+        return self.loss_sum.item() / self.loss_cnt if self.loss_cnt > 0 else None
+
+    def scores(self, average="binary"):
+        """
+        precision, recall and F1 with sklearn's semantics for labels {0, 1}:
+        "binary" scores the positive class 1, "micro" pools both classes
+        (all three are then the accuracy). Undefined ratios are 0.
+        """
+        tn, fp, fn, tp = self.counts.cpu().tolist()
+
+        if average == "micro":
+            total = tn + fp + fn + tp
+            acc = (tn + tp) / total if total > 0 else 0.0
+            return acc, acc, acc
+
+        assert(average == "binary")
+        precision = tp / (tp + fp) if tp + fp > 0 else 0.0
+        recall = tp / (tp + fn) if tp + fn > 0 else 0.0
+        f1 = 2 * tp / (2 * tp + fp + fn) if tp > 0 else 0.0
+        return precision, recall, f1
@@ -0,0 +1,98 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import breadth_first_order
+from tqdm import tqdm
+
+# node orderings that can be stored with a graph for NeuroBackMamba
+#   degree:     descending degree, the eval ordering of NodePrioritization
+#   bfs:        breadth first from the root node (root, clauses, then variables by first clause)
+#   interleave: every clause followed by its variables that did not appear before
+ORDERINGS = ["degree", "bfs", "interleave"]
+
+
+def degree_order(edge_index, num_nodes):
+    node_degrees = torch.bincount(edge_index[0], minlength=num_nodes)
+    return torch.argsort(node_degrees, descending=True, stable=True)
+
+
+def bfs_order(edge_index, num_nodes, root=None):
+    # the root node is the last node of the graphs built by pt_dataset.py
+    root = num_nodes - 1 if root is None else root
+    edge_index = edge_index.numpy()
+    adj = coo_matrix((np.ones(edge_index.shape[1], dtype=np.int8), (edge_index[0], edge_index[1])),
+                     shape=(num_nodes, num_nodes)).tocsr()
+
+    order = breadth_first_order(adj, root, directed=False, return_predecessors=False)
+
+    # nodes that can not be reached from the root keep their index order at the end
+    if len(order) < num_nodes:
+        seen = np.zeros(num_nodes, dtype=bool)
+        seen[order] = True
+        order = np.concatenate([order, np.flatnonzero(~seen)])
+    return torch.from_numpy(order.astype(np.int64))
+
+
+def interleave_order(x, edge_index):
+    # x: 1 for variables, -1 for clauses, 0 for the root node
+    node_type = x.view(-1).numpy()
+    src, dst = edge_index.numpy()
+    num_nodes = len(node_type)
+
+    # variables go right after the first clause they occur in
+    var_cla = (node_type[src] == 1) & (node_type[dst] == -1)
+    major = np.full(num_nodes, num_nodes, dtype=np.int64)
+    np.minimum.at(major, src[var_cla], dst[var_cla])
+
+    is_cla = node_type == -1
+    major[is_cla] = np.flatnonzero(is_cla)
+    major[node_type == 0] = -1
+
+    # a clause before its variables, variables in index order
+    minor = np.arange(1, num_nodes + 1, dtype=np.int64)
+    minor[is_cla] = 0
+
+    return torch.from_numpy(np.lexsort((minor, major)).astype(np.int64))
+
+
+def compute_node_order(data, ordering):
+    assert(ordering in ORDERINGS)
+    if ordering == "degree":
+        return degree_order(data.edge_index, data.num_nodes)
+    if ordering == "bfs":
+        return bfs_order(data.edge_index, data.num_nodes)
+    return interleave_order(data.x, data.edge_index)
+
+
+def add_node_order(data, ordering):
+    """
+    Stores the node permutation of a graph and its inverse. Their names end with
+    "index", so that PyG collation offsets them by the node count of the previous
+    graphs, like edge_index, and a batch gets one permutation packing its graphs.
+    """
+    order = compute_node_order(data, ordering)
+    inv = torch.empty_like(order)
+    inv[order] = torch.arange(order.numel())
+
+    data.node_order_index = order
+    data.node_order_inv_index = inv
+    data.node_ordering = ordering
+    return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="add a precomputed node ordering to the graphs of a pt directory")
+    parser.add_argument('--pt_dir_path', type=str, default="./data/pt/validation/processed")
+    parser.add_argument('--ordering', type=str, default="degree", choices=ORDERINGS)
+    args = parser.parse_args()
+
+    for pt_file in tqdm(sorted(os.listdir(args.pt_dir_path))):
+        path = os.path.join(args.pt_dir_path, pt_file)
+        data = torch.load(path, weights_only=False)
+        add_node_order(data, args.ordering)
+
+        torch.save(data, path + ".tmp")
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,61 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import texttable as tt
+
+from gt_model import load_gt_model
+from export import ONNX_DIR, export_onnx_checkpoint
+from ort_backend import OrtGTModel, relation_mask
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check ONNX Runtime outputs of an exported GTModel against PyTorch")
+    parser.add_argument('--model_path', type=str, default="./best_model/pretrain-best2.ptg")
+    parser.add_argument('--pt_dir_path', type=str, default="./data/pt/validation/processed")
+    parser.add_argument('--onnx_dir', type=str, default=ONNX_DIR)
+    parser.add_argument('--max_graphs', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    model_dir = export_onnx_checkpoint(args.model_path, args.onnx_dir)
+    ort_model = OrtGTModel(model_dir, intra_op_threads=args.threads)
+
+    model = load_gt_model(args.model_path)
+    model.eval()
+
+    # sample graphs evenly over the size range
+    pt_file_lst = sorted(os.listdir(args.pt_dir_path), key=lambda pt_file: os.path.getsize(f"{args.pt_dir_path}/{pt_file}"))
+    step = max(1, len(pt_file_lst) // args.max_graphs)
+    pt_file_lst = pt_file_lst[::step][:args.max_graphs]
+
+    table = tt.Texttable()
+    table.header(["graph", "nodes", "edges", "relations", "max |diff|", "torch (ms)", "ort (ms)", "ok"])
+
+    failed = 0
+    for pt_file in pt_file_lst:
+        data = torch.load(os.path.join(args.pt_dir_path, pt_file), weights_only=False)
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            ref = model(data.x, data.edge_index, data.edge_attr).numpy()
+            torch_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pred = ort_model(data.x.numpy(), data.edge_index.numpy(), data.edge_attr.numpy())
+        ort_time = time.perf_counter() - start
+
+        diff = float(np.abs(pred - ref).max())
+        ok = diff <= args.atol
+        failed += not ok
+
+        table.add_row([pt_file, data.num_nodes, data.num_edges, relation_mask(data.edge_attr.numpy()),
+                       diff, torch_time * 1000, ort_time * 1000, ok])
+
+    table.set_precision(6)
+    print(table.draw())
+    print(f"{len(pt_file_lst) - failed}/{len(pt_file_lst)} graphs within atol={args.atol}")
+    exit(1 if failed > 0 else 0)
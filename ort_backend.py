@@ -0,0 +1,80 @@
+import os
+import sys
+
+import numpy as np
+
+# this module only needs numpy and onnxruntime, so that solver hosts can run
+# the exported models without a PyTorch/PyG install
+
+# edge_attr value of each relation of GTBlock, same order as export.RELATION_ATTRS
+RELATION_ATTRS = [-1, 0, 1]
+
+
+def relation_mask(edge_attr):
+    mask = 0
+    for bit, attr in enumerate(RELATION_ATTRS):
+        if (edge_attr == attr).any():
+            mask |= 1 << bit
+    return mask
+
+
+class OrtGTModel:
+    """
+    GTModel inference with ONNX Runtime on CPU, over the models written by
+    export.export_onnx_checkpoint (one per relation mask). Graphs whose
+    relation mask has no exported model run on the eager model of
+    checkpoint_path instead, when it is given.
+    """
+    def __init__(self, model_dir, intra_op_threads=0, inter_op_threads=1, checkpoint_path=None):
+        import onnxruntime as ort
+
+        self.model_dir = model_dir
+        self.checkpoint_path = checkpoint_path
+        self._eager = None
+
+        self.options = ort.SessionOptions()
+        self.options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        self.options.intra_op_num_threads = intra_op_threads
+        self.options.inter_op_num_threads = inter_op_threads
+        # PyG's Identity nodes carry stale shape annotations, silence the resulting warnings
+        self.options.log_severity_level = 3
+
+        self._sessions = {}
+
+    def session(self, rel_mask):
+        # None when there is no model for the mask but an eager fallback
+        if rel_mask not in self._sessions:
+            import onnxruntime as ort
+
+            path = os.path.join(self.model_dir, f"gt_r{rel_mask}.onnx")
+            if not os.path.isfile(path):
+                if self.checkpoint_path is not None:
+                    print(f"missing ONNX model {path}, relation mask {rel_mask} runs on the eager model", file=sys.stderr)
+                    self._sessions[rel_mask] = None
+                    return None
+                raise FileNotFoundError(f"missing ONNX model {path}, run export.py --onnx first")
+            self._sessions[rel_mask] = ort.InferenceSession(path, self.options, providers=["CPUExecutionProvider"])
+        return self._sessions[rel_mask]
+
+    def eager(self, x, edge_index, edge_attr):
+        # only imported here, the fallback needs PyTorch/PyG
+        import torch
+
+        from gt_model import load_gt_model
+
+        if self._eager is None:
+            self._eager = load_gt_model(self.checkpoint_path).eval()
+        with torch.no_grad():
+            pred = self._eager(torch.from_numpy(x), torch.from_numpy(edge_index), torch.from_numpy(edge_attr))
+        return pred.numpy()
+
+    def __call__(self, x, edge_index, edge_attr):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        edge_index = np.ascontiguousarray(edge_index, dtype=np.int64)
+        edge_attr = np.ascontiguousarray(edge_attr, dtype=np.float32).reshape(-1, 1)
+
+        session = self.session(relation_mask(edge_attr))
+        if session is None:
+            return self.eager(x, edge_index, edge_attr)
+        return session.run(None, {"x": x, "edge_index": edge_index, "edge_attr": edge_attr})[0]
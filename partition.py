@@ -0,0 +1,152 @@
+import math
+
+import torch
+import torch_geometric
+from torch_geometric.data import Batch, Data
+from torch_geometric.utils import sort_edge_index, subgraph
+from torch_geometric.utils.sparse import index2ptr
+
+from node_order import bfs_order
+
+# graphs larger than this many nodes are trained on as clusters (split_oversized)
+DEFAULT_MAX_NODES = 1_000_000
+
+
+def metis_partition(edge_index, num_nodes, num_parts):
+    # METIS through torch-sparse or pyg-lib, None when neither is installed
+    row, col = sort_edge_index(edge_index, num_nodes=num_nodes)
+    rowptr = index2ptr(row, size=num_nodes)
+
+    if torch_geometric.typing.WITH_TORCH_SPARSE:
+        try:
+            return torch.ops.torch_sparse.partition(rowptr, col, None, num_parts, False)
+        except (AttributeError, RuntimeError):
+            pass
+
+    if torch_geometric.typing.WITH_METIS:
+        import pyg_lib
+        return pyg_lib.partition.metis(rowptr, col, num_parts)
+
+    return None
+
+
+def bfs_blocks_order(x, edge_index, num_nodes):
+    # variables in breadth first order, every clause right after the first of its variables
+    rank = torch.empty(num_nodes, dtype=torch.long)
+    rank[bfs_order(edge_index, num_nodes, root=0)] = torch.arange(num_nodes)
+
+    node_type = x.view(-1)
+    src, dst = edge_index
+    var_cla = (node_type[src] == 1) & (node_type[dst] == -1)
+    anchor = rank.scatter_reduce(0, dst[var_cla], rank[src[var_cla]], reduce="amin", include_self=False)
+
+    return torch.argsort(anchor * 2 + (node_type != 1).long(), stable=True)
+
+
+def partition_graph(data, num_parts):
+    """
+    Cluster of every node of a graph, -1 for the root node. The clusters are
+    balanced parts of the variable-clause graph (the root node is connected to
+    every clause and is left out): METIS when available, otherwise consecutive
+    blocks of a breadth first order of the variables, each followed by its clauses.
+    """
+    num_nodes = data.num_nodes
+    is_root = data.x.view(-1) == 0
+    edge_index = data.edge_index.long()
+    edge_index = edge_index[:, ~(is_root[edge_index[0]] | is_root[edge_index[1]])]
+
+    part = metis_partition(edge_index, num_nodes, num_parts) if num_parts > 1 else None
+    if part is None:
+        part = torch.empty(num_nodes, dtype=torch.long)
+        order = bfs_blocks_order(data.x, edge_index, num_nodes)
+        order = order[~is_root[order]]
+        part[order] = torch.arange(order.numel()) * num_parts // order.numel()
+
+    part = part.long()
+    part[is_root] = -1
+    return part
+
+
+def cluster_graphs(data, max_nodes, halo_hops=1):
+    """
+    Splits a graph into clusters of at most max_nodes nodes: half of them owned,
+    the rest a halo of neighbours up to halo_hops away (never through the root
+    node, which is in every cluster). The halo gives the owned nodes their
+    neighbourhood, only the owned variables keep their backbone label, the halo
+    variables are labeled 2 (unknown) so that the loss skips them.
+
+    Clusters keep the node layout of the graphs (variables, clauses, root), so
+    they can be trained on like whole graphs.
+    """
+    num_nodes = data.num_nodes
+    is_root = data.x.view(-1) == 0
+    num_vars = int((data.x.view(-1) == 1).sum())
+    owned_nodes = max(max_nodes // 2, 1)
+    max_halo = max(max_nodes - owned_nodes - int(is_root.sum()), 0)
+
+    part = partition_graph(data, math.ceil((num_nodes - int(is_root.sum())) / owned_nodes))
+
+    # halo edges, without the root node
+    src, dst = data.edge_index.long()
+    keep = ~(is_root[src] | is_root[dst])
+    src, dst = src[keep], dst[keep]
+
+    clusters = []
+    for p in range(int(part.max()) + 1):
+        owned = part == p
+        if not owned.any():
+            continue
+
+        in_cluster = owned.clone()
+        frontier = owned
+        halo_budget = max_halo
+        for _ in range(halo_hops):
+            if halo_budget == 0:
+                break
+            reached = torch.zeros(num_nodes, dtype=torch.bool)
+            reached[dst[frontier[src]]] = True
+            halo = (reached & ~in_cluster).nonzero().view(-1)
+            if halo.numel() > halo_budget:
+                halo = halo[torch.randperm(halo.numel())[:halo_budget]]
+
+            in_cluster[halo] = True
+            frontier = torch.zeros(num_nodes, dtype=torch.bool)
+            frontier[halo] = True
+            halo_budget -= halo.numel()
+
+        # sorted node ids keep the variables first and the root node last
+        subset = (in_cluster | is_root).nonzero().view(-1)
+        edge_index, edge_attr = subgraph(subset, data.edge_index, data.edge_attr, relabel_nodes=True, num_nodes=num_nodes)
+        cluster = Data(x=data.x[subset], edge_index=edge_index, edge_attr=edge_attr)
+
+        sub_vars = subset[subset < num_vars]
+        if getattr(data, "n2v", None) is not None:
+            cluster.n2v = data.n2v[sub_vars]
+        if getattr(data, "y", None) is not None:
+            cluster.y = torch.where(owned[sub_vars], data.y[sub_vars], torch.full_like(data.y[sub_vars], 2))
+        clusters.append(cluster)
+
+    return clusters
+
+
+def split_oversized(batch, max_nodes, halo_hops=1):
+    """
+    Micro-batches for training within a node budget: a batch without graphs over
+    max_nodes nodes is returned as is, otherwise its smaller graphs are batched
+    together and every larger graph is split into clusters (cluster_graphs),
+    one micro-batch each.
+    """
+    if not max_nodes or int(batch.ptr.diff().max()) <= max_nodes:
+        return [batch]
+
+    small = []
+    parts = []
+    for data in batch.to_data_list():
+        if data.num_nodes <= max_nodes:
+            small.append(data)
+        else:
+            parts += [Batch.from_data_list([cluster]) for cluster in cluster_graphs(data, max_nodes, halo_hops)]
+
+    if len(small) > 0:
+        parts.insert(0, Batch.from_data_list(small))
+    return parts
@@ -1,75 +1,277 @@
 import gc
 import os
-import tarfile
 import time
 
+import numpy as np
 import torch
 from torch.cuda.amp import autocast
+from torch_geometric.data import Batch, Data
 from tqdm import *
 
 from data import *
-from gt_model import GTModel
+from gt_model import GTModel, load_gt_model
 from mamba_model import NeuroBackMamba
+from quantize import prepare_cpu_model, autocast_context
+from export import CompiledGTModel, checkpoint_hash, onnx_model_dir
+from ort_backend import OrtGTModel
+from layerwise import LayerwiseGTModel, DEFAULT_MEMORY_BUDGET, full_graph_bytes
+from mamba_stream import StreamingNeuroBackMamba, DEFAULT_CHUNK_SIZE
+from prediction_io import SUFFIX, append_record, confident, export_text, merge_predictions, split_pt_file, write_predictions
+from tiered import DEFAULT_EXACT_VARS, DEFAULT_FEATURE_VARS, TIER_SCORES, TIERS, tier_of
 
 # MODEL = "mamba"
 MODEL = "neuroback"
 
-def predict_single(pt_dir_path, pt_file, model_path, res_dir_path, is_cuda=True):
+# precision of CPU inference, see quantize.PRECISIONS
+PRECISION = "fp32"
+
+# "eager" runs the PyTorch model, "compiled" the TorchScript artifacts of export.py,
+# "onnx" the ONNX Runtime CPU backend over the models of export.py --onnx (neuroback only)
+BACKEND = "eager"
+
+# ONNX Runtime intra-op threads, 0 lets ORT pick one per physical core
+ORT_THREADS = 0
+
+# CPU graphs whose full-graph forward is estimated above this many bytes
+# are predicted with the memory-bounded layer-wise engine instead
+MEMORY_BUDGET = DEFAULT_MEMORY_BUDGET
+
+# on CPU, mamba graphs with more nodes are streamed through the model in chunks of this many nodes
+MAMBA_CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+
+# components with at most this many variables skip the model: their exact backbone is
+# enumerated, or (up to FEATURE_VARS variables) a structural polarity model scores them, see tiered.py
+EXACT_VARS = DEFAULT_EXACT_VARS
+FEATURE_VARS = DEFAULT_FEATURE_VARS
+
+# scores in the prediction files, np.float16 halves them
+SCORE_DTYPE = np.float32
+
+# merged predictions only keep the variables with scores outside (1 - BAND_CFD, BAND_CFD),
+# those the solver uses with --neuroback_cfd=BAND_CFD or higher; None keeps them all
+BAND_CFD = None
+
+# consecutive graphs are predicted in one forward while they fit in these budgets,
+# larger graphs are predicted alone
+BATCH_NODES = 1 << 18
+BATCH_EDGES = 1 << 22
+
+# checkpoints of the two models
+GT_MODEL_PATH = "./best_model/pretrain-best2.ptg"
+MAMBA_MODEL_PATH = "./models/mamba_pretrain/pretrain-best.ptg"
+
+
+class Predictor:
+    """
+    Loads the model (MODEL, BACKEND) once and predicts the variable scores of
+    many graphs, on the GPU or on CPU in the given precision. On CPU, graphs too
+    large for a full-graph forward go through the memory-bounded engines
+    (LayerwiseGTModel, StreamingNeuroBackMamba), which share the loaded weights.
+    checkpoint_path replaces the checkpoint of MODEL, e.g. with a distilled student.
+    Components small enough for the cheap tiers of tiered.py (EXACT_VARS,
+    FEATURE_VARS) are scored without the model.
+    """
+    def __init__(self, is_cuda=True, precision=PRECISION, memory_budget=None, checkpoint_path=None):
+        self.is_cuda = is_cuda
+        self.precision = precision if not is_cuda else "fp32"
+        self.memory_budget = memory_budget
+        self._streaming = None
+        self.exact_vars = EXACT_VARS
+        self.feature_vars = FEATURE_VARS
+        # components and seconds of every tier
+        self.tier_stats = {tier: {"components": 0, "seconds": 0.0} for tier in TIERS}
+        checkpoint_path = checkpoint_path or (MAMBA_MODEL_PATH if MODEL == "mamba" else GT_MODEL_PATH)
+
+        if MODEL == "mamba":
+            model = NeuroBackMamba(
+                input_dim=1,
+                hidden_dim=64,
+                num_layers=12,
+                dropout=0.1
+            )
+            checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+            model.load_state_dict(checkpoint["model_state_dict"])
+        elif BACKEND == "compiled":
+            model = CompiledGTModel(checkpoint_path, device="cuda" if is_cuda else "cpu")
+        elif BACKEND == "onnx":
+            model = OrtGTModel(onnx_model_dir(checkpoint_path), intra_op_threads=ORT_THREADS,
+                               checkpoint_path=checkpoint_path)
+            self.is_cuda = False
+        else:
+            model = load_gt_model(checkpoint_path)
+
+        # what the scores depend on, e.g. to cache them
+        self.model_key = f"{MODEL}-{BACKEND}-{self.precision}-{checkpoint_hash(checkpoint_path)}"
+        if self.exact_vars > 0 or self.feature_vars > 0:
+            self.model_key += f"-tiers{self.exact_vars}-{self.feature_vars}"
+
+        # fp32 eager model for the memory-bounded engines, and the model of the common path
+        self.model = model
+        self.run_model = model
+        if isinstance(model, torch.nn.Module):
+            if self.is_cuda:
+                self.run_model = model.cuda().eval()
+            else:
+                self.model = model.eval()
+                self.run_model = prepare_cpu_model(model, self.precision)
+
+    def _model_for(self, data):
+        if self.is_cuda:
+            return self.run_model, autocast_context("fp32")
+
+        if isinstance(self.model, GTModel) and self.memory_budget is not None and \
+            full_graph_bytes(data.num_nodes, data.num_edges, self.model.mlp1.in_features) > self.memory_budget:
+            return LayerwiseGTModel(self.model, memory_budget=self.memory_budget), autocast_context("fp32")
+
+        if isinstance(self.model, NeuroBackMamba) and data.num_nodes > MAMBA_CHUNK_SIZE:
+            if self._streaming is None:
+                self._streaming = StreamingNeuroBackMamba(self.model, chunk_size=MAMBA_CHUNK_SIZE)
+            return self._streaming, autocast_context("fp32")
+
+        return self.run_model, autocast_context(self.precision)
+
+    def _forward(self, data):
+        model, precision_ctx = self._model_for(data)
+
+        with torch.no_grad():
+            with precision_ctx:
+                if MODEL == "mamba":
+                    batch = getattr(data, "batch", None)
+                    if batch is None:
+                        batch = torch.zeros(data.x.size(0), dtype=torch.long, device=data.x.device)
+                    logits = model(data.x, data.edge_index, data.edge_attr, batch,
+                                   getattr(data, "node_order_index", None), getattr(data, "node_order_inv_index", None))
+                    pred = torch.sigmoid(logits)
+                elif isinstance(model, OrtGTModel):
+                    pred = torch.from_numpy(model(data.x.numpy(), data.edge_index.numpy(), data.edge_attr.numpy()))
+                else:
+                    pred = model(data.x, data.edge_index, data.edge_attr)
+
+        return pred.float().view(-1).cpu()
+
+    def predict(self, data):
+        # scores of the variable nodes of a graph, aligned with data.n2v, on CPU
+        data = data.cuda() if self.is_cuda else data.cpu()
+        return self._forward(data)[:data.n2v.numel()]
+
+    def tier(self, data):
+        return tier_of(data, self.exact_vars, self.feature_vars)
+
+    def _count(self, tier, components, seconds):
+        self.tier_stats[tier]["components"] += components
+        self.tier_stats[tier]["seconds"] += seconds
+
+    def predict_batch(self, graphs):
+        """
+        Scores of the variable nodes of every graph (as predict): the graphs of
+        the cheap tiers scored one by one, the others with predict_model_batch.
+        """
+        preds = [None] * len(graphs)
+        model_graphs = []
+        for i, data in enumerate(graphs):
+            tier = self.tier(data)
+            if tier == "gnn":
+                model_graphs.append(i)
+                continue
+
+            start = time.perf_counter()
+            preds[i] = TIER_SCORES[tier](data)
+            self._count(tier, 1, time.perf_counter() - start)
+
+        if len(model_graphs) > 0:
+            start = time.perf_counter()
+            for i, pred in zip(model_graphs, self.predict_model_batch([graphs[i] for i in model_graphs])):
+                preds[i] = pred
+            self._count("gnn", len(model_graphs), time.perf_counter() - start)
+        return preds
+
+    def predict_model_batch(self, graphs):
+        """
+        Scores of the variable nodes of every graph (as predict), with a single
+        forward over the batch of all of them. The graphs are disjoint in the
+        batch, so the scores are those of one forward per graph.
+        """
+        if len(graphs) == 1:
+            return [self.predict(graphs[0])]
+
+        # only the model inputs, so that graphs with different extra attributes can be batched
+        keys = ["x", "edge_index", "edge_attr", "n2v"]
+        if MODEL == "mamba" and all(getattr(data, "node_order_index", None) is not None for data in graphs):
+            keys += ["node_order_index", "node_order_inv_index"]
+        batch = Batch.from_data_list([Data(**{key: data[key] for key in keys}) for data in graphs])
+        batch = batch.cuda() if self.is_cuda else batch.cpu()
+
+        pred = self._forward(batch)
+        ptr = batch.ptr.tolist()
+        return [pred[ptr[i]:ptr[i] + data.n2v.numel()] for i, data in enumerate(graphs)]
+
+
+def batch_nodes(is_cuda):
+    # node budget of predict_batch, on CPU mamba batches must not be streamed
+    if MODEL == "mamba" and not is_cuda:
+        return min(BATCH_NODES, MAMBA_CHUNK_SIZE)
+    return BATCH_NODES
+
+
+def coalesce(graphs, max_nodes=BATCH_NODES, max_edges=BATCH_EDGES):
+    # groups of consecutive (name, graph) pairs within the node and edge budgets, larger graphs alone
+    group, num_nodes, num_edges = [], 0, 0
+    for name, data in graphs:
+        if len(group) > 0 and (num_nodes + data.num_nodes > max_nodes or num_edges + data.num_edges > max_edges):
+            yield group
+            group, num_nodes, num_edges = [], 0, 0
+        group.append((name, data))
+        num_nodes += data.num_nodes
+        num_edges += data.num_edges
+    if len(group) > 0:
+        yield group
+
+
+# predictors are kept per process, so that the model is only loaded once
+_predictors = {}
+
+def get_predictor(is_cuda=True, precision=PRECISION, memory_budget=None, checkpoint_path=None):
+    key = (is_cuda, precision, memory_budget, checkpoint_path)
+    if key not in _predictors:
+        _predictors[key] = Predictor(is_cuda=is_cuda, precision=precision, memory_budget=memory_budget,
+                                     checkpoint_path=checkpoint_path)
+    return _predictors[key]
+
+
+def write_res(res_dir_path, pt_file, n2v, pred):
+    # appends the prediction of a component to the prediction file of its CNF
+    cnf_file_name, component = split_pt_file(pt_file)
+    append_record(f"{res_dir_path}/{cnf_file_name}{SUFFIX}", n2v.view(-1).cpu().numpy(), pred.numpy(),
+                  component=component, score_dtype=SCORE_DTYPE)
+
+
+def load_graphs(pt_dir_path, pt_file_lst):
+    for pt_file in pt_file_lst:
+        yield pt_file, torch.load(os.path.join(pt_dir_path, pt_file), weights_only=False)
+
+
+def predict_group(group, res_dir_path, is_cuda=True, precision=PRECISION, memory_budget=None):
+    # predicts a group of (pt_file, graph) pairs of coalesce in one forward
+    preds = get_predictor(is_cuda, precision, memory_budget).predict_batch([data for _, data in group])
+    for (pt_file, data), pred in zip(group, preds):
+        write_res(res_dir_path, pt_file, data.n2v, pred)
+
+
+def predict_single(pt_dir_path, pt_file, model_path, res_dir_path, is_cuda=True, precision=PRECISION, memory_budget=None):
     data = torch.load(os.path.join(pt_dir_path, pt_file), weights_only=False)
+    predict_group([(pt_file, data)], res_dir_path, is_cuda, precision, memory_budget)
 
-    if (MODEL == "mamba"):
-        mymodel = NeuroBackMamba(
-            input_dim=1,
-            hidden_dim=64,
-            num_layers=12,
-            dropout=0.1
-        )
-        checkpoint = torch.load("./models/mamba_pretrain/pretrain-best.ptg")
-        mymodel.load_state_dict(checkpoint["model_state_dict"])
-
-    else:
-        mymodel = GTModel(3,3)
-        checkpoint = torch.load("./best_model/pretrain-best2.ptg")
-        mymodel.load_state_dict(checkpoint["model_state_dict"])
-    
-    if is_cuda:
-        data = data.cuda()
-        mymodel = mymodel.cuda()
-        clean_fn = ".".join(pt_file.split(".")[:-3])
-    else:
-        data = data.cpu()
-        mymodel = mymodel.cpu()
 
-    mymodel.eval()
+def write_perf(log_dir_path, group, mode, time_cost):
+    # one csv per graph, with its share (by node count) of the time of its group
+    num_nodes = sum(data.num_nodes for _, data in group)
+    for pt_file, data in group:
+        with open(f"{log_dir_path}/{pt_file}.csv", "w") as perf_file:
+            perf = pt_file + "," + mode + "," + str(time_cost * data.num_nodes / num_nodes) + "\n"
+            perf_file.write(perf)
 
-    batch = torch.zeros(data.x.size(0), dtype=torch.long, device=data.x.device)
 
-    with torch.no_grad():
-        if MODEL == "mamba":
-            logits = mymodel(data.x, data.edge_index, data.edge_attr, batch)
-            pred = torch.sigmoid(logits)
-        else:
-            pred = mymodel(data.x, data.edge_index, data.edge_attr)
-
-        n2v = data.n2v.cpu().numpy().tolist()
-
-        cnf_file_name = pt_file[:-3]
-        with open(res_dir_path + "/" + cnf_file_name + ".res", "w") as f:
-            for n, v in enumerate(n2v):
-                pred_score = pred[n].tolist()[0]
-                f.write(f"{v},{pred_score}\n")
-        
-        tmp = os.getcwd()
-        os.chdir(res_dir_path)
-        tar = tarfile.open(cnf_file_name + ".res.tar.gz", "w:gz")
-        tar.add(cnf_file_name + ".res")
-        tar.close()
-        os.remove(cnf_file_name + ".res")
-        
-        os.chdir(tmp)
-
-
-def predict_mix(pt_dir_path, model_path, res_dir_path):
+def predict_mix(pt_dir_path, model_path, res_dir_path, precision=PRECISION):
     if not os.path.isdir(res_dir_path):
         os.makedirs(res_dir_path)
 
@@ -88,34 +290,34 @@ def predict_mix(pt_dir_path, model_path, res_dir_path):
     if not os.path.isdir("./log/predict_mix"):
         os.makedirs("./log/predict_mix")
 
+    groups = coalesce(load_graphs(pt_dir_path, pt_file_lst), max_nodes=batch_nodes(is_cuda=True))
+
     with tqdm(total=len(pt_file_lst)) as pbar:
-        for pt_file in pt_file_lst:
-            with open(f"./log/predict_mix/{pt_file}.csv", "w") as perf_file:
-                start = time.time()
-                if mode == "cuda":
-                    try:
-                        predict_single(pt_dir_path, pt_file, model_path, res_dir_path, is_cuda=True)
-                    except Exception as e:
-                        print("Switch to CPU")
-                        mode = "cpu"
-
-                        start = time.time()
-                        predict_single(pt_dir_path, pt_file, model_path, res_dir_path, is_cuda=False)
-                else:
-                    assert(mode == "cpu")
-                    predict_single(pt_dir_path, pt_file, model_path, res_dir_path, is_cuda=False)
+        start = time.time()
+        for group in groups:
+            if mode == "cuda":
+                try:
+                    predict_group(group, res_dir_path, is_cuda=True)
+                except Exception as e:
+                    print("Switch to CPU")
+                    mode = "cpu"
+                    start = time.time()
 
-                time_cost = time.time() - start # in seconds
+            if mode == "cpu":
+                for sub_group in coalesce(group, max_nodes=batch_nodes(is_cuda=False)):
+                    predict_group(sub_group, res_dir_path, is_cuda=False, precision=precision, memory_budget=MEMORY_BUDGET)
 
-                perf = pt_file + "," + mode + "," + str(time_cost) + "\n"
-                perf_file.write(perf)
+            time_cost = time.time() - start # in seconds
 
-                pbar.update()
+            write_perf("./log/predict_mix", group, mode, time_cost)
+
+            pbar.update(len(group))
+            start = time.time()
 
         print("Done")
 
 
-def predict_cpu(pt_dir_path, model_path, res_dir_path):
+def predict_cpu(pt_dir_path, model_path, res_dir_path, precision=PRECISION):
     if not os.path.isdir(res_dir_path):
         os.makedirs(res_dir_path)
 
@@ -125,22 +327,23 @@ def predict_cpu(pt_dir_path, model_path, res_dir_path):
     if not os.path.isdir("./log/predict_cpu"):
         os.makedirs("./log/predict_cpu")
 
+    groups = coalesce(load_graphs(pt_dir_path, pt_file_lst), max_nodes=batch_nodes(is_cuda=False))
+
     with tqdm(total=len(pt_file_lst)) as pbar:
-        for pt_file in pt_file_lst:
-            with open(f"./log/predict_cpu/{pt_file}.csv", "w") as perf_file:
-                start = time.time()
-                try:
-                    predict_single(pt_dir_path, pt_file, model_path, res_dir_path, is_cuda=False)
-                except Exception as e:
-                    print(pt_file, e)
-                    break
-                    
-                time_cost = time.time() - start # in seconds
+        start = time.time()
+        for group in groups:
+            try:
+                predict_group(group, res_dir_path, is_cuda=False, precision=precision, memory_budget=MEMORY_BUDGET)
+            except Exception as e:
+                print([pt_file for pt_file, _ in group], e)
+                break
+                
+            time_cost = time.time() - start # in seconds
 
-                perf = pt_file + ",cpu," + str(time_cost) + "\n"
-                perf_file.write(perf)
+            write_perf("./log/predict_cpu", group, "cpu", time_cost)
 
-                pbar.update()
+            pbar.update(len(group))
+            start = time.time()
 
         print("Done")
 
@@ -155,72 +358,52 @@ def predict_cuda(pt_dir_path, model_path, res_dir_path):
     if not os.path.isdir("./log/predict_cuda"):
         os.makedirs("./log/predict_cuda")
 
+    groups = coalesce(load_graphs(pt_dir_path, pt_file_lst), max_nodes=batch_nodes(is_cuda=True))
+
     with tqdm(total=len(pt_file_lst)) as pbar:
-        for pt_file in pt_file_lst:
-            with open(f"./log/predict_cuda/{pt_file}.csv", "w") as perf_file:
-                start = time.time()
-                try:
-                    predict_single(pt_dir_path, pt_file, model_path, res_dir_path, is_cuda=True)
-                except Exception as e:
-                    print(pt_file, e)
-                    break
-                    
-                time_cost = time.time() - start # in seconds
+        start = time.time()
+        for group in groups:
+            try:
+                predict_group(group, res_dir_path, is_cuda=True)
+            except Exception as e:
+                print([pt_file for pt_file, _ in group], e)
+                break
+                
+            time_cost = time.time() - start # in seconds
 
-                perf = pt_file + ",cuda," + str(time_cost) + "\n"
-                perf_file.write(perf)
+            write_perf("./log/predict_cuda", group, "cuda", time_cost)
 
-                pbar.update()
+            pbar.update(len(group))
+            start = time.time()
 
         print("Done")
 
 
-def merge_wcc_preds(res_dir_path, merge_dir_path, rm_wcc_pred=False):
+def merge_wcc_preds(res_dir_path, merge_dir_path, rm_wcc_pred=False, export="tar", cfd=BAND_CFD):
+    """
+    Merges the component predictions of every CNF into {cnf_file_name}.bbp,
+    sorted by descending score, which the solver reads as they are. export="tar"
+    also writes the .res.tar.gz text archives of earlier versions, "text" the
+    uncompressed .res files, None nothing else. With cfd, only the variables
+    outside the confidence band are kept (see prediction_io.confident).
+    """
     print("merge")
     if not os.path.isdir(merge_dir_path):
         os.makedirs(merge_dir_path)
 
-    cnf2pred = {}
     for pred_fn in os.listdir(res_dir_path):
-        cnf_file_name = ".".join(pred_fn.split(".")[:-4])
-
-        if cnf_file_name not in cnf2pred:
-            cnf2pred[cnf_file_name] = []
-
-        cnf2pred[cnf_file_name].append(pred_fn)
-
-    for cnf_file_name, pred_fn_lst in cnf2pred.items():
-        backbone_lst = []
-        for pred_fn in pred_fn_lst:
-            tar_file_obj = tarfile.open(f"{res_dir_path}/{pred_fn}", "r")
-
-            # extract a file
-            res_name = ".".join(pred_fn.split(".")[:-2])
-            res_file = tar_file_obj.extractfile(res_name)
-            
-            for line in res_file.read().decode('utf-8').split("\n"):
-                line = line.strip()
-                if len(line) > 0:
-                    backbone_lst.append(line)
-
-            #close file
-            tar_file_obj.close()
-
-        backbone_lst = sorted(backbone_lst, key= lambda l: float(l.split(",")[1]), reverse=True)
-        with open(merge_dir_path + "/" + cnf_file_name + ".res", "w") as f:
-            for line in backbone_lst:
-                f.write(f"{line}\n")
-
-        tmp = os.getcwd()
-        os.chdir(merge_dir_path)
-        tar = tarfile.open(cnf_file_name + ".res.tar.gz", "w:gz")
-        tar.add(cnf_file_name + ".res")
-        tar.close()
-        os.remove(cnf_file_name + ".res")
-        
-        os.chdir(tmp)
+        if not pred_fn.endswith(SUFFIX):
+            continue
+
+        cnf_file_name = pred_fn[:-len(SUFFIX)]
+        variables, scores = merge_predictions(f"{res_dir_path}/{pred_fn}")
+        if cfd is not None:
+            variables, scores = confident(variables, scores, cfd)
+        write_predictions(f"{merge_dir_path}/{pred_fn}", variables, scores, score_dtype=SCORE_DTYPE)
+
+        if export is not None:
+            export_text(f"{merge_dir_path}/{cnf_file_name}.res", variables, scores, tar=export == "tar")
 
         if rm_wcc_pred:
-            for pred_fn in pred_fn_lst:
-                os.remove(f"{res_dir_path}/{pred_fn}")
+            os.remove(f"{res_dir_path}/{pred_fn}")
     print("done")
@@ -0,0 +1,175 @@
+import argparse
+import io
+import json
+import os
+import stat
+import sys
+import time
+
+import torch
+
+from deadline import call_before, get_deadline_predictor
+from predict import MEMORY_BUDGET, PRECISION, batch_nodes, coalesce, get_predictor
+from prediction_cache import DEFAULT_CACHE_BYTES, PREDICTION_CACHE_DIR, PredictionCache
+from prediction_io import SUFFIX, confident, encode_record, export_text, text_lines, write_predictions
+from pt_dataset import cnf_to_graphs, read_cnf
+
+
+def predict_graphs(predictor, graphs):
+    # variables and scores of the components of a formula, small components batched
+    variables = [data.n2v.view(-1).long().cpu() for data in graphs]
+    scores = []
+    for group in coalesce(enumerate(graphs), max_nodes=batch_nodes(predictor.is_cuda)):
+        scores += predictor.predict_batch([data for _, data in group])
+    if len(graphs) == 0:
+        return torch.zeros(0, dtype=torch.long), torch.zeros(0)
+    return torch.cat(variables), torch.cat(scores)
+
+
+def write_scores(output, variables, scores, binary=False, cfd=None):
+    """
+    Writes scores sorted as merge_wcc_preds does to output: an open text or
+    binary stream (e.g. the stdin of a solver process), "-" for stdout, a
+    path ending with .bbp for a prediction file, or any other path (a regular
+    file or a named pipe) for the text format of the solver. binary=True
+    writes the .bbp format to streams and pipes too, and with cfd only the
+    variables outside the confidence band are written (see prediction_io.confident).
+    """
+    if cfd is not None:
+        variables, scores = confident(variables, scores, cfd)
+
+    if output == "-":
+        output = sys.stdout
+
+    if hasattr(output, "write"):
+        if binary:
+            output = output.buffer if isinstance(output, io.TextIOBase) else output
+            output.write(encode_record(variables, scores))
+        else:
+            text = text_lines(variables, scores)
+            output.write(text if isinstance(output, io.TextIOBase) else text.encode())
+        output.flush()
+    elif output.endswith(SUFFIX):
+        write_predictions(output, variables, scores)
+    elif os.path.exists(output) and stat.S_ISFIFO(os.stat(output).st_mode):
+        with open(output, "wb" if binary else "w") as f:
+            f.write(encode_record(variables, scores) if binary else text_lines(variables, scores))
+    elif binary:
+        write_predictions(output, variables, scores)
+    else:
+        export_text(output, variables, scores)
+
+
+def predict_cnf(cnf, output=None, predictor=None, node_ordering=None, cache=None, deadline=None, binary=False, cfd=None):
+    """
+    Backbone prediction of a formula without intermediate files: parses the
+    CNF (a path, "-" for stdin, or a stream; see pt_dataset.read_cnf), splits
+    it into components, predicts them in batches and, if output is given,
+    writes the sorted scores there (see write_scores, binary and cfd are
+    passed on, the returned scores are all of them). With a PredictionCache,
+    a formula already predicted by the same model skips conversion and
+    inference.
+
+    With a deadline (seconds from the call), the scores are ready by then: the
+    components are predicted with the plan of deadline.DeadlinePredictor that
+    fits the time left after conversion, possibly only some of them.
+
+    A formula not converted in time (the timelim of pt_dataset, or the
+    deadline) raises TimeoutError, and nothing is written to output.
+
+    Returns the variables and scores by descending score, as numpy arrays, and
+    the seconds of every stage (parse, cache, graph, predict, merge, write),
+    with a deadline also the record of the plan used under "plan".
+    """
+    predictor = predictor or get_predictor(False, PRECISION, MEMORY_BUDGET)
+    # loaded (or calibrated on first use) before the clock starts
+    deadline_predictor = get_deadline_predictor(predictor) if deadline is not None else None
+    times = {}
+
+    start = time.perf_counter()
+    deadline_at = start + deadline if deadline is not None else None
+    cnf = read_cnf(cnf)
+    times["parse"] = time.perf_counter() - start
+
+    cached = None
+    if cache is not None:
+        start = time.perf_counter()
+        key = cache.key(cnf.cnf, f"{predictor.model_key}-{node_ordering}")
+        cached = cache.get(key)
+        times["cache"] = time.perf_counter() - start
+
+    if cached is not None:
+        variables, scores = cached
+    else:
+        start = time.perf_counter()
+        if deadline is None:
+            graphs = cnf_to_graphs(cnf, node_ordering)
+        else:
+            timelim = max(deadline_at - time.perf_counter(), 0)
+            graphs = call_before(deadline_at, cnf_to_graphs, cnf, node_ordering, timelim)
+            if graphs is None:
+                raise TimeoutError(f"{cnf.path} not converted within the deadline of {deadline:.3f} s")
+        times["graph"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if deadline is None:
+            variables, scores = predict_graphs(predictor, graphs)
+        else:
+            variables, scores, times["plan"] = deadline_predictor.predict(graphs, deadline_at)
+        times["predict"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        order = torch.argsort(scores, descending=True, stable=True)
+        variables, scores = variables[order].int().numpy(), scores[order].numpy()
+        times["merge"] = time.perf_counter() - start
+
+        # only predictions of the full model over all the components are cached
+        plan = times.get("plan")
+        if cache is not None and (plan is None or (plan["plan"] == "full" and plan["predicted"] == plan["components"])):
+            cache.put(key, variables, scores)
+
+    if output is not None:
+        start = time.perf_counter()
+        write_scores(output, variables, scores, binary, cfd)
+        times["write"] = time.perf_counter() - start
+
+    return variables, scores, times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="predict the backbone of a CNF formula in memory")
+    parser.add_argument('cnf', type=str, help="CNF file, plain or compressed, or - for stdin")
+    parser.add_argument('--output', type=str, default="-", help="score file (.res text or .bbp), a named pipe, or - for stdout")
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--precision', type=str, default=PRECISION)
+    parser.add_argument('--node_ordering', type=str, default=None, help="precompute the node order of NeuroBackMamba")
+    parser.add_argument('--cache_dir', type=str, default=PREDICTION_CACHE_DIR)
+    parser.add_argument('--cache_bytes', type=int, default=DEFAULT_CACHE_BYTES)
+    parser.add_argument('--no_cache', action='store_true')
+    parser.add_argument('--binary', action='store_true', help="write the .bbp format the solver also reads, whatever the output")
+    parser.add_argument('--cfd', type=float, default=None, help="only write the variables with scores outside (1 - cfd, cfd)")
+    parser.add_argument('--deadline', type=float, default=None, help="seconds to have the scores ready in, after loading the model")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    predictor = get_predictor(is_cuda=args.cuda, precision=args.precision, memory_budget=None if args.cuda else MEMORY_BUDGET)
+    if args.deadline is not None:
+        get_deadline_predictor(predictor)
+    load_time = time.perf_counter() - start
+
+    cache = None if args.no_cache else PredictionCache(args.cache_dir, args.cache_bytes)
+    try:
+        variables, _, times = predict_cnf(args.cnf, args.output, predictor, args.node_ordering, cache, args.deadline,
+                                          args.binary, args.cfd)
+    except TimeoutError as e:
+        print(json.dumps({"error": f"TimeoutError: {e}"}), file=sys.stderr)
+        exit(1)
+
+    # stage times on stderr, stdout may carry the scores
+    plan = times.pop("plan", None)
+    report = {"num_vars": len(variables), "times": dict(load_model=load_time, **times)}
+    if plan is not None:
+        report["plan"] = plan
+    if cache is not None:
+        report["cache"] = "hit" if cache.hits > 0 else "miss"
+    print(json.dumps(report), file=sys.stderr)
@@ -1,4 +1,7 @@
+import torch
+
 from predict import predict_cpu, merge_wcc_preds
+from predict_parallel import predict_cpu_parallel
 
 
 print("predict backbone on CPU")
@@ -7,6 +10,17 @@ pt_dir_path = "./data/pt/test/processed"
 model_path = "./best_model/pretrain-best.ptg"
 res_dir_path = "./prediction/cpu/wcc_predictions"
 merge_dir_path = "./prediction/cpu/cmb_predictions"
+# fp32, bf16, int8 or int8+bf16 (pick with quantize_check.py)
+precision = "fp32"
+# worker processes and intra-op threads per worker (pick with predict_parallel.py), 1 worker runs serially,
+# None threads keeps PyTorch's default (all cores) for a serial run and 1 per worker otherwise
+workers = 1
+threads = None
 
-predict_cpu(pt_dir_path, model_path, res_dir_path)
+if workers > 1:
+    predict_cpu_parallel(pt_dir_path, model_path, res_dir_path, precision=precision, workers=workers, threads=threads or 1)
+else:
+    if threads is not None:
+        torch.set_num_threads(threads)
+    predict_cpu(pt_dir_path, model_path, res_dir_path, precision=precision)
 merge_wcc_preds(res_dir_path, merge_dir_path)
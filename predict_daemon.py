@@ -0,0 +1,215 @@
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import time
+
+import numpy as np
+import torch
+from torch_geometric.data import Data
+from torch_geometric.data.data import DataEdgeAttr, DataTensorAttr
+from torch_geometric.data.storage import GlobalStorage
+
+from deadline import get_deadline_predictor
+from predict import MEMORY_BUDGET, PRECISION, get_predictor
+from predict_cnf import predict_cnf, predict_graphs, write_scores
+from prediction_cache import DEFAULT_CACHE_BYTES, PREDICTION_CACHE_DIR, PredictionCache
+
+DEFAULT_SOCKET_PATH = "/tmp/neuroback.sock"
+
+# graphs of requests are loaded with weights_only=True, so that a path or
+# payload can only hold tensors and these PyG classes, never code to run
+torch.serialization.add_safe_globals([Data, DataEdgeAttr, DataTensorAttr, GlobalStorage])
+
+# Protocol: a request is one JSON line, the response is one JSON line, both
+# possibly followed by raw bytes (payload_bytes of them). A connection can
+# carry any number of requests. Requests:
+#   {"cnf": path}                      a CNF file, plain or compressed (.xz, .gz, .bz2, .lzma),
+#                                      with "deadline_ms": ms the scores are ready within ms
+#                                      and the response has the "plan" used (deadline.py)
+#   {"pt": path or [paths]}            graphs converted by pt_dataset.py
+#   {"payload_bytes": n} + n bytes     a torch.save'd Data or list of Data
+#   {"stats": true}                    the hit/miss statistics of the prediction cache
+# with "output": path, the scores of all the variables are written there by
+# descending score, as a .bbp prediction file (prediction_io.py) if the path
+# ends with .bbp, otherwise as a solver-ready .res text file (or to a named
+# pipe); "binary": true writes the .bbp format whatever the path, and
+# "cfd": c only the variables with scores outside (1 - c, c). Without output,
+# the response carries num_vars int32 variables then num_vars float32 scores,
+# by descending score.
+# Every response has "ok", and "error" when it is false, and the stage "times".
+# CNF requests go through the prediction cache (prediction_cache.py) unless
+# the daemon runs with --no_cache.
+
+
+def remove_stale_socket(socket_path):
+    # a socket left by a daemon that is gone is removed, anything else at the path is an error
+    if not os.path.lexists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        raise FileExistsError(f"{socket_path} exists and is not a socket")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise OSError(f"a daemon is already serving on {socket_path}")
+
+
+class PredictionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if len(line.strip()) == 0:
+                continue
+
+            try:
+                response, payload = self.server.serve(json.loads(line), self.rfile)
+            except Exception as e:
+                response, payload = {"ok": False, "error": f"{type(e).__name__}: {e}"}, b""
+
+            self.wfile.write(json.dumps(response).encode() + b"\n" + payload)
+            self.wfile.flush()
+
+
+class PredictionServer(socketserver.UnixStreamServer):
+    """
+    Serves backbone predictions on a Unix socket with a model loaded once, so
+    that a solver wrapper does not pay the Python, PyTorch and checkpoint
+    start-up for every formula. Requests are served one at a time.
+    """
+    def __init__(self, socket_path, predictor, cache=None):
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, PredictionHandler)
+        self.predictor = predictor
+        self.cache = cache
+
+    def server_bind(self):
+        # only the user running the daemon can connect, whatever the umask: the socket is
+        # created with mode 0600, the chmod only makes sure of it
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+    def serve(self, request, rfile):
+        # the payload is read first, so that the stream stays in sync if the request fails
+        payload = rfile.read(request["payload_bytes"]) if "payload_bytes" in request else None
+
+        if request.get("stats"):
+            return {"ok": True, "cache": self.cache.stats() if self.cache is not None else None}, b""
+
+        if "cnf" in request:
+            deadline = request["deadline_ms"] / 1000 if "deadline_ms" in request else None
+            variables, scores, times = predict_cnf(request["cnf"], predictor=self.predictor, cache=self.cache, deadline=deadline)
+            response = {"ok": True, "num_vars": len(variables), "times": times}
+            if "plan" in times:
+                response["plan"] = times.pop("plan")
+        else:
+            times = {}
+            start = time.perf_counter()
+            if "pt" in request:
+                paths = request["pt"] if isinstance(request["pt"], list) else [request["pt"]]
+                graphs = [torch.load(path, weights_only=True) for path in paths]
+            elif payload is not None:
+                graphs = torch.load(io.BytesIO(payload), weights_only=True)
+                graphs = graphs if isinstance(graphs, list) else [graphs]
+            else:
+                raise ValueError("a request needs one of cnf, pt, payload_bytes or stats")
+            times["load"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            variables, scores = predict_graphs(self.predictor, graphs)
+            times["predict"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            order = torch.argsort(scores, descending=True, stable=True)
+            variables, scores = variables[order].int().numpy(), scores[order].numpy()
+            times["merge"] = time.perf_counter() - start
+            response = {"ok": True, "num_graphs": len(graphs), "num_vars": len(variables), "times": times}
+
+        if "output" in request:
+            start = time.perf_counter()
+            write_scores(request["output"], variables, scores, request.get("binary", False), request.get("cfd"))
+            times["write"] = time.perf_counter() - start
+            return response, b""
+
+        payload = variables.astype(np.int32).tobytes() + scores.astype(np.float32).tobytes()
+        response["payload_bytes"] = len(payload)
+        return response, payload
+
+
+def query(request, payload=b"", socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Sends one request to a running daemon. Returns the response and, when the
+    scores are not written to a file, the variables and scores as numpy arrays.
+    """
+    if len(payload) > 0:
+        request = dict(request, payload_bytes=len(payload))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(request).encode() + b"\n" + payload)
+            f.flush()
+
+            response = json.loads(f.readline())
+            if not response.get("payload_bytes"):
+                return response, None, None
+
+            data = f.read(response["payload_bytes"])
+            num_vars = response["num_vars"]
+            variables = np.frombuffer(data, dtype=np.int32, count=num_vars)
+            scores = np.frombuffer(data, dtype=np.float32, count=num_vars, offset=4 * num_vars)
+            return response, variables, scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="backbone prediction daemon on a Unix socket")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="load the model and serve predictions")
+    serve_parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET_PATH)
+    serve_parser.add_argument('--cuda', action='store_true')
+    serve_parser.add_argument('--precision', type=str, default=PRECISION)
+    serve_parser.add_argument('--cache_dir', type=str, default=PREDICTION_CACHE_DIR)
+    serve_parser.add_argument('--cache_bytes', type=int, default=DEFAULT_CACHE_BYTES)
+    serve_parser.add_argument('--no_cache', action='store_true')
+
+    query_parser = subparsers.add_parser("query", help="predict one formula with a running daemon")
+    query_parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET_PATH)
+    query_parser.add_argument('--cnf', type=str, required=True)
+    query_parser.add_argument('--output', type=str, required=True)
+    query_parser.add_argument('--binary', action='store_true')
+    query_parser.add_argument('--cfd', type=float, default=None)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        predictor = get_predictor(is_cuda=args.cuda, precision=args.precision,
+                                  memory_budget=None if args.cuda else MEMORY_BUDGET)
+        cache = None if args.no_cache else PredictionCache(args.cache_dir, args.cache_bytes)
+        # the cost model of deadline requests is loaded (or calibrated) before accepting any, not by the first of them
+        get_deadline_predictor(predictor)
+        with PredictionServer(args.socket, predictor, cache) as server:
+            print(f"serving predictions on {args.socket}", flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(args.socket)
+    else:
+        request = {"cnf": os.path.abspath(args.cnf), "output": os.path.abspath(args.output), "binary": args.binary}
+        if args.cfd is not None:
+            request["cfd"] = args.cfd
+        response, _, _ = query(request, socket_path=args.socket)
+        print(json.dumps(response))
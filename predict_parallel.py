@@ -0,0 +1,154 @@
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+import texttable as tt
+import torch
+from tqdm import tqdm
+
+import predict
+from predict import MEMORY_BUDGET, PRECISION, batch_nodes, coalesce, get_predictor, load_graphs, predict_group, write_perf
+
+# files of at most this many bytes together are one task of a worker, larger files are a task alone
+TASK_BYTES = 1 << 22
+
+
+def share_predictor(precision=PRECISION):
+    """
+    The CPU predictor of the workers, loaded once in this process with its
+    weights in shared memory. Workers are forked and find it in the predictor
+    cache of predict.py, so they do not load or copy the model.
+    """
+    if predict.BACKEND == "onnx":
+        raise ValueError("ONNX Runtime sessions cannot be shared with forked workers, use the eager or compiled backend")
+
+    predictor = get_predictor(False, precision, MEMORY_BUDGET)
+    for model in (predictor.model, predictor.run_model):
+        if isinstance(model, torch.nn.Module):
+            model.share_memory()
+    return predictor
+
+
+def make_tasks(pt_dir_path, pt_file_lst, task_bytes=TASK_BYTES):
+    # lists of files, the largest first so that the longest tasks do not start last
+    sizes = {pt_file: os.path.getsize(f"{pt_dir_path}/{pt_file}") for pt_file in pt_file_lst}
+
+    tasks, task, task_size = [], [], 0
+    for pt_file in sorted(pt_file_lst, key=lambda pt_file: -sizes[pt_file]):
+        if len(task) > 0 and task_size + sizes[pt_file] > task_bytes:
+            tasks.append(task)
+            task, task_size = [], 0
+        task.append(pt_file)
+        task_size += sizes[pt_file]
+    if len(task) > 0:
+        tasks.append(task)
+    return tasks
+
+
+def _init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def _run_task(args):
+    pt_dir_path, pt_files, res_dir_path, precision, log_dir_path = args
+
+    groups = coalesce(load_graphs(pt_dir_path, pt_files), max_nodes=batch_nodes(is_cuda=False))
+
+    start = time.time()
+    for group in groups:
+        predict_group(group, res_dir_path, is_cuda=False, precision=precision, memory_budget=MEMORY_BUDGET)
+
+        if log_dir_path is not None:
+            write_perf(log_dir_path, group, "cpu", time.time() - start)
+        start = time.time()
+
+    return len(pt_files)
+
+
+def predict_cpu_parallel(pt_dir_path, model_path, res_dir_path, precision=PRECISION, workers=None, threads=1,
+                         log_dir_path="./log/predict_cpu", quiet=False):
+    """
+    predict_cpu with workers processes of threads intra-op threads each
+    (by default one single-threaded worker per core). Every worker predicts
+    tasks of make_tasks, the largest first, batching their small graphs.
+    """
+    workers = workers or os.cpu_count()
+
+    if not os.path.isdir(res_dir_path):
+        os.makedirs(res_dir_path)
+    if log_dir_path is not None and not os.path.isdir(log_dir_path):
+        os.makedirs(log_dir_path)
+
+    pt_file_lst = list(os.listdir(pt_dir_path))
+    tasks = [(pt_dir_path, task, res_dir_path, precision, log_dir_path) for task in make_tasks(pt_dir_path, pt_file_lst)]
+
+    share_predictor(precision)
+
+    with mp.get_context("fork").Pool(workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        with tqdm(total=len(pt_file_lst), disable=quiet) as pbar:
+            for num_files in pool.imap_unordered(_run_task, tasks):
+                pbar.update(num_files)
+
+    if not quiet:
+        print("Done")
+
+
+def default_grid(cpu_count):
+    # powers of two of workers and threads using at most all the cores
+    powers = [2 ** k for k in range(cpu_count.bit_length()) if 2 ** k <= cpu_count]
+    return [(workers, threads) for workers, threads in itertools.product(powers, powers) if workers * threads <= cpu_count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="graphs/sec of parallel CPU inference over workers x threads")
+    parser.add_argument('--pt_dir_path', type=str, default="./data/pt/test/processed")
+    parser.add_argument('--precision', type=str, default=PRECISION)
+    parser.add_argument('--max_graphs', type=int, default=1000)
+    parser.add_argument('--workers', type=int, nargs="+", default=None)
+    parser.add_argument('--threads', type=int, nargs="+", default=None)
+    args = parser.parse_args()
+
+    if args.workers is None and args.threads is None:
+        grid = default_grid(os.cpu_count())
+    else:
+        grid = list(itertools.product(args.workers or [1], args.threads or [1]))
+
+    # a fixed sample of the graphs, in a directory of links so that every run predicts the same files
+    sample_dir = tempfile.mkdtemp()
+    pt_file_lst = sorted(os.listdir(args.pt_dir_path))[:args.max_graphs]
+    for pt_file in pt_file_lst:
+        os.symlink(os.path.abspath(f"{args.pt_dir_path}/{pt_file}"), f"{sample_dir}/{pt_file}")
+
+    share_predictor(args.precision)
+
+    table = tt.Texttable()
+    table.header(["workers", "threads", "time (s)", "graphs/s", "speedup"])
+
+    results = []
+    try:
+        # warm up the file cache and the workers' allocators
+        res_dir_path = tempfile.mkdtemp()
+        predict_cpu_parallel(sample_dir, None, res_dir_path, args.precision, *grid[0], log_dir_path=None, quiet=True)
+        shutil.rmtree(res_dir_path)
+
+        for workers, threads in tqdm(grid):
+            res_dir_path = tempfile.mkdtemp()
+            start = time.perf_counter()
+            predict_cpu_parallel(sample_dir, None, res_dir_path, args.precision, workers, threads, log_dir_path=None, quiet=True)
+            results.append((workers, threads, time.perf_counter() - start))
+            shutil.rmtree(res_dir_path)
+    finally:
+        shutil.rmtree(sample_dir)
+
+    base_time = results[0][2]
+    for workers, threads, seconds in results:
+        table.add_row([workers, threads, seconds, len(pt_file_lst) / seconds, base_time / seconds])
+
+    table.set_precision(2)
+    print(table.draw())
+    workers, threads, seconds = min(results, key=lambda result: result[2])
+    print(f"fastest: {workers} workers x {threads} threads ({len(pt_file_lst) / seconds:.1f} graphs/s)")
@@ -0,0 +1,129 @@
+import argparse
+import hashlib
+import os
+import re
+import time
+
+from prediction_io import SUFFIX, encode_record, read_predictions
+
+# sorted predictions of formulas already predicted, see PredictionCache
+PREDICTION_CACHE_DIR = "./cache/predictions"
+DEFAULT_CACHE_BYTES = 1 << 30
+
+COMMENT_LINE = re.compile(r"^\s*c.*$", re.MULTILINE)
+
+
+def cnf_hash(text):
+    # hash of the header and clauses of a CNF, comments and whitespace ignored
+    normalized = " ".join(COMMENT_LINE.sub("", text).split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class PredictionCache:
+    """
+    Size-bounded on-disk LRU cache of the sorted predictions of formulas, keyed
+    by the hash of the normalized CNF and of the model (Predictor.model_key).
+    Entries are .bbp files of prediction_io.py. Reading an entry refreshes its
+    modification time, and once the cache is over max_bytes the least recently
+    used entries are evicted. Processes can share a cache directory.
+    """
+    def __init__(self, cache_dir=PREDICTION_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.hit_seconds = 0.0
+        self.size = sum(size for _, _, size in self.entries())
+
+    def entries(self):
+        # path, last use and size of every entry
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, st.st_mtime, st.st_size
+
+    def key(self, cnf_text, model_key):
+        return hashlib.sha256(f"{cnf_hash(cnf_text)}-{model_key}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + SUFFIX)
+
+    def get(self, key):
+        # sorted variables and scores of an entry, None on a miss
+        start = time.perf_counter()
+        path = self.path(key)
+        try:
+            variables, scores = read_predictions(path)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.hit_seconds += time.perf_counter() - start
+        return variables, scores
+
+    def put(self, key, variables, scores):
+        path = self.path(key)
+        record = encode_record(variables, scores)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(record)
+        os.replace(tmp_path, path)
+
+        self.size += len(record)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # least recently used entries first, down to 90% of max_bytes so that evictions are not on every put
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        for path, _, _ in list(self.entries()):
+            os.remove(path)
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "mean_hit_ms": self.hit_seconds / self.hits * 1000 if self.hits > 0 else 0.0,
+            "evictions": self.evictions,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="inspect or clear the prediction cache")
+    parser.add_argument('--cache_dir', type=str, default=PREDICTION_CACHE_DIR)
+    parser.add_argument('--clear', action='store_true')
+    args = parser.parse_args()
+
+    cache = PredictionCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+    entries = list(cache.entries())
+    print(f"{len(entries)} entries, {sum(size for _, _, size in entries) / 2 ** 20:.1f} MiB in {args.cache_dir}")
@@ -0,0 +1,149 @@
+import argparse
+import os
+import struct
+import tarfile
+import zlib
+
+import numpy as np
+
+# A prediction file ({cnf_file_name}.bbp) holds one record per predicted
+# component of a CNF, appended as components finish:
+#   header: magic, component index (uint32), variable count n (uint32),
+#           score size in bytes (2: float16, 4: float32), 3 padding bytes
+#   n int32 variables, then their n scores
+# Records of a component appended again (e.g. by a rerun) replace the earlier ones.
+# The solver reads these files directly (--backbonefile, solver/src/parse.c).
+MAGIC = b"NBBP"
+HEADER = struct.Struct("<4sIIB3x")
+SCORE_DTYPES = {2: np.float16, 4: np.float32}
+SUFFIX = ".bbp"
+
+
+def split_pt_file(pt_file):
+    # CNF file name and component index of a graph file of pt_dataset.py, {cnf_file_name}.c-{i}.pt
+    cnf_file_name, component = pt_file.rsplit(".", 2)[:2]
+    try:
+        return cnf_file_name, int(component.rsplit("-", 1)[-1])
+    except ValueError:
+        return cnf_file_name, zlib.crc32(component.encode())
+
+
+def encode_record(variables, scores, component=0, score_dtype=np.float32):
+    variables = np.ascontiguousarray(variables, dtype=np.int32)
+    scores = np.ascontiguousarray(scores, dtype=score_dtype)
+    return HEADER.pack(MAGIC, component, variables.size, scores.itemsize) + variables.tobytes() + scores.tobytes()
+
+
+def append_record(path, variables, scores, component=0, score_dtype=np.float32):
+    # a single write on an O_APPEND descriptor, records of concurrent writers do not interleave
+    record = memoryview(encode_record(variables, scores, component, score_dtype))
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        while len(record) > 0:
+            record = record[os.write(fd, record):]
+    finally:
+        os.close(fd)
+
+
+def read_records(path):
+    # {component: (variables, scores)} of a prediction file
+    with open(path, "rb") as f:
+        buf = f.read()
+
+    records = {}
+    offset = 0
+    while offset < len(buf):
+        magic, component, n, score_size = HEADER.unpack_from(buf, offset)
+        if magic != MAGIC or score_size not in SCORE_DTYPES:
+            raise ValueError(f"{path}: no prediction record at byte {offset}")
+        offset += HEADER.size
+
+        variables = np.frombuffer(buf, dtype=np.int32, count=n, offset=offset)
+        offset += variables.nbytes
+        scores = np.frombuffer(buf, dtype=SCORE_DTYPES[score_size], count=n, offset=offset)
+        offset += scores.nbytes
+
+        records[component] = (variables, scores)
+    return records
+
+
+def read_predictions(path):
+    # variables and float32 scores of all the components of a CNF
+    records = list(read_records(path).values())
+    if len(records) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    variables = np.concatenate([variables for variables, _ in records])
+    scores = np.concatenate([scores.astype(np.float32) for _, scores in records])
+    return variables, scores
+
+
+def merge_predictions(path):
+    # variables and scores by descending score, the order of the merged text files
+    variables, scores = read_predictions(path)
+    order = np.argsort(-scores, kind="stable")
+    return variables[order], scores[order]
+
+
+def confident(variables, scores, cfd):
+    """
+    Only the variables with scores outside the confidence band (1 - cfd, cfd),
+    the only ones the solver uses with --neuroback_cfd=cfd or higher. Compared
+    in float64, as the solver compares them.
+    """
+    scores64 = np.asarray(scores).astype(np.float64)
+    keep = (scores64 >= cfd) | (scores64 <= 1.0 - cfd)
+    return variables[keep], scores[keep]
+
+
+def write_predictions(path, variables, scores, score_dtype=np.float32):
+    # a prediction file with a single record, replaced atomically
+    with open(path + ".tmp", "wb") as f:
+        f.write(encode_record(variables, scores, 0, score_dtype))
+    os.replace(path + ".tmp", path)
+
+
+def text_lines(variables, scores):
+    # "variable,score" lines, the text format of the solver
+    return "".join(f"{v},{score}\n" for v, score in zip(variables.tolist(), scores.astype(np.float32).tolist()))
+
+
+def export_text(res_path, variables, scores, tar=False):
+    """
+    Writes predictions in the text format of the solver ("variable,score"
+    lines), with tar=True as the {res_path}.tar.gz archive of earlier versions
+    instead. Returns the written path.
+    """
+    with open(res_path + ".tmp", "w") as f:
+        f.write(text_lines(variables, scores))
+    os.replace(res_path + ".tmp", res_path)
+
+    if not tar:
+        return res_path
+
+    with tarfile.open(res_path + ".tar.gz", "w:gz") as tar_file:
+        tar_file.add(res_path, arcname=os.path.basename(res_path))
+    os.remove(res_path)
+    return res_path + ".tar.gz"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export .bbp prediction files to the solver's text format")
+    parser.add_argument('--input', type=str, required=True, help="a .bbp file or a directory of them")
+    parser.add_argument('--output_dir', type=str, default=None, help="defaults to the directory of the input")
+    parser.add_argument('--tar', action='store_true', help="write .res.tar.gz archives instead of .res files")
+    parser.add_argument('--cfd', type=float, default=None, help="only write the variables with scores outside (1 - cfd, cfd)")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        paths = [os.path.join(args.input, fn) for fn in sorted(os.listdir(args.input)) if fn.endswith(SUFFIX)]
+    else:
+        paths = [args.input]
+
+    for path in paths:
+        output_dir = args.output_dir or os.path.dirname(path) or "."
+        os.makedirs(output_dir, exist_ok=True)
+        res_path = os.path.join(output_dir, os.path.basename(path)[:-len(SUFFIX)] + ".res")
+        variables, scores = merge_predictions(path)
+        if args.cfd is not None:
+            variables, scores = confident(variables, scores, args.cfd)
+        print(export_text(res_path, variables, scores, tar=args.tar))
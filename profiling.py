@@ -0,0 +1,178 @@
+import json
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import psutil
+import torch
+
+# timing records kept before the CUDA events are read, reading them synchronizes once
+FLUSH_EVERY = 4096
+
+
+def size_bucket(num_nodes, num_graphs):
+    # graphs with 10^k to 10^(k+1) nodes on average are in bucket "1e{k}"
+    return f"1e{int(math.log10(max(num_nodes / max(num_graphs, 1), 1)))}"
+
+
+class StageTimer:
+    """
+    Always-on timers of the stages of a training loop (load, h2d, forward,
+    backward, optimizer, ...), the throughput of every graph-size bucket and the
+    peak memory of an epoch: allocated CUDA memory, or on CPU the RSS of the
+    process sampled at the end of every step.
+
+    On CUDA the stages are timed with events that are only read every
+    FLUSH_EVERY records and at summary(), so timing does not synchronize the
+    device inside a step. Waiting for the loader is host time (iterate()).
+    Stages are also torch.profiler ranges, they show up in the trace_profiler traces.
+    """
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == "cuda"
+        self._process = psutil.Process()
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        # graphs, nodes, labeled variables and seconds of every size bucket
+        self.buckets = defaultdict(lambda: [0, 0, 0, 0.0])
+        self._stages = []
+        self._steps = []
+        self._step_start = None
+        self._peak_rss = 0
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def _now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        return start.elapsed_time(end) / 1000 if self.cuda else end - start
+
+    def iterate(self, loader):
+        # the batches of a loader, the time waiting for each one is the "load" stage
+        it = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self.totals["load"] += time.perf_counter() - start
+            self.counts["load"] += 1
+            yield batch
+
+    @contextmanager
+    def stage(self, name):
+        with torch.profiler.record_function(name):
+            start = self._now()
+            yield
+            self._stages.append((name, start, self._now()))
+        if len(self._stages) >= FLUSH_EVERY:
+            self.flush()
+
+    def step_begin(self):
+        self._step_start = self._now()
+
+    def step_end(self, num_graphs, num_nodes, num_vars):
+        # one training step on num_graphs graphs, num_nodes nodes and num_vars labeled variables
+        self._steps.append((size_bucket(num_nodes, num_graphs), num_graphs, num_nodes, num_vars, self._step_start, self._now()))
+        if not self.cuda:
+            self._peak_rss = max(self._peak_rss, self._process.memory_info().rss)
+        if len(self._steps) >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+        for name, start, end in self._stages:
+            self.totals[name] += self._elapsed(start, end)
+            self.counts[name] += 1
+        for bucket, num_graphs, num_nodes, num_vars, start, end in self._steps:
+            stats = self.buckets[bucket]
+            stats[0] += num_graphs
+            stats[1] += num_nodes
+            stats[2] += num_vars
+            stats[3] += self._elapsed(start, end)
+
+        self._stages = []
+        self._steps = []
+
+    def peak_memory(self):
+        # peak allocated CUDA memory of the epoch, or on CPU the largest RSS sampled during the epoch
+        # (ru_maxrss would be the peak of the whole process, earlier epochs included)
+        if self.cuda:
+            return torch.cuda.max_memory_allocated()
+        return max(self._peak_rss, self._process.memory_info().rss)
+
+    def summary(self):
+        self.flush()
+        total = sum(self.totals.values())
+
+        stages = {}
+        for name, seconds in self.totals.items():
+            stages[name] = {
+                "seconds": seconds,
+                "calls": self.counts[name],
+                "mean_ms": seconds / self.counts[name] * 1000,
+                "share": seconds / total if total > 0 else 0.0,
+            }
+
+        buckets = {}
+        for bucket, (num_graphs, num_nodes, num_vars, seconds) in sorted(self.buckets.items()):
+            buckets[bucket] = {
+                "graphs": num_graphs,
+                "nodes": num_nodes,
+                "labeled_vars": num_vars,
+                "seconds": seconds,
+                "nodes_per_s": num_nodes / seconds if seconds > 0 else 0.0,
+                "labeled_vars_per_s": num_vars / seconds if seconds > 0 else 0.0,
+            }
+
+        return {
+            "stages": stages,
+            "buckets": buckets,
+            "peak_memory_bytes": self.peak_memory(),
+            "peak_memory_device": "cuda" if self.cuda else "cpu",
+        }
+
+    def write(self, path, **extra):
+        summary = dict(extra, **self.summary())
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def stage_line(summary):
+    # one line of the stage shares for the text logs
+    stages = sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"])
+    return " ".join(f"{name}={stats['seconds']:.1f}s({stats['share'] * 100:.0f}%)" for name, stats in stages)
+
+
+def trace_profiler(trace_dir, start, steps, device):
+    """
+    torch.profiler over the steps [start, start + steps) of a loop that calls
+    step() after every step, the trace is exported to trace_dir for TensorBoard
+    or chrome://tracing. None if steps is 0.
+    """
+    if not steps:
+        return None
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.device(device).type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=steps, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+        profile_memory=True,
+    )
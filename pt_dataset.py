@@ -13,6 +13,8 @@ import torch
 from torch_geometric.data import Data
 from tqdm import tqdm
 
+from node_order import add_node_order
+
 OPENER = {
     ".xz": lzma.open,
     ".lzma": lzma.open,
@@ -84,26 +86,28 @@ class DisJointSets:
         return False
 
 def cnf_to_pt_bipartite(_cnf: CNF, _backbone: BackBone, timelim=1000):
+    # _backbone is None for formulas to predict, their graphs have no y
     start_time = time.time()
    
     backbone = set()
-    for line in _backbone.bb.splitlines():
-        line = line.strip()
-        if len(line) > 0:
-            lit = int(line.split()[-1])
-            if lit != 0:
-                backbone.add(lit)
-
-        if len(backbone) == 0:
-            print(f"warning: no backbone in the data: {_backbone.path}")
-            return None, None
+    if _backbone is not None:
+        for line in _backbone.bb.splitlines():
+            line = line.strip()
+            if len(line) > 0:
+                lit = int(line.split()[-1])
+                if lit != 0:
+                    backbone.add(lit)
+
+            if len(backbone) == 0:
+                print(f"warning: no backbone in the data: {_backbone.path}", file=sys.stderr)
+                return None, None
 
     X = []
     v2n = {}
     var_num = 0
     for line in _cnf.cnf.splitlines():
         if time.time() - start_time > timelim:
-            print("warning: timeout while reading cnf")
+            print("warning: timeout while reading cnf", file=sys.stderr)
             return None, None
 
         line = line.strip()
@@ -125,7 +129,7 @@ def cnf_to_pt_bipartite(_cnf: CNF, _backbone: BackBone, timelim=1000):
 
     # backbone
     y = []
-    if _backbone.bb is not None:
+    if _backbone is not None and _backbone.bb is not None:
         y = [2 for _ in range(var_num)]
         for var, node_id in v2n.items():
             if var in backbone:
@@ -141,7 +145,7 @@ def cnf_to_pt_bipartite(_cnf: CNF, _backbone: BackBone, timelim=1000):
     edge_attr = []
     for line in _cnf.cnf.splitlines():
         if time.time() - start_time > timelim:
-            print(f"warning: timeout while reading cnf: {_cnf.path}")
+            print(f"warning: timeout while reading cnf: {_cnf.path}", file=sys.stderr)
             return None, None
 
         line = line.strip()
@@ -176,14 +180,14 @@ def cnf_to_pt_bipartite(_cnf: CNF, _backbone: BackBone, timelim=1000):
     assert(len(edge_index) == len(edge_attr))
 
     if len(y) > 0 and 0 not in y and 1 not in y:
-        print(f"warning: no backbone in the data: {_backbone.path}", flush=True)
+        print(f"warning: no backbone in the data: {_backbone.path}", file=sys.stderr, flush=True)
         return None, None
 
     wcc = None
     ds = DisJointSets(len(X))
     for idx, edge in enumerate(edge_index):
         if time.time() - start_time > timelim:
-            print("warning: timeout while constructing disjoint sets")
+            print("warning: timeout while constructing disjoint sets", file=sys.stderr)
             return None, None
 
         from_node, to_node = edge[0], edge[1]
@@ -192,7 +196,7 @@ def cnf_to_pt_bipartite(_cnf: CNF, _backbone: BackBone, timelim=1000):
     assert(len(wcc) > 0 and len(wcc_edges) > 0)
 
     if time.time() - start_time > timelim:
-        print("warning: timeout after solving wcc")
+        print("warning: timeout after solving wcc", file=sys.stderr)
         return None, None
 
     data_lst = []
@@ -226,7 +230,7 @@ def cnf_to_pt_bipartite(_cnf: CNF, _backbone: BackBone, timelim=1000):
     else:
         for root, c in wcc.items():
             if time.time() - start_time > timelim:
-                print("warning: timeout while enumerating wcc")
+                print("warning: timeout while enumerating wcc", file=sys.stderr)
                 return None, None
 
             if len(c) == 1:
@@ -263,7 +267,7 @@ def cnf_to_pt_bipartite(_cnf: CNF, _backbone: BackBone, timelim=1000):
             edges = wcc_edges[root]
             for edge in edges:
                 if edge[0] not in old_n2new_n or edge[1] not in old_n2new_n:
-                    print("BUG:", _cnf.path)
+                    print("BUG:", _cnf.path, file=sys.stderr)
 
                 assert(edge[0] in old_n2new_n and edge[1] in old_n2new_n)
                 node_a = old_n2new_n[edge[0]]
@@ -316,21 +320,50 @@ def get_cnf_and_backbone(cnf_path: Path):
 
     return cnf, backbone
 
-def worker_save_dataset(cnf_dir, target_dir):
+def read_cnf(cnf_path):
+    # a CNF file, plain or compressed, "-" for stdin, or an open text or binary stream
+    if cnf_path == "-":
+        return CNF(sys.stdin.read(), Path("<stdin>"))
+    if hasattr(cnf_path, "read"):
+        text = cnf_path.read()
+        return CNF(text.decode("utf-8") if isinstance(text, bytes) else text, Path(getattr(cnf_path, "name", "<stream>")))
+
+    cnf_path = Path(cnf_path)
+    opener = OPENER.get(cnf_path.suffix, open)
+    with opener(cnf_path, mode="rt", encoding="utf-8") as file:
+        return CNF(file.read(), cnf_path)
+
+def finalize_graph(data, node_ordering=None):
+    # undirected graph with float features, as the models read it
+    reverse = data.edge_index.index_select(0, torch.LongTensor([1, 0]))
+    data.edge_index = torch.cat([data.edge_index, reverse], dim=1)
+    data.edge_attr = torch.cat([data.edge_attr, data.edge_attr], dim=0)
+
+    data.x = data.x.float()
+    data.edge_index = data.edge_index.long()
+    data.edge_attr = data.edge_attr.float()
+
+    if data.y != None:
+        data.y = data.y.long()
+
+    if node_ordering is not None:
+        add_node_order(data, node_ordering)
+    return data
+
+def cnf_to_graphs(cnf: CNF, node_ordering=None, timelim=1000):
+    # model-ready graphs of the connected components of a formula, without backbone labels
+    data_list, _ = cnf_to_pt_bipartite(cnf, None, timelim=timelim)
+    if data_list is None:
+        # without a backbone to check, only a timeout leaves no data list
+        raise TimeoutError(f"{cnf.path} not converted within {timelim:.3f} s")
+    return [finalize_graph(data, node_ordering) for data in data_list]
+
+def worker_save_dataset(cnf_dir, target_dir, node_ordering=None):
     cnf, backbone = get_cnf_and_backbone(cnf_dir)
     data_list, _ = cnf_to_pt_bipartite(cnf, backbone)
     
     for i, data in enumerate(data_list):
-        reverse = data.edge_index.index_select(0, torch.LongTensor([1, 0]))
-        data.edge_index = torch.cat([data.edge_index, reverse], dim=1)
-        data.edge_attr = torch.cat([data.edge_attr, data.edge_attr], dim=0)
-		
-        data.x = data.x.float()
-        data.edge_index = data.edge_index.long()
-        data.edge_attr = data.edge_attr.float()
-
-        if data.y != None:
-            data.y = data.y.long()
+        finalize_graph(data, node_ordering)
 
         name = f"{cnf_dir.name}.c-{i}.pt"
         save_path = target_dir / name
@@ -338,10 +371,10 @@ def worker_save_dataset(cnf_dir, target_dir):
 
     return f"{cnf_dir.name}, {len(data_list)}"
 
-def save_dataset(root_dir, target_dir, n_cpu, log_dir):
+def save_dataset(root_dir, target_dir, n_cpu, log_dir, node_ordering=None):
 
     cnf_dir_list = [p for p in root_dir.iterdir() if p.is_file()]
-    preconf_worker = partial(worker_save_dataset, target_dir=target_dir)
+    preconf_worker = partial(worker_save_dataset, target_dir=target_dir, node_ordering=node_ordering)
 
     with open(log_dir, "w") as f:
         f.write("name,n_data_list" + "\n")
@@ -358,6 +391,9 @@ def save_dataset(root_dir, target_dir, n_cpu, log_dir):
 if __name__ == '__main__':
     TARGET_DIR = Path("./data") 
 
+    # node ordering stored with every graph for NeuroBackMamba: None, "degree", "bfs" or "interleave"
+    NODE_ORDERING = None
+
     if TARGET_DIR.exists():
         shutil.rmtree(TARGET_DIR)
 
@@ -379,7 +415,7 @@ if __name__ == '__main__':
     # scans = [(TRAIN_DIR, s1), (VAL_DIR, s2), (TEST_DIR, s3)]
     scans = [(TEST_DIR, s3)]
     for source_path, scan in scans:
-        save_dataset(scan[0], source_path, 14, scan[1])
+        save_dataset(scan[0], source_path, 14, scan[1], NODE_ORDERING)
 
     # import pandas as pd
     # df = pd.read_csv("./pretrain_scan.csv")
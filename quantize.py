@@ -0,0 +1,50 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+# CPU inference precisions:
+#   fp32      - eager model as trained
+#   bf16      - bfloat16 autocast over the whole forward (message passing included)
+#   int8      - dynamic int8 quantization of the nn.Linear layers
+#               (RGINConv MLPs, GTBlock/DTBlock MLPs, qkv projection and head)
+#   int8+bf16 - both of the above
+PRECISIONS = ["fp32", "bf16", "int8", "int8+bf16"]
+
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision: {precision}, expected one of {PRECISIONS}")
+
+
+# nn.Linear layers kept in fp32 by quantize_model: the selective scan of
+# mamba_cpu.py reads the weight and bias of dt_proj as tensors
+FP32_LINEARS = ["dt_proj"]
+
+
+def quantize_model(model):
+    # MultiheadAttention.out_proj is a NonDynamicallyQuantizableLinear and is
+    # deliberately left out by quantize_dynamic, the GATv2 projections are PyG
+    # Linear layers and stay in fp32 (or bf16 under autocast)
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig
+                    for name, module in model.named_modules()
+                    if type(module) is nn.Linear and name.split(".")[-1] not in FP32_LINEARS}
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+def prepare_cpu_model(model, precision="fp32"):
+    check_precision(precision)
+
+    model = model.cpu()
+    model.eval()
+    if precision in ("int8", "int8+bf16"):
+        model = quantize_model(model)
+    return model
+
+
+def autocast_context(precision="fp32"):
+    check_precision(precision)
+
+    if precision in ("bf16", "int8+bf16"):
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
@@ -0,0 +1,96 @@
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+from sklearn.metrics import f1_score
+import texttable as tt
+from tqdm import tqdm
+
+from data import MyOwnDataset
+from gt_model import load_gt_model
+from quantize import PRECISIONS, prepare_cpu_model, autocast_context
+
+
+def run_mode(model, dataset, precision, max_graphs):
+    model = prepare_cpu_model(copy.deepcopy(model), precision)
+
+    all_target = []
+    all_pred_class = []
+    all_pred = []
+    times = []
+
+    with torch.no_grad():
+        for idx in tqdm(range(min(len(dataset), max_graphs)), desc=precision):
+            data = dataset[idx]
+            if data.y is None:
+                continue
+
+            start = time.perf_counter()
+            with autocast_context(precision):
+                pred = model(data.x, data.edge_index, data.edge_attr)
+            pred = pred.float()
+            times.append(time.perf_counter() - start)
+
+            y01_indices = (data.y != 2).nonzero(as_tuple=True)
+            y01 = data.y[y01_indices]
+            pred = pred[y01_indices].flatten()
+
+            all_target.append(y01.numpy())
+            all_pred.append(pred.numpy())
+            all_pred_class.append((pred >= 0.5).int().numpy())
+
+    all_target = np.concatenate(all_target)
+    all_pred = np.concatenate(all_pred)
+    all_pred_class = np.concatenate(all_pred_class)
+
+    # same metric as learn.evaluate()
+    f1 = f1_score(all_target, all_pred_class, average='micro')
+    return f1, all_pred, np.array(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare CPU inference precisions against fp32 on the validation split")
+    parser.add_argument('--model_path', type=str, default="./best_model/pretrain-best2.ptg")
+    parser.add_argument('--dataset_path', type=str, default="./data/pt/validation")
+    parser.add_argument('--max_graphs', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.005, help="max allowed F1 drop w.r.t. fp32")
+    parser.add_argument('--modes', type=str, nargs="+", default=PRECISIONS)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model = load_gt_model(args.model_path)
+    model.eval()
+
+    dataset = MyOwnDataset(root=args.dataset_path)
+
+    ref_f1, ref_pred, ref_times = run_mode(model, dataset, "fp32", args.max_graphs)
+
+    table = tt.Texttable()
+    table.header(["mode", "f1", "f1 delta", "max |score diff|", "flip rate", "median speedup", "total time (s)"])
+    table.add_row(["fp32", ref_f1, 0.0, 0.0, 0.0, 1.0, ref_times.sum()])
+
+    best_mode = "fp32"
+    best_time = ref_times.sum()
+    for mode in args.modes:
+        if mode == "fp32":
+            continue
+
+        f1, pred, times = run_mode(model, dataset, mode, args.max_graphs)
+        delta = f1 - ref_f1
+        flip = np.mean((pred >= 0.5) != (ref_pred >= 0.5))
+        speedup = np.median(ref_times / times)
+
+        table.add_row([mode, f1, delta, np.abs(pred - ref_pred).max(), flip, speedup, times.sum()])
+
+        if -delta <= args.tolerance and times.sum() < best_time:
+            best_mode = mode
+            best_time = times.sum()
+
+    table.set_precision(4)
+    print(table.draw())
+    print(f"fastest mode within tolerance {args.tolerance}: {best_mode}")
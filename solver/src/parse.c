@@ -7,6 +7,8 @@
 #include "random.h"
 
 #include <ctype.h>
+#include <math.h>
+#include <stdio.h>
 #include <string.h>
 #include <inttypes.h>
 
@@ -425,165 +427,258 @@ void kissat_random_phase_initial(kissat * solver) {
       
 }
 
-void
-kissat_parse_backbone (kissat * solver, file * file, double neuralback_cfd) {
-  
-	if(GET_OPTION(neural_backbone_initial)) {
-		value* initial_phase_list = solver->phases.initial;
-		const value initial_phase = INITIAL_PHASE;
-		for (all_phases (initial, p))
-			*p = initial_phase;
-
-		unsigned applied = 0;
-
-		char line[128];
-		while (fgets(line, sizeof line, file->file)) {
-			char *p = line;
-			while (*p == ' ' || *p == '\t') p++;
-			if (!*p || *p == '\n' || *p == '\r') continue;
-
-			// Try CSV format first (with confidence scores)
-			if (strchr(p, ',')) {
-				int eidx; double score;
-				if (sscanf(p, "%d , %lf", &eidx, &score) == 2) {
-					if (eidx > 0 && (size_t)eidx < SIZE_STACK(solver->import)) {
-						import *import = &PEEK_STACK (solver->import, eidx);
-						if(score >= neuralback_cfd) {
-							initial_phase_list[IDX (import->lit)] = -1;
-							applied++;
-						} else if(score <= 1.0 - neuralback_cfd) {
-							initial_phase_list[IDX (import->lit)] = 1;
-							applied++;
-						}
-					}
-				}
-				continue;
-			}
-
-			// Fall back to simple format (signed literals)
-			int eidx = 0, sign = 1;
-			if (*p == 'b' || *p == 'B') {
-				p++;
-				while (*p == ' ' || *p == '\t') p++;
-			}
-			if (*p == '-' || *p == '+') {
-				if (*p == '-') sign = -1;
-				p++;
-			}
-			if (sscanf(p, "%d", &eidx) == 1 && eidx > 0) {
-				if ((size_t)eidx < SIZE_STACK(solver->import)) {
-					import *import = &PEEK_STACK (solver->import, eidx);
-						initial_phase_list[IDX (import->lit)] = sign;
-						applied++;
-				}
-			}
-		}
+// One variable of a backbone file: its external index, the phase to give it
+// (0 for none) and, for lines 'idx,score' and binary files, its score.
+
+typedef struct backbone_entry backbone_entry;
+
+struct backbone_entry
+{
+  int eidx;
+  int sign;
+  bool scored;
+  double score;
+};
+
+typedef STACK (backbone_entry) backbone_entries;
+
+// Binary backbone files are the '.bbp' prediction files of 'prediction_io.py':
+// records of a 16 byte little endian header (magic "NBBP", component, n, score
+// size 2 or 4, 3 padding bytes), n int32 variables, then n float16 or float32
+// scores.
+
+#define BACKBONE_MAGIC "NBBP"
+#define BACKBONE_HEADER 16
+
+static uint32_t
+read_u32 (const unsigned char *p)
+{
+  return (uint32_t) p[0] | (uint32_t) p[1] << 8 |
+    (uint32_t) p[2] << 16 | (uint32_t) p[3] << 24;
+}
+
+static double
+read_score (const unsigned char *p, unsigned size)
+{
+  if (size == 4)
+    {
+      const uint32_t bits = read_u32 (p);
+      float score;
+      memcpy (&score, &bits, sizeof score);
+      return score;
+    }
+  const unsigned bits = (unsigned) p[0] | (unsigned) p[1] << 8;
+  const unsigned exponent = (bits >> 10) & 0x1f, mantissa = bits & 0x3ff;
+  double score;
+  if (!exponent)
+    score = ldexp (mantissa, -24);
+  else if (exponent == 0x1f)
+    score = mantissa ? NAN : INFINITY;
+  else
+    score = ldexp (mantissa | 0x400, (int) exponent - 25);
+  return (bits & 0x8000) ? -score : score;
+}
+
+static int
+score_sign (double score, double cfd)
+{
+  if (score >= cfd)
+    return -1;
+  if (score <= 1.0 - cfd)
+    return 1;
+  return 0;
+}
+
+static void
+parse_binary_backbone (kissat * solver, const unsigned char *p,
+		       const unsigned char *end, double cfd,
+		       backbone_entries * entries)
+{
+  while (end - p >= BACKBONE_HEADER
+	 && !memcmp (p, BACKBONE_MAGIC, 4))
+    {
+      const size_t n = read_u32 (p + 8);
+      const unsigned size = p[12];
+      p += BACKBONE_HEADER;
+      if ((size != 2 && size != 4)
+	  || (size_t) (end - p) / (4 + size) < n)
+	break;
+      const unsigned char *scores = p + 4 * n;
+      for (size_t i = 0; i < n; i++)
+	{
+	  backbone_entry entry;
+	  entry.eidx = (int) read_u32 (p + 4 * i);
+	  entry.scored = true;
+	  entry.score = read_score (scores + size * i, size);
+	  entry.sign = score_sign (entry.score, cfd);
+	  if (entry.eidx > 0)
+	    PUSH_STACK (*entries, entry);
 	}
+      p = scores + size * n;
+    }
+}
+
+// Text backbone files have one 'idx,score' or signed literal ('[b] [-]idx')
+// per line.
+
+static void
+parse_text_backbone (kissat * solver, char *p, char *end,
+		     backbone_entries * entries)
+{
+  while (p < end)
+    {
+      char *eol = memchr (p, '\n', end - p);
+      if (!eol)
+	eol = end;
+      *eol = 0;
 
-	if(GET_OPTION(neural_backbone_prioritize)) {
-		rewind(file->file);
-		value* initial_phase_list = solver->phases.initial;
-		const value initial_phase = INITIAL_PHASE;
-		for (all_phases (initial, p))
-			*p = initial_phase;
-
-		unsigned applied = 0;
-
-		char line[128];
-		while (fgets(line, sizeof line, file->file)) {
-			char *p = line;
-			while (*p == ' ' || *p == '\t') p++;
-			if (!*p || *p == '\n' || *p == '\r') continue;
-
-			if (strchr(p, ',')) {
-				int eidx; double score;
-			if (sscanf(p, "%d , %lf", &eidx, &score) == 2) {
-					if (eidx > 0 && (size_t)eidx < SIZE_STACK(solver->import)) {
-						import *import = &PEEK_STACK (solver->import, eidx);
-						if(score >= neuralback_cfd) {
-							initial_phase_list[IDX (import->lit)] = -1;
-							applied++;
-						} else if(score <= 1.0 - neuralback_cfd) {
-							initial_phase_list[IDX (import->lit)] = 1;
-							applied++;
-						}
-					}
-				}
-				continue;
-			}
-
-			int eidx = 0, sign = 1;
-			if (*p == 'b' || *p == 'B') { p++; while (*p==' '||*p=='\t') p++; }
-			if (*p == '-' || *p == '+') { if (*p=='-') sign=-1; p++; }
-		if (sscanf(p, "%d", &eidx) == 1 && eidx > 0) {
-				if ((size_t)eidx < SIZE_STACK(solver->import)) {
-					import *import = &PEEK_STACK (solver->import, eidx);
-					initial_phase_list[IDX (import->lit)] = sign;
-					applied++;
-				}
-			}
+      while (*p == ' ' || *p == '\t')
+	p++;
+      if (*p && *p != '\r')
+	{
+	  backbone_entry entry;
+	  char *q;
+	  if (strchr (p, ','))
+	    {
+	      entry.eidx = (int) strtol (p, &q, 10);
+	      while (q != p && (*q == ' ' || *q == '\t'))
+		q++;
+	      if (q != p && *q == ',')
+		{
+		  char *r = q + 1;
+		  entry.score = strtod (r, &q);
+		  entry.scored = true;
+		  entry.sign = 1;
+		  if (q != r && entry.eidx > 0)
+		    PUSH_STACK (*entries, entry);
+		}
+	    }
+	  else
+	    {
+	      if (*p == 'b' || *p == 'B')
+		{
+		  p++;
+		  while (*p == ' ' || *p == '\t')
+		    p++;
 		}
+	      entry.sign = 1;
+	      if (*p == '-' || *p == '+')
+		{
+		  if (*p == '-')
+		    entry.sign = -1;
+		  p++;
+		}
+	      entry.eidx = (int) strtol (p, &q, 10);
+	      entry.scored = false;
+	      entry.score = 0;
+	      if (q != p && entry.eidx > 0)
+		PUSH_STACK (*entries, entry);
+	    }
 	}
+      p = eol + 1;
+    }
+}
 
-	if(GET_OPTION(neural_backbone_partial)) {
-		rewind(file->file);
-		value* initial_phase_list = solver->phases.initial;
-		const value initial_phase = INITIAL_PHASE;
-		for (all_phases (initial, p))
-			*p = initial_phase;
-
-		unsigned applied = 0;
-
-		const double weight = GET_OPTION(neural_backbone_partial_weight) / 100.0;
-		char line[128];
-		while (fgets(line, sizeof line, file->file)) {
-			char *p = line;
-			while (*p == ' ' || *p == '\t') p++;
-			if (!*p || *p == '\n' || *p == '\r') continue;
-			if (*p == 'b' || *p == 'B') { p++; while (*p==' '||*p=='\t') p++; }
-			int sign = 1, eidx = 0;
-			if (*p == '-' || *p == '+') { if (*p=='-') sign=-1; p++; }
-			if (sscanf(p, "%d", &eidx) == 1 && eidx > 0) {
-				if ((size_t)eidx < SIZE_STACK(solver->import)) {
-					const double rnd = kissat_pick_double(&solver->random);
-					if (rnd < weight) {
-						import *import = &PEEK_STACK (solver->import, eidx);
-							initial_phase_list[IDX (import->lit)] = sign;
-							applied++;
-					}
-				}
-			}
-		}
+// The file is read in one go (it can be a pipe) and parsed once for all the
+// backbone modes. Scored entries set initial phases through the confidence
+// 'neuralback_cfd', signed literals their sign. In the other modes, text
+// 'idx,score' lines count as positive literals, as they always did, and
+// binary entries as the phase of their score if it is outside the band.
+
+void
+kissat_parse_backbone (kissat * solver, file * file, double neuralback_cfd)
+{
+  chars buffer;
+  INIT_STACK (buffer);
+  for (;;)
+    {
+      if (FULL_STACK (buffer))
+	ENLARGE_STACK (buffer);
+      const size_t bytes = fread (END_STACK (buffer), 1,
+				  buffer.allocated - buffer.end, file->file);
+      if (!bytes)
+	break;
+      buffer.end += bytes;
+    }
+
+  backbone_entries entries;
+  INIT_STACK (entries);
+  const size_t size = SIZE_STACK (buffer);
+  if (size >= 4 && !memcmp (BEGIN_STACK (buffer), BACKBONE_MAGIC, 4))
+    parse_binary_backbone (solver, (unsigned char *) BEGIN_STACK (buffer),
+			   (unsigned char *) END_STACK (buffer),
+			   neuralback_cfd, &entries);
+  else
+    {
+      PUSH_STACK (buffer, 0);
+      parse_text_backbone (solver, BEGIN_STACK (buffer),
+			   BEGIN_STACK (buffer) + size, &entries);
+    }
+  RELEASE_STACK (buffer);
+
+  const size_t imported = SIZE_STACK (solver->import);
+
+  if (GET_OPTION (neural_backbone_initial)
+      || GET_OPTION (neural_backbone_prioritize))
+    {
+      value *initial_phase_list = solver->phases.initial;
+      const value initial_phase = INITIAL_PHASE;
+      for (all_phases (initial, p))
+	*p = initial_phase;
+
+      for (all_stack (backbone_entry, entry, entries))
+	{
+	  if ((size_t) entry.eidx >= imported)
+	    continue;
+	  import *import = &PEEK_STACK (solver->import, entry.eidx);
+	  const int sign = entry.scored ?
+	    score_sign (entry.score, neuralback_cfd) : entry.sign;
+	  if (sign)
+	    initial_phase_list[IDX (import->lit)] = sign;
 	}
+    }
 
-		if(GET_OPTION(neural_backbone_always) 
-		  || GET_OPTION(neural_backbone_rephase)
-		  || GET_OPTION(neural_backbone_lowscores)) {
-
-			rewind(file->file);
-			value* neural_phase_list = solver->phases.neural;
-			for (all_phases (neural, p))
-				*p = 0;
-
-		unsigned applied = 0;
-
-		char line[128];
-		while (fgets(line, sizeof line, file->file)) {
-			char *p = line;
-			while (*p == ' ' || *p == '\t') p++;
-			if (!*p || *p == '\n' || *p == '\r') continue;
-			if (*p == 'b' || *p == 'B') { p++; while (*p==' '||*p=='\t') p++; }
-			int sign = 1, eidx = 0;
-			if (*p == '-' || *p == '+') { if (*p=='-') sign=-1; p++; }
-			if (sscanf(p, "%d", &eidx) == 1 && eidx > 0) {
-				if ((size_t)eidx < SIZE_STACK(solver->import)) {
-					import *import = &PEEK_STACK (solver->import, eidx);
-						neural_phase_list[IDX (import->lit)] = sign;
-						applied++;
-				}
-			}
-		}
-  }}
+  if (GET_OPTION (neural_backbone_partial))
+    {
+      value *initial_phase_list = solver->phases.initial;
+      const value initial_phase = INITIAL_PHASE;
+      for (all_phases (initial, p))
+	*p = initial_phase;
+
+      const double weight =
+	GET_OPTION (neural_backbone_partial_weight) / 100.0;
+      for (all_stack (backbone_entry, entry, entries))
+	{
+	  if ((size_t) entry.eidx >= imported || !entry.sign)
+	    continue;
+	  const double rnd = kissat_pick_double (&solver->random);
+	  if (rnd < weight)
+	    {
+	      import *import = &PEEK_STACK (solver->import, entry.eidx);
+	      initial_phase_list[IDX (import->lit)] = entry.sign;
+	    }
+	}
+    }
+
+  if (GET_OPTION (neural_backbone_always)
+      || GET_OPTION (neural_backbone_rephase)
+      || GET_OPTION (neural_backbone_lowscores))
+    {
+      value *neural_phase_list = solver->phases.neural;
+      for (all_phases (neural, p))
+	*p = 0;
+
+      for (all_stack (backbone_entry, entry, entries))
+	{
+	  if ((size_t) entry.eidx >= imported || !entry.sign)
+	    continue;
+	  import *import = &PEEK_STACK (solver->import, entry.eidx);
+	  neural_phase_list[IDX (import->lit)] = entry.sign;
+	}
+    }
+
+  RELEASE_STACK (entries);
+}
 
 void
 kissat_parse_unsatord (kissat * solver, file * file) {
@@ -0,0 +1,155 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import texttable as tt
+import torch
+from tqdm import tqdm
+
+# components with at most this many variables get their exact backbone by enumerating all their assignments
+DEFAULT_EXACT_VARS = 12
+
+# components with at most this many variables (and more than the above) get the scores of the
+# structural polarity model, 0 leaves them to the GNN
+DEFAULT_FEATURE_VARS = 0
+
+# tiers from the cheapest to the model
+TIERS = ["exact", "features", "gnn"]
+
+# clauses checked at once against the surviving assignments
+EXACT_CLAUSE_CHUNK = 256
+
+
+def tier_of(data, exact_vars=DEFAULT_EXACT_VARS, feature_vars=DEFAULT_FEATURE_VARS):
+    num_vars = data.n2v.numel()
+    if num_vars <= exact_vars:
+        return "exact"
+    if num_vars <= feature_vars:
+        return "features"
+    return "gnn"
+
+
+def literal_edges(data):
+    # variable, clause (from 0) and sign (+1, -1) of every literal of a graph of pt_dataset.py
+    num_vars = data.n2v.numel()
+    edge_index = data.edge_index.cpu()
+    edge_attr = data.edge_attr.cpu().view(-1)
+
+    # var -> clause edges, the reverse ones and the root -> clause edges are left out
+    mask = (edge_index[0] < num_vars) & (edge_attr != 0)
+    var, clause = edge_index[0][mask].numpy(), edge_index[1][mask].numpy() - num_vars
+    return var, clause, np.sign(edge_attr[mask].numpy()).astype(np.int64)
+
+
+def exact_scores(data):
+    """
+    Scores of the variables of a tiny component from its models, enumerated:
+    the share of models where a variable is false. Backbone variables get
+    exactly 1 (false) or 0 (true), the labels the GNN is trained on, the
+    others their share in between. Unsatisfiable components get 0.5.
+    """
+    num_vars = data.n2v.numel()
+    var, clause, sign = literal_edges(data)
+    num_clauses = int(clause.max()) + 1 if clause.size > 0 else 0
+
+    # literals of every clause as bit masks over the variables
+    pos = np.zeros(num_clauses, dtype=np.int64)
+    neg = np.zeros(num_clauses, dtype=np.int64)
+    np.bitwise_or.at(pos, clause[sign > 0], np.left_shift(1, var[sign > 0]))
+    np.bitwise_or.at(neg, clause[sign < 0], np.left_shift(1, var[sign < 0]))
+
+    # assignments as bit masks, variable i true iff bit i is set
+    models = np.arange(1 << num_vars, dtype=np.int64)
+    for i in range(0, num_clauses, EXACT_CLAUSE_CHUNK):
+        p, n = pos[i:i + EXACT_CLAUSE_CHUNK], neg[i:i + EXACT_CLAUSE_CHUNK]
+        sat = ((models[:, None] & p) != 0) | ((~models[:, None] & n) != 0)
+        models = models[sat.all(axis=1)]
+        if models.size == 0:
+            return torch.full((num_vars,), 0.5)
+
+    true_share = ((models[:, None] >> np.arange(num_vars)) & 1).mean(axis=0)
+    return torch.from_numpy(1.0 - true_share).float()
+
+
+def feature_scores(data):
+    """
+    Scores of a structural polarity model: the Jeroslow-Wang weight
+    (sum of 2^-|clause|) of the negative literals of a variable over the
+    weight of all its literals. Variables of unit clauses get 0 or 1.
+    """
+    num_vars = data.n2v.numel()
+    var, clause, sign = literal_edges(data)
+    var, clause = torch.from_numpy(var), torch.from_numpy(clause)
+
+    size = torch.bincount(clause).double()
+    weight = torch.pow(2.0, -size[clause])
+    neg = torch.zeros(num_vars, dtype=torch.float64).index_add_(0, var, weight * torch.from_numpy(sign < 0).double())
+    total = torch.zeros(num_vars, dtype=torch.float64).index_add_(0, var, weight)
+
+    scores = torch.where(total > 0, neg / total.clamp(min=1e-300), torch.full_like(total, 0.5))
+    units = size[clause] == 1
+    scores[var[units]] = torch.from_numpy(sign < 0)[units].double()
+    return scores.float()
+
+
+TIER_SCORES = {"exact": exact_scores, "features": feature_scores}
+
+
+if __name__ == "__main__":
+    from predict import EXACT_VARS, FEATURE_VARS, MEMORY_BUDGET, PRECISION, batch_nodes, coalesce, get_predictor, load_graphs
+
+    parser = argparse.ArgumentParser(description="time saved by the cheap tiers of the predictor over the GNN, on a split")
+    parser.add_argument('--pt_dir_path', type=str, default="./data/pt/test/processed")
+    parser.add_argument('--precision', type=str, default=PRECISION)
+    parser.add_argument('--max_graphs', type=int, default=None)
+    parser.add_argument('--exact_vars', type=int, default=EXACT_VARS)
+    parser.add_argument('--feature_vars', type=int, default=FEATURE_VARS)
+    args = parser.parse_args()
+
+    predictor = get_predictor(False, args.precision, MEMORY_BUDGET)
+    pt_file_lst = sorted(os.listdir(args.pt_dir_path))[:args.max_graphs]
+
+    graphs = {tier: [] for tier in TIERS}
+    for pt_file, data in tqdm(load_graphs(args.pt_dir_path, pt_file_lst), total=len(pt_file_lst)):
+        graphs[tier_of(data, args.exact_vars, args.feature_vars)].append((pt_file, data))
+
+    def accuracy(group, preds):
+        # share of the labeled backbone variables whose phase the scores get right
+        correct, total = 0, 0
+        for (_, data), pred in zip(group, preds):
+            if getattr(data, "y", None) is None:
+                continue
+            mask = data.y <= 1
+            correct += int(((pred[mask] >= 0.5).long() == data.y[mask]).sum())
+            total += int(mask.sum())
+        return correct / total if total > 0 else float("nan")
+
+    table = tt.Texttable()
+    table.header(["tier", "components", "variables", "tier (s)", "gnn (s)", "saved (s)", "tier acc", "gnn acc"])
+
+    for tier in TIERS:
+        group = graphs[tier]
+        if len(group) == 0:
+            continue
+
+        # the GNN as predict.py runs it, in batches
+        predictor.predict_model_batch([group[0][1]])
+        start = time.perf_counter()
+        gnn_preds = []
+        for sub_group in coalesce(group, max_nodes=batch_nodes(is_cuda=False)):
+            gnn_preds += predictor.predict_model_batch([data for _, data in sub_group])
+        gnn_time = time.perf_counter() - start
+
+        if tier == "gnn":
+            tier_preds, tier_time = gnn_preds, gnn_time
+        else:
+            start = time.perf_counter()
+            tier_preds = [TIER_SCORES[tier](data) for _, data in group]
+            tier_time = time.perf_counter() - start
+
+        table.add_row([tier, len(group), sum(data.n2v.numel() for _, data in group), tier_time, gnn_time,
+                       gnn_time - tier_time, accuracy(group, tier_preds), accuracy(group, gnn_preds)])
+
+    table.set_precision(3)
+    print(table.draw())